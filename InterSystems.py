@@ -1,13 +1,24 @@
 from .cdev import cdev
+from .cdev import store
+from .cdev import symbols
+from .cdev import sync
+from .cdev.index import FileIndex
 
+import collections
+import concurrent.futures
+import itertools
 import json
 import os
 import re
+import shutil
 import sys
 import subprocess
 import sublime_plugin
 import sublime
+import tempfile
 import threading
+import time
+import traceback
 import webbrowser
 
 def settings_get(name, default=None, file='InterSystems.sublime-settings'):
@@ -19,21 +30,42 @@ def settings_set(name, value, file='InterSystems.sublime-settings'):
     plugin_settings.set(name, value )
     sublime.save_settings(file)
 
+metadata = None
+metadata_lock = threading.Lock()
+
+def metadata_store():
+    global metadata
+    with metadata_lock:
+        if not metadata:
+            path = os.path.join(sublime.cache_path(), 'InterSystems Cache', 'metadata')
+            metadata = store.MetadataStore(path, settings_get('metadata-cache-size', 64) * 1024 * 1024)
+        return metadata
+
 def cache_name(name, namespace_specific = False):
+    instance = current_instance()
     if namespace_specific:
-        return "{0}{1}{2}{3}".format(name, current_instance().host, current_instance().port, current_namespace().name)
+        return store.MetadataStore.key(instance.host, instance.port, current_namespace().name, name)
     else:
-        return "{0}{1}{2}".format(name, current_instance().host, current_instance().port)
+        return store.MetadataStore.key(instance.host, instance.port, name)
 
 def cache_get(name, default=None, namespace_specific = False):
     cacheName = cache_name(name, namespace_specific)
 
-    return settings_get(cacheName, default, 'InterSystemsCache.sublime-settings')
+    return metadata_store().get(cacheName, default)
 
 def cache_set(name, value, namespace_specific = False):
     cacheName = cache_name(name, namespace_specific)
 
-    settings_set(cacheName, value, 'InterSystemsCache.sublime-settings')
+    metadata_store().set(cacheName, value)
+
+def server_version(content):
+    """ returns: dict # identifies content as stored in the current namespace of the current server """
+    instance = current_instance()
+    return { 'namespace': store.MetadataStore.key(instance.host, instance.port, current_namespace().name), 'hash': cdev.content_hash(content) }
+
+def unchanged(view, content):
+    """ True if content is what the current server last sent or accepted for view. """
+    return view.settings().get('cache-version') == server_version(content)
 
 def current_namespace():
     namespace = cache_get("Namespace",{})
@@ -42,97 +74,931 @@ def current_namespace():
     else:
         sublime.active_window().run_command('change_cache_namespace', current_namespace)
 
+instances = {}
+instances_lock = threading.Lock()
+
+def instance_key(server):
+    return tuple(sorted((key, str(value)) for (key, value) in server.items()))
+
 def current_instance():
     instance_name = settings_get('current-server')
     servers = settings_get('servers',{})
-    server = servers.get(instance_name)
+    return get_instance(servers.get(instance_name))
+
+def get_instance(server):
+    """ returns: CacheInstance # for the server settings, shared until they change
+        An instance whose last request failed is replaced, so the next command reconnects and finds out
+        afresh what the server supports; one idle for instance-refresh-interval seconds rediscovers its root.
+        Nothing is probed here, as the instance is also looked up on the UI thread. """
+    key = instance_key(server)
+
+    with instances_lock:
+        instance = instances.get(key)
+        if not instance or not instance.healthy:
+            # compress_requests None has the instance find out whether the server reads compressed bodies
+            options = { 'timeout': settings_get('request-timeout', 30), 'compress_requests': None if settings_get('compress-requests', False) else False }
+            options.update(server)
+            instance = cdev.CacheInstance(**options)
+            instance.content_cache = content_cache(instance)
+            instances[key] = instance
+        elif instance.last_success and time.time() - instance.last_success > settings_get('instance-refresh-interval', 600):
+            instance.refresh()
+        return instance
+
+content_caches = {}
+
+def content_cache(instance):
+    key = (instance.host, str(instance.port))
+    if key not in content_caches:
+        path = os.path.join(sublime.cache_path(), 'InterSystems Cache', 'content', '{0}_{1}'.format(*key))
+        content_caches[key] = store.ContentCache(
+            settings_get('content-cache-memory', 16) * 1024 * 1024,
+            path,
+            settings_get('content-cache-disk', 256) * 1024 * 1024)
+    return content_caches[key]
+
+def clear_instances():
+    with instances_lock:
+        instances.clear()
+
+class RequestQueue:
+    """ Runs plugin work on a bounded set of threads.
+        Work submitted with a key already in flight is not started twice, and work
+        submitted on a channel supersedes the unfinished work on that channel. """
+    def __init__(self):
+        self.executor = None
+        self.lock = threading.Lock()
+        self.in_flight = {}
+        self.channels = {}
+        self.running = 0
+        self.local = threading.local()
+
+    def submit(self, function, *args, key = None, channel = None):
+        with self.lock:
+            if not self.executor:
+                self.executor = concurrent.futures.ThreadPoolExecutor(settings_get('max-concurrent-requests', 4))
+            if key is not None and key in self.in_flight:
+                return self.in_flight[key]
+            token = { 'cancelled': False }
+            if channel is not None:
+                previous = self.channels.get(channel)
+                if previous:
+                    previous[0]['cancelled'] = True
+                    previous[1].cancel()
+            future = self.executor.submit(self.call, token, function, args)
+            if channel is not None:
+                self.channels[channel] = (token, future)
+            if key is not None:
+                self.in_flight[key] = future
+                future.add_done_callback(lambda future: self.done(key, future))
+            return future
+
+    def call(self, token, function, args):
+        self.local.token = token
+        with self.lock:
+            self.running += 1
+        try:
+            return function(*args)
+        except Exception as e:
+            traceback.print_exc()
+            sublime.status_message("Cache request failed: {0}".format(e))
+        finally:
+            self.local.token = None
+            with self.lock:
+                self.running -= 1
+
+    def idle(self):
+        return self.running == 0
+
+    def done(self, key, future):
+        with self.lock:
+            if self.in_flight.get(key) is future:
+                del self.in_flight[key]
+
+    def superseded(self):
+        """ True when called from work that newer work on its channel has replaced. """
+        token = getattr(self.local, 'token', None)
+        return bool(token and token['cancelled'])
+
+    def shutdown(self):
+        with self.lock:
+            if self.executor:
+                self.executor.shutdown(wait=False)
+                self.executor = None
+
+requests = RequestQueue()
+
+def settings_changed():
+    clear_instances()
+    cdev.stats.trace(settings_get('trace-file'))
+
+class WarmUp:
+    """ Connects to the current server and fetches what the first interactive command would need,
+        on one background thread that only makes a request while no interactive work is running.
+        Starting a new warm-up abandons the previous one. """
+    def __init__(self):
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    def start(self, delay = 0):
+        if not settings_get('warm-up', False):
+            return
+        with self.lock:
+            self.generation += 1
+            generation = self.generation
+        thread = threading.Thread(target=self.run, args=[generation, delay])
+        thread.daemon = True
+        thread.start()
+
+    def wait(self, generation):
+        """ returns: bool # False if a newer warm-up has started """
+        while not requests.idle():
+            time.sleep(0.2)
+        return generation == self.generation
+
+    def run(self, generation, delay):
+        time.sleep(delay)
+        try:
+            if not self.wait(generation): return
+            instance = current_instance()
+            instance.namespaces
+            if not self.wait(generation): return
+            cache_set('Namespaces', [namespace.to_dict() for namespace in instance.get_namespaces()])
+            if not cache_get('Namespace', {}):
+                return
+            if not self.wait(generation): return
+            update_file_listing()
+            for (name, id) in cache_get('RecentFiles', [], True)[:settings_get('warm-up-prefetch', 10)]:
+                if not self.wait(generation): return
+                instance.get_file(file_stub(name, id))
+            sublime.status_message("Connected to {0}".format(settings_get('current-server')))
+        except Exception as e:
+            print("Cache warm-up failed: {0}".format(e))
 
-    return cdev.CacheInstance(**server)
+warm_up = WarmUp()
+
+def plugin_loaded():
+    sublime.load_settings('InterSystems.sublime-settings').add_on_change('cache-instances', settings_changed)
+    cdev.stats.trace(settings_get('trace-file'))
+    shutil.rmtree(large_output_folder(), ignore_errors=True)
+    warm_up.start(delay = 2)
+
+def plugin_unloaded():
+    sublime.load_settings('InterSystems.sublime-settings').clear_on_change('cache-instances')
+    requests.shutdown()
+    with mirrors_lock:
+        mirrors.clear()
+    cdev.stats.trace(None)
+    if metadata:
+        metadata.flush()
+    for cache in content_caches.values():
+        cache.flush()
 
 
 def download_file(file_stub):
-    file = current_instance().get_file(file_stub)
+    open_file(current_instance().get_file_cached(file_stub, refresh_file))
+    remember_file(file_stub)
+
+def remember_file(file):
+    """ Keep the most recently opened files of each namespace for warm-up prefetching. """
+    recent = [entry for entry in cache_get('RecentFiles', [], True) if entry[0] != file.name]
+    cache_set('RecentFiles', [[file.name, file.id]] + recent[:49], True)
+
+handed_off = {}
+handed_off_lock = threading.Lock()
+handed_off_keys = itertools.count()
+
+def hand_off(text):
+    """ Keep text for a command, which is passed the returned key instead of text itself,
+        so large content is not serialized into and out of the command's arguments.
+        returns: str """
+    with handed_off_lock:
+        key = str(next(handed_off_keys))
+        handed_off[key] = text
+        return key
+
+def take_text(text, text_key):
+    """ returns: str # the text a command was passed directly or by hand_off key """
+    if text_key is None:
+        return text
+    with handed_off_lock:
+        return handed_off.pop(text_key, '')
+
+def insert_text(view, edit, point, text):
+    """ Insert text with its \\r\\n line endings converted one chunk at a time, rather than copying it whole.
+        returns: int # characters inserted """
+    inserted = 0
+    for chunk in cdev.normalize_newlines(cdev.text_chunks(text)):
+        inserted += view.insert(edit, point + inserted, chunk)
+    return inserted
+
+def large_output_folder():
+    return os.path.join(tempfile.gettempdir(), 'InterSystems Cache')
+
+def open_text(window, text, name, syntax_file = None):
+    """ Open text in a new scratch view. Text over large-output-size megabytes is written to a
+        temporary file instead, which Sublime loads in the background without blocking the editor.
+        returns: View """
+    if len(text) < settings_get('large-output-size', 4) * 1024 * 1024:
+        view = window.new_file()
+        view.run_command('write_cache_output', { 'text_key': hand_off(text), 'name': name, 'syntax_file': syntax_file })
+        return view
+
+    os.makedirs(large_output_folder(), exist_ok=True)
+    path = os.path.join(tempfile.mkdtemp(dir=large_output_folder()), re.sub(r'[^\w. -]', '_', name))
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        for chunk in cdev.normalize_newlines(cdev.text_chunks(text)):
+            f.write(chunk)
+    view = window.open_file(path)
+    view.set_scratch(True)
+    if syntax_file: view.set_syntax_file(syntax_file)
+    return view
+
+def write_file(view, file):
+    """ Replace the content of view with file, as the current server version. """
+    index_source(file)
+    syntax_name = 'UDL' if file.name.endswith('.cls') else 'COS'
+    view.run_command('write_cache_output',
+        {
+            'text_key': hand_off(file.content),
+            'syntax_file': 'Packages/InterSystems Cache/CacheColors/{0}.tmLanguage'.format(syntax_name),
+            'name': file.name,
+            'file': file.to_dict(),
+            'version': server_version(file.content)
+        })
+    view.settings().set('cache-change-count', view.change_count())
+    view.erase_status('cache-newer')
+
+def uploaded_file(added, compiled):
+    """ returns: File # the file as compiled when the compile response carries its content, else as uploaded """
+    file = getattr(compiled, 'file', None)
+    return file if getattr(file, 'content', None) is not None else added.file
+
+def refresh_file(file):
+    """ Show a newer server version of file in the views holding it. Views edited since they were
+        downloaded or uploaded keep their text and say in the status bar that the server has moved on. """
+    for window in sublime.windows():
+        for view in window.views():
+            view_file = view.settings().get('file')
+            if view_file and view_file.get('id') == file.id:
+                if view.settings().get('cache-change-count') == view.change_count():
+                    write_file(view, file)
+                else:
+                    view.set_status('cache-newer', "Newer version of {0} on the server".format(file.name))
+                    sublime.status_message("{0} changed on the server; your edits were kept".format(file.name))
+
+def open_file(file, line = None):
+    index_source(file)
     syntax_name = 'UDL' if file.name.endswith('.cls') else 'COS'
     sublime.run_command('open_cache_code',
         {
-            'text':file.content,
+            'line': line,
+            'text_key': hand_off(file.content),
             'syntax_name': syntax_name,
             'name': file.name,
-            'file': vars(file)
+            'file': file.to_dict(),
+            'version': server_version(file.content)
         })
 
 
+file_indexes = {}
+file_listings = {}
+file_indexes_lock = threading.Lock()
+
+def file_listing():
+    """ The current namespace's cached file listing and its validators, read from the metadata store once per session.
+        returns: (FileList, dict) """
+    key = cache_name('Files', True)
+    with file_indexes_lock:
+        if key not in file_listings:
+            file_listings[key] = (cdev.FileList.load(cache_get('Files', None, True)), cache_get('FilesValidators', {}, True))
+        return file_listings[key]
+
+def file_index():
+    """ The search index over the current namespace's cached file listing, built once per session. """
+    key = cache_name('Files', True)
+    files = file_listing()[0]
+    with file_indexes_lock:
+        if key not in file_indexes:
+            file_indexes[key] = FileIndex.from_files(files)
+        return file_indexes[key]
+
+def update_file_listing():
+    """ Revalidate the current namespace's file listing, updating its index with any changes.
+        returns: FileIndex """
+    key = cache_name('Files', True)
+    index = file_index()
+    files, validators = file_listing()
+    files, validators, changed = current_instance().revalidate_files(current_namespace(), files, validators)
+    if changed:
+        with file_indexes_lock:
+            file_listings[key] = (files, validators)
+        cache_set('Files', files.to_columns(), True)
+        cache_set('FilesValidators', validators, True)
+        index.sync(files)
+    return index
+
+def file_stub(name, id):
+    return cdev.File({ 'name': name, 'id': id })
+
+symbol_indexes = {}
+symbol_indexes_lock = threading.Lock()
+symbol_saves = set()
+
+def symbol_index():
+    """ The symbol index of the current namespace, loaded from the metadata store once per session. """
+    key = cache_name('Symbols', True)
+    with symbol_indexes_lock:
+        if key not in symbol_indexes:
+            symbol_indexes[key] = symbols.SymbolIndex.load(cache_get('Symbols', None, True))
+        return symbol_indexes[key]
+
+def index_source(file):
+    """ Add the content of a downloaded or uploaded file to the symbol index, which is saved a few seconds later. """
+    if getattr(file, 'content', None) is None or file.name.rpartition('.')[2].lower() not in ('cls', 'mac', 'int', 'inc'):
+        return
+    index = symbol_index()
+    if not index.update(file.name, file.content):
+        return
+    key = cache_name('Symbols', True)
+    with symbol_indexes_lock:
+        if key in symbol_saves:
+            return
+        symbol_saves.add(key)
+    def save():
+        with symbol_indexes_lock:
+            symbol_saves.discard(key)
+        metadata_store().set(key, index.to_dict())
+    sublime.set_timeout(lambda: requests.submit(save), 5000)
+
+def index_files(names):
+    """ Download and index the files among names that exist on the server but are not indexed yet.
+        returns: [ str ] # names that are now indexed """
+    index = symbol_index()
+    listing = file_index()
+    if not len(listing):
+        listing = update_file_listing()
+    stubs = [file_stub(name, listing.id(name)) for name in names if name not in index and listing.id(name)]
+    for (stub, file) in current_instance().get_files_content(stubs, settings_get('download-concurrency', 8)):
+        if isinstance(file, Exception):
+            print("Cannot Index {0}: {1}".format(stub.name, file))
+        else:
+            index_source(file)
+    return [name for name in names if name in index]
+
 class DownloadClassOrRoutine(sublime_plugin.ApplicationCommand):
     def run(self):
-        threading.Thread(target=self.go).start()
+        requests.submit(self.go, key='download_class_or_routine', channel='quick_panel')
 
     def go(self):
-        self.cached_files = [cdev.File(file) for file in cache_get('Files', [], True)]
-        if len(self.cached_files):
-            sublime.active_window().show_quick_panel([file.name for file in self.cached_files], self.download)
+        self.entries = sorted(file_index().entries())
+        if len(self.entries) and not requests.superseded():
+            sublime.active_window().show_quick_panel([name for (name, id) in self.entries], self.download)
         #Update the Cache
-        files = current_instance().get_files(current_namespace())
-        if not len(self.cached_files):
-            self.cached_files = files
-            sublime.active_window().show_quick_panel([file.name for file in self.cached_files], self.download)
-        cache_set('Files', [vars(file) for file in files], True)
+        index = update_file_listing()
+        if not len(self.entries) and not requests.superseded():
+            self.entries = sorted(index.entries())
+            sublime.active_window().show_quick_panel([name for (name, id) in self.entries], self.download)
 
     def download(self,index):
         if index >= 0:
-            file_stub = self.cached_files[index]
-            download_file(file_stub)
+            stub = file_stub(*self.entries[index])
+            requests.submit(download_file, stub, key=('download_file', stub.id))
+
+class FindCacheFile(sublime_plugin.ApplicationCommand):
+    """ Fuzzy search over the file index. Words starting with a dot filter by type, e.g. 'pers .cls' """
+    def run(self):
+        sublime.active_window().show_input_panel("Find file", "", self.take_query, None, None)
 
+    def take_query(self, query):
+        requests.submit(self.go, query, channel='quick_panel')
 
-class UploadClassOrRoutine(sublime_plugin.ApplicationCommand):
-    def get_class_name(self):
-        match = re.search(r"^Class\s((\%|[a-zA-Z])(\w|\.)+)\s", self.text, re.MULTILINE)
-        if match:
-            return match.group(1) + ".cls"
+    def go(self, query):
+        words = query.split()
+        types = [word.lower() for word in words if word.startswith('.')] or None
+        text = ''.join(word for word in words if not word.startswith('.'))
+        index = file_index()
+        if not len(index):
+            index = update_file_listing()
+        self.names = index.search(text, types, settings_get('find-file-results', 200))
+        self.index = index
+        if requests.superseded():
+            return
+        if len(self.names):
+            sublime.active_window().show_quick_panel(self.names, self.download)
         else:
-            match = re.search(r"^;((\%|[a-zA-Z])(\w|\.)+)\s", self.text, re.MULTILINE)
-            return None
+            sublime.status_message("No files match {0}".format(query))
 
-    def compile(self, new_file):
-        result = current_instance().compile_file(new_file,"ck")
-        if result.success:
-            sublime.status_message("Compiled {0}".format(result.file.name))
-            return True
+    def download(self, position):
+        if position >= 0:
+            name = self.names[position]
+            stub = file_stub(name, self.index.id(name))
+            requests.submit(download_file, stub, key=('download_file', stub.id))
+
+
+class DownloadPackage(sublime_plugin.ApplicationCommand):
+    def run(self, prefix = None, folder = None):
+        self.folder = folder or settings_get('download-folder')
+        if prefix is None:
+            sublime.active_window().show_input_panel("Download files starting with", "", self.take_prefix, None, None)
+        else:
+            self.take_prefix(prefix)
+
+    def take_prefix(self, prefix):
+        requests.submit(self.go, prefix, key=('download_package', prefix))
+
+    def go(self, prefix):
+        index = file_index()
+        if not len(index):
+            index = update_file_listing()
+        files = [file_stub(name, index.id(name)) for name in index.prefix(prefix)]
+        if not len(files):
+            sublime.status_message("No files start with {0}".format(prefix))
+            return
+
+        if self.folder:
+            os.makedirs(os.path.expanduser(self.folder), exist_ok=True)
+
+        done = 0
+        errors = []
+        for (stub, file) in current_instance().get_files_content(files, settings_get('download-concurrency', 8)):
+            done += 1
+            if isinstance(file, Exception):
+                errors.append("{0}: {1}".format(stub.name, file))
+            elif self.folder:
+                self.write(file)
+                index_source(file)
+            else:
+                open_file(file)
+            sublime.status_message("Downloaded {0} of {1} files".format(done, len(files)))
+
+        if len(errors):
+            sublime.run_command('show_cache_errors', { 'errors': errors })
+
+    def write(self, file):
+        path = os.path.join(os.path.expanduser(self.folder), file.name)
+        with open(path, 'w', encoding='utf-8', newline='\n') as f:
+            f.write(file.content.replace('\r\n','\n'))
+
+mirrors = {}
+mirrors_lock = threading.Lock()
+
+def mirror_tick(mirror, passes):
+    """ Scan a mirror's folder every sync-local-interval seconds and revalidate the server
+        every sync-server-interval seconds, until the mirror is stopped. """
+    with mirrors_lock:
+        if mirrors.get(mirror.path) is not mirror:
+            return
+    local_interval = max(1, settings_get('sync-local-interval', 2))
+    server_passes = max(1, settings_get('sync-server-interval', 30) // local_interval)
+    requests.submit(run_mirror, mirror, passes % server_passes == 0, key=('mirror', mirror.path))
+    sublime.set_timeout(lambda: mirror_tick(mirror, passes + 1), local_interval * 1000)
+
+def run_mirror(mirror, server):
+    report_mirror(mirror, mirror.sync(server=server))
+
+def report_mirror(mirror, result):
+    if result:
+        sublime.status_message("{0}: {1}".format(mirror.path, result.summary()))
+    errors = ["{0}: changed here and on the server, server copy saved as {0}{1}".format(name, sync.CONFLICT_SUFFIX)
+              for name in result.conflicts] + result.errors
+    if len(errors):
+        sublime.run_command('show_cache_errors', { 'errors': errors })
+
+class MirrorCacheNamespace(sublime_plugin.ApplicationCommand):
+    def run(self, folder = None, prefix = None):
+        self.prefix = prefix
+        if folder is None:
+            sublime.active_window().show_input_panel("Mirror namespace to folder", settings_get('download-folder') or "", self.take_folder, None, None)
         else:
+            self.take_folder(folder)
+
+    def take_folder(self, folder):
+        self.folder = folder
+        if self.prefix is None:
+            sublime.active_window().show_input_panel("Mirror files starting with", "", self.take_prefix, None, None)
+        else:
+            self.take_prefix(self.prefix)
+
+    def take_prefix(self, prefix):
+        requests.submit(self.go, self.folder, prefix, key=('mirror', self.folder))
+
+    def go(self, folder, prefix):
+        mirror = sync.NamespaceMirror(current_instance(), current_namespace(), folder, prefix, settings_get('download-concurrency', 8))
+        with mirrors_lock:
+            mirrors[mirror.path] = mirror
+        sublime.status_message("Mirroring {0} to {1}".format(mirror.namespace.name, mirror.path))
+        # A folder mirrored before keeps its local edits; a new one starts with a full download
+        result = mirror.sync() if mirror.state['files'] else mirror.pull()
+        report_mirror(mirror, result)
+        sublime.set_timeout(lambda: mirror_tick(mirror, 1), settings_get('sync-local-interval', 2) * 1000)
+
+class StopCacheMirror(sublime_plugin.ApplicationCommand):
+    def run(self):
+        with mirrors_lock:
+            self.paths = sorted(mirrors)
+        if len(self.paths):
+            sublime.active_window().show_quick_panel(self.paths, self.stop)
+        else:
+            sublime.status_message("No folders are being mirrored")
+
+    def stop(self, index):
+        if index != -1:
+            with mirrors_lock:
+                mirrors.pop(self.paths[index], None)
+            sublime.status_message("Stopped mirroring {0}".format(self.paths[index]))
+
+class MirrorSaveListener(sublime_plugin.EventListener):
+    def on_post_save(self, view):
+        if not view.file_name():
+            return
+        with mirrors_lock:
+            targets = [(mirror, mirror.contains(view.file_name())) for mirror in mirrors.values()]
+        for (mirror, name) in targets:
+            if name:
+                requests.submit(lambda mirror, name: report_mirror(mirror, mirror.push(name)), mirror, name)
+
+def show_line(view, line):
+    if view.is_loading():
+        sublime.set_timeout(lambda: show_line(view, line), 50)
+        return
+    point = view.text_point(line - 1, 0)
+    view.sel().clear()
+    view.sel().add(sublime.Region(point))
+    view.show_at_center(point)
+
+def open_symbol(name, line):
+    """ Show line of file name, in its open view if there is one. """
+    for window in sublime.windows():
+        for view in window.views():
+            view_file = view.settings().get('file')
+            if view_file and view_file.get('name') == name:
+                window.focus_view(view)
+                show_line(view, line)
+                return
+    requests.submit(lambda: open_file(current_instance().get_file_cached(file_stub(name, file_index().id(name))), line))
+
+def view_reference(view):
+    """ returns: (reference, str, str) # (symbols.reference_at the caret, file name, class name) of view """
+    point = view.sel()[0].begin()
+    line = view.line(point)
+    view_file = view.settings().get('file') or {}
+    name = view_file.get('name')
+    class_name = name[:-4] if name and name.endswith('.cls') else None
+    return symbols.reference_at(view.substr(line), point - line.begin()), name, class_name
+
+def find_definitions(reference, file_name, class_name):
+    """ Resolve a reference against the symbol index, fetching only the files it needs and has not indexed.
+        returns: [ Symbol ] """
+    kind, name, routine = reference
+    index = symbol_index()
+    if kind == 'label':
+        files = index_files([routine + extension for extension in ('.mac', '.int', '.inc')])
+        if not name:
+            return [symbols.Symbol('routine', routine, file, 1, None) for file in files]
+        return [symbol for symbol in index.definitions(name, ['label']) if symbol.file in files]
+    if kind == 'macro':
+        if file_name:
+            index_files([include + '.inc' for include in index.includes(file_name)])
+        return index.definitions(name, ['macro'])
+    if kind in ('class', 'name'):
+        qualified = symbols.qualify(name, symbols.package_of(class_name or ''))
+        if index_files([qualified + '.cls']):
+            return index.definitions(qualified, ['class'])
+        if kind == 'class':
+            return []
+
+    member = name.rpartition('.')[2]
+    if class_name:
+        for depth in range(10):
+            missing = index.superclasses(class_name)[1]
+            if not missing or not index_files([superclass + '.cls' for superclass in missing]):
+                break
+        found = index.members(class_name, member)
+        if found:
+            return found
+    return [symbol for symbol in index.definitions(member) if symbol.kind != 'class']
+
+def symbol_caption(symbol):
+    return ["{0} {1}".format(symbol.kind, symbol.name), "{0}:{1}".format(symbol.file, symbol.line)]
+
+class GoToCacheDefinition(sublime_plugin.TextCommand):
+    def go(self, reference, file_name, class_name):
+        self.symbols = find_definitions(reference, file_name, class_name)
+        if len(self.symbols) == 1:
+            self.open(0)
+        elif len(self.symbols) and not requests.superseded():
+            sublime.active_window().show_quick_panel([symbol_caption(symbol) for symbol in self.symbols], self.open)
+        elif not len(self.symbols):
+            sublime.status_message("No definition of {0} found".format(reference[1]))
+
+    def open(self, index):
+        if index >= 0:
+            open_symbol(self.symbols[index].file, self.symbols[index].line)
+
+    def run(self, edit):
+        reference, file_name, class_name = view_reference(self.view)
+        if reference:
+            requests.submit(self.go, reference, file_name, class_name, key=('go_to_cache_definition', self.view.id()), channel='quick_panel')
+
+class FindCacheReferences(sublime_plugin.TextCommand):
+    def go(self, reference):
+        kind, name, routine = reference
+        if kind == 'name' and '.' in name and not file_index().id(name + '.cls'):
+            name = name.rpartition('.')[2]
+        self.references = symbol_index().references(name)[:settings_get('find-file-results', 200)]
+        if not len(self.references):
+            sublime.status_message("No references to {0} in the {1} indexed files".format(name, len(symbol_index())))
+        elif not requests.superseded():
+            sublime.active_window().show_quick_panel(["{0}:{1}".format(file, line) for (file, line) in self.references], self.open)
+
+    def open(self, index):
+        if index >= 0:
+            open_symbol(*self.references[index])
+
+    def run(self, edit):
+        reference = view_reference(self.view)[0]
+        if reference:
+            requests.submit(self.go, reference, key=('find_cache_references', self.view.id()), channel='quick_panel')
+
+class DeployToServers(sublime_plugin.ApplicationCommand):
+    """ Upload and compile the active file, or every open Cache file, on several servers at once.
+        An XML export in the active view is loaded as a bundle. """
+    def run(self, servers = None, scope = None):
+        window = sublime.active_window()
+        self.view = window.active_view()
+        configured = sorted(settings_get('servers', {}).keys())
+        self.groups = []
+        if settings_get('deploy-servers'):
+            self.groups.append(("Deploy servers: {0}".format(", ".join(settings_get('deploy-servers'))), settings_get('deploy-servers')))
+        self.groups.append(("All servers", configured))
+        self.groups.extend((name, [name]) for name in configured)
+        self.scope = scope
+        if servers is not None:
+            self.take_servers(servers)
+        else:
+            window.show_quick_panel([caption for (caption, names) in self.groups], self.choose_servers)
+
+    def choose_servers(self, index):
+        if index >= 0:
+            self.take_servers(self.groups[index][1])
+
+    def take_servers(self, servers):
+        self.servers = servers
+        if self.scope is not None:
+            self.take_scope(self.scope)
+        else:
+            self.scopes = ['active', 'open']
+            sublime.active_window().show_quick_panel(["Active file", "All open Cache files"], self.choose_scope)
+
+    def choose_scope(self, index):
+        if index >= 0:
+            self.take_scope(self.scopes[index])
+
+    def take_scope(self, scope):
+        views = [self.view] if scope == 'active' else sublime.active_window().views()
+        files = []
+        xml = None
+        for view in views:
+            text = view.substr(sublime.Region(0, view.size())).replace('\n','\r\n')
+            if scope == 'active' and text.lstrip().startswith('<?xml'):
+                xml = text
+                continue
+            name = get_class_name(text)
+            if not name:
+                view_file = view.settings().get('file')
+                name = view_file.get('name') if view_file else None
+            if name:
+                files.append((name, text))
+        if not files and not xml:
+            sublime.status_message("No Cache files to deploy")
+            return
+        requests.submit(self.go, self.servers, current_namespace().name, files, xml, key='deploy_to_servers')
+
+    def go(self, servers, namespace, files, xml):
+        configured = settings_get('servers', {})
+        targets = [(name, get_instance(configured[name])) for name in servers if name in configured]
+        sublime.status_message("Deploying {0} files to {1} servers".format(len(files) + bool(xml), len(targets)))
+        results = cdev.deploy(targets, namespace, files, xml, "ck", settings_get('upload-concurrency', 8))
+        sublime.run_command('open_cache_output', {
+                'text_key': hand_off(cdev.deploy_report(results)),
+                'name': "Deploy to {0}".format(", ".join(servers))
+            })
+        failed = len([result for result in results if not result.success])
+        sublime.status_message("Deployed to {0} of {1} servers".format(len(results) - failed, len(results)))
+
+
+def get_class_name(text):
+    match = re.search(r"^Class\s((\%|[a-zA-Z])(\w|\.)+)\s", text, re.MULTILINE)
+    if match:
+        return match.group(1) + ".cls"
+    else:
+        match = re.search(r"^;((\%|[a-zA-Z])(\w|\.)+)\s", text, re.MULTILINE)
+        return None
+
+class UploadQueue:
+    """ Uploads and compiles files one at a time per file and in parallel across files.
+        A file is uploaded upload-delay seconds after its last submission; content submitted
+        again before then, or while the file is uploading, replaces the content waiting to go,
+        so a burst of uploads of one file costs one upload of its latest text. """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.generations = collections.Counter()
+        self.active = set()
+        self.latencies = collections.deque(maxlen=20)
+        self.status_views = {}
+
+    def submit(self, view, name, text):
+        with self.lock:
+            submitted = self.pending[name][3] if name in self.pending else time.time()
+            self.pending[name] = (view, text, view.change_count(), submitted)
+            self.generations[name] += 1
+            generation = self.generations[name]
+        sublime.set_timeout(lambda: self.ready(name, generation), int(settings_get('upload-delay', 0.3) * 1000))
+        self.show_status(view)
+
+    def ready(self, name, generation):
+        with self.lock:
+            if generation != self.generations[name] or name in self.active:
+                return
+            self.active.add(name)
+        requests.submit(self.run, name)
+
+    def run(self, name):
+        while True:
+            with self.lock:
+                entry = self.pending.pop(name, None)
+                if entry is None:
+                    self.active.discard(name)
+                    break
+            view, text, change_count, submitted = entry
+            try:
+                self.upload(view, name, text, change_count)
+            except Exception as e:
+                traceback.print_exc()
+                sublime.status_message("Cannot upload {0}: {1}".format(name, e))
+            self.latencies.append(time.time() - submitted)
+            self.show_status(view)
+
+    def upload(self, view, name, text, change_count):
+        instance = current_instance()
+        result = instance.add_file(current_namespace(), name, text)
+        if not result.success:
             sublime.run_command('show_cache_errors', { 'errors': result.errors })
-            return False
+            return
+        if self.waiting(name):
+            # Newer content is waiting; compiling this version would be wasted work
+            return
+        compiled = instance.compile_file(result.file, "ck")
+        if not compiled.success:
+            sublime.run_command('show_cache_errors', { 'errors': compiled.errors })
+            return
+        file = uploaded_file(result, compiled)
+        sublime.status_message("Compiled {0}".format(file.name))
+        if not self.waiting(name) and view.change_count() == change_count:
+            write_file(view, file)
+        else:
+            index_source(file)
 
-    def update(self,result):
-        if result.success:
-            success = self.compile(result.file)
-            if success:
-                syntax_name = 'UDL' if result.file.name.endswith('.cls') else 'COS'
-                self.view.run_command('write_cache_code',
-                    {
-                        'text': result.file.content,
-                        'syntax_name': syntax_name,
-                        'name': result.file.name
-                    })
+    def waiting(self, name):
+        """ returns: bool # newer content for name has been submitted and is waiting to go """
+        with self.lock:
+            return name in self.pending
+
+    def claim(self, names):
+        """ Mark files as uploading for a caller that uploads them itself, such as a batch upload.
+            returns: set # the names claimed; files already queued or uploading are left to the queue """
+        with self.lock:
+            claimed = set(name for name in names if name not in self.pending and name not in self.active)
+            self.active.update(claimed)
+        return claimed
 
+    def release(self, names):
+        """ End a claim. Content submitted for the files in the meantime is uploaded now. """
+        with self.lock:
+            self.active.difference_update(names)
+            waiting = [name for name in names if name in self.pending]
+            self.active.update(waiting)
+        for name in waiting:
+            requests.submit(self.run, name)
+
+    def status(self):
+        """ returns: str # e.g. 'Cache: 2 queued, 1 uploading, 340 ms' or '' when idle """
+        with self.lock:
+            queued = len([name for name in self.pending if name not in self.active])
+            active = len(self.active)
+            latencies = sorted(self.latencies)
+        if not queued and not active:
+            return ''
+        text = "Cache: {0} queued, {1} uploading".format(queued, active)
+        if latencies:
+            text += ", {0:.0f} ms".format(latencies[len(latencies) // 2] * 1000)
+        return text
+
+    def show_status(self, view):
+        text = self.status()
+        with self.lock:
+            self.status_views[view.id()] = view
+            views = list(self.status_views.values())
+            if not text:
+                self.status_views.clear()
+        for status_view in views:
+            if text:
+                status_view.set_status('cache-uploads', text)
+            else:
+                status_view.erase_status('cache-uploads')
+
+uploads = UploadQueue()
+
+class UploadClassOrRoutine(sublime_plugin.ApplicationCommand):
     def take_name(self, name):
-        if not x[-4] == '.':
+        if not name[-4:-3] == '.':
             name += ".mac"
-        result = current_instance().add_file(current_namespace(), name, self.text)
-        self.update(result)
+        uploads.submit(self.view, name, self.text)
 
     def run(self):
-        threading.Thread(target=self.go).start()
+        requests.submit(self.go, key=('upload_class_or_routine', sublime.active_window().active_view().id()))
 
     def go(self):
         self.view = sublime.active_window().active_view()
         self.text = self.view.substr(sublime.Region(0, self.view.size())).replace('\n','\r\n')
-        
-        class_name = self.get_class_name()
+        if unchanged(self.view, self.text):
+            sublime.status_message("No changes to upload")
+            return
+
+        class_name = get_class_name(self.text)
         if class_name:
-            result = current_instance().add_file(current_namespace(), class_name, self.text)
-            self.update(result)
+            uploads.submit(self.view, class_name, self.text)
         else:
             self.view.window().show_input_panel("Enter a name for this routine", "", self.take_name)
 
+class UploadOpenFiles(sublime_plugin.ApplicationCommand):
+    def file_name(self, view, text):
+        name = get_class_name(text)
+        if not name:
+            view_file = view.settings().get('file')
+            name = view_file.get('name') if view_file else None
+        return name
+
+    def run(self):
+        self.uploads = []
+        for view in sublime.active_window().views():
+            if view.settings().get('cache-change-count') == view.change_count():
+                continue
+            text = view.substr(sublime.Region(0, view.size())).replace('\n','\r\n')
+            name = self.file_name(view, text)
+            if name and not unchanged(view, text):
+                self.uploads.append((view, name, text, view.change_count()))
+        if len(self.uploads):
+            requests.submit(self.go, key='upload_open_files')
+        else:
+            sublime.status_message("No changed Cache files are open")
+
+    def go(self):
+        # Files the upload queue already has are left to it, and it holds back new saves until the batch is done
+        claimed = uploads.claim([name for (view, name, text, change_count) in self.uploads])
+        try:
+            self.upload([upload for upload in self.uploads if upload[1] in claimed])
+        finally:
+            uploads.release(claimed)
+
+    def upload(self, files):
+        instance = current_instance()
+        namespace = current_namespace()
+        concurrency = settings_get('upload-concurrency', 8)
+        sublime.status_message("Uploading {0} files".format(len(files)))
+        added = instance.add_files(namespace, [(name, text) for (view, name, text, change_count) in files], concurrency)
+
+        errors = []
+        compiling = []
+        for ((view, name, text, change_count), result) in zip(files, added):
+            if result.success:
+                compiling.append((view, change_count, result))
+            else:
+                errors.extend(self.format_errors(name, getattr(result, 'errors', [])))
+
+        if len(compiling):
+            sublime.status_message("Compiling {0} files".format(len(compiling)))
+            compiled = instance.compile_files(namespace, [result.file for (view, change_count, result) in compiling], "ck", concurrency)
+            for ((view, change_count, added), result) in zip(compiling, compiled):
+                if not result.success:
+                    errors.extend(self.format_errors(added.file.name, getattr(result, 'errors', [])))
+                    continue
+                file = uploaded_file(added, result)
+                if not uploads.waiting(file.name) and view.change_count() == change_count:
+                    write_file(view, file)
+                else:
+                    index_source(file)
+
+        if len(errors):
+            sublime.run_command('show_cache_errors', { 'errors': errors })
+        else:
+            sublime.status_message("Compiled {0} files".format(len(compiling)))
+
+    def format_errors(self, name, errors):
+        return ["{0}: {1}".format(name, error) for error in errors]
+
 class OpenInBrowser(sublime_plugin.TextCommand):
     def run(self, edit):
         file = self.view.settings_get('file')
@@ -142,23 +1008,32 @@ class OpenInBrowser(sublime_plugin.TextCommand):
 class ChangeCacheNamespace(sublime_plugin.ApplicationCommand):
     def change(self, index):
         if index >= 0:
-            cache_set('Namespace', vars(self.namespaces[index]))
+            current_instance().query_cache.clear()
+            cache_set('Namespace', self.namespaces[index].to_dict())
+            warm_up.start()
             if self.callback:
                 self.callback()
 
 
     def run(self, callback = None):
         self.callback = callback
-        threading.Thread(target=self.go).start()
+        requests.submit(self.go, key='change_cache_namespace', channel='quick_panel')
 
     def go(self):
-        self.namespaces = current_instance().get_namespaces()
-        sublime.active_window().show_quick_panel([namespace.name for namespace in self.namespaces], self.change)
+        self.namespaces = [cdev.Namespace(namespace) for namespace in cache_get('Namespaces', [])]
+        if len(self.namespaces) and not requests.superseded():
+            sublime.active_window().show_quick_panel([namespace.name for namespace in self.namespaces], self.change)
+        namespaces = current_instance().get_namespaces()
+        cache_set('Namespaces', [namespace.to_dict() for namespace in namespaces])
+        if not len(self.namespaces) and not requests.superseded():
+            self.namespaces = namespaces
+            sublime.active_window().show_quick_panel([namespace.name for namespace in self.namespaces], self.change)
 
 class ChangeCacheInstance(sublime_plugin.ApplicationCommand):
     def change(self,index):
         if index >= 0:
             settings_set('current-server',self.items[index])
+            warm_up.start()
             
     def run(self):
         servers = settings_get('servers', default=[])
@@ -169,63 +1044,71 @@ def get_file(view):
     view_file = view.settings().get('file', None)
     return cdev.File(view_file) if view_file else None
 
+def generated_files(file):
+    """ The generated files of a class, compiling it only if its source changed since the list was cached.
+        returns: ([ File ], [ str ]) # (generated files, compile errors) """
+    instance = current_instance()
+    key = 'GeneratedFiles/{0}'.format(file.name)
+    source_hash = cdev.content_hash(instance.get_file(file).content)
+    cached = cache_get(key, None, True)
+    if cached and cached['hash'] == source_hash:
+        return [cdev.File(generated) for generated in cached['files']], []
+
+    compile_result = instance.compile_file(file, 'ck-u')
+    if not compile_result.success:
+        return [], compile_result.errors
+    if hasattr(compile_result.file, 'content'):
+        source_hash = cdev.content_hash(compile_result.file.content)
+    files = instance.get_generated_files(compile_result.file)
+    cache_set(key, { 'hash': source_hash, 'files': [generated.to_dict() for generated in files] }, True)
+    return files, []
+
+def prefetch_files(files):
+    """ Download files into the content cache so opening them needs no transfer. """
+    for (stub, file) in current_instance().get_files_content(files, settings_get('download-concurrency', 8)):
+        if isinstance(file, Exception):
+            print("Cannot Prefetch {0}: {1}".format(stub.name, file))
+        else:
+            index_source(file)
+
 class OpenGeneratedFiles(sublime_plugin.TextCommand):
     def go(self):
         file = get_file(self.view)
         if file:
-            compile_result = current_instance().compile_file(file, 'ck-u')
-            if compile_result.success:
-                self.files = current_instance().get_generated_files(compile_result.file)
-                if len(self.files):
-                    sublime.active_window().show_quick_panel([file.name for file in self.files], self.download)
-            else:
-                sublime.run_command('show_cache_errors', { 'errors': compile_result.errors })
+            self.files, errors = generated_files(file)
+            if len(errors):
+                sublime.run_command('show_cache_errors', { 'errors': errors })
+            elif len(self.files) and not requests.superseded():
+                if settings_get('prefetch-generated-files', True):
+                    requests.submit(prefetch_files, self.files, key=('prefetch_generated_files', file.name))
+                sublime.active_window().show_quick_panel([file.name for file in self.files], self.download)
 
     def download(self,index):
         if index >= 0:
-            file_stub = self.files[index]
-            download_file(file_stub)
+            stub = self.files[index]
+            requests.submit(download_file, stub, key=('download_file', stub.id))
 
     def run(self, edit):
-        threading.Thread(target=self.go).start()
+        requests.submit(self.go, key=('open_generated_files', self.view.id()), channel='quick_panel')
 
 class RunSqlQuery(sublime_plugin.TextCommand):
-    def resultSetToString(self, content):
-        lines = ['|', '']
-        for (header, column) in content.items():
-            lines[0] += header
-
-            i = 2
-            for field in column:
-                if len(lines) <= i:
-                    lines.append('|')
-                lines[i] += field
-                i += 1
-            max_len = max([len(line) for line in lines])
-            lines = [line.ljust(max_len, ' ') + '|' for line in lines]
-            lines[1] = '=' * (max_len + 1)
-
-        lines.append('-' * len(lines[1]))
-        output = '\n'.join(lines)
-        return output
-
     def go(self, text):
-        addresult = current_instance().add_query(current_namespace(), text)
-        if addresult.success:
-            executeresult = current_instance().execute_query(addresult.query)
-            if executeresult.success:
-                output = self.resultSetToString(executeresult.resultset)
-                sublime.run_command('open_cache_output', {
-                        'text': output,
-                        'name': text
-                    })
-            else:
-                sublime.run_command('show_cache_errors', { 'errors': executeresult.errors })
+        pages = current_instance().run_query(current_namespace(), text, settings_get('query-page-size', 1000))
+        executeresult = next(pages)
+        if executeresult.success:
+            format = settings_get('query-output-format', 'table')
+            widths = cdev.column_widths(executeresult.resultset, settings_get('query-max-column-width'))
+            output = cdev.render_resultset(executeresult.resultset, format, widths=widths)
+            sublime.run_command('open_cache_output', {
+                    'text_key': hand_off(output),
+                    'name': text,
+                    'pages_key': hand_off((pages, format, widths))
+                })
         else:
-            sublime.run_command('show_cache_errors', { 'errors': addresult.errors })
+            sublime.run_command('show_cache_errors', { 'errors': executeresult.errors })
 
     def run_query(self, text):
-        threading.Thread(target=self.go, args=[text]).start()
+        requests.submit(self.go, text, key=('run_sql_query', text))
 
     def run(self, edit):
         selection = self.view.sel()
@@ -235,14 +1118,91 @@ class RunSqlQuery(sublime_plugin.TextCommand):
             text = self.view.substr(region)
             self.run_query(text)
 
+query_pages = {}
+
+class ShowQueryPlan(sublime_plugin.TextCommand):
+    def go(self, text):
+        result = current_instance().query_plan(current_namespace(), text)
+        if result.success:
+            window = sublime.active_window()
+            panel = window.create_output_panel('InterSystems Query Plan')
+            window.run_command('show_panel', { 'panel': 'output.InterSystems Query Plan' })
+            panel.run_command('write_cache_error', { 'errortext': '{0}\n\n{1}'.format(text.strip(), result.plan.replace('\r\n', '\n')) })
+        else:
+            sublime.run_command('show_cache_errors', { 'errors': result.errors })
+
+    def run(self, edit):
+        region = self.view.sel()[0]
+        if region.empty():
+            region = sublime.Region(0, self.view.size())
+        requests.submit(self.go, self.view.substr(region), key=('show_query_plan', self.view.id()))
+
+class MoreQueryResults(sublime_plugin.TextCommand):
+    def go(self, pages, format, widths):
+        executeresult = next(pages, None)
+        if executeresult is None:
+            sublime.status_message("No more rows")
+        elif executeresult.success:
+            # Cells wider than the columns so far widen them, up to query-max-column-width, under a new header
+            page_widths = [max(width, needed) for (width, needed) in
+                           zip(widths, cdev.column_widths(executeresult.resultset, settings_get('query-max-column-width')))]
+            header = format == 'table' and page_widths != widths
+            output = cdev.render_resultset(executeresult.resultset, format, widths=page_widths, header=header)
+            self.view.run_command('append_cache_output', { 'text_key': hand_off(output), 'replace_last_line': format == 'table' and not header })
+            query_pages[self.view.id()] = (pages, format, page_widths)
+        else:
+            sublime.run_command('show_cache_errors', { 'errors': executeresult.errors })
+
+    def run(self, edit):
+        query = query_pages.pop(self.view.id(), None)
+        if query:
+            requests.submit(self.go, *query, key=('more_query_results', self.view.id()))
+
+    def is_enabled(self):
+        return self.view.id() in query_pages
+
+class QueryPagesListener(sublime_plugin.EventListener):
+    def on_close(self, view):
+        query_pages.pop(view.id(), None)
+
+def load_xml(content):
+    """ Load every file in an export, opening the file if there is only one. """
+    results = current_instance().import_xml(current_namespace(), content, settings_get('upload-concurrency', 8))
+    errors = []
+    loaded = []
+    for result in results:
+        if result.success:
+            loaded.append(result.file)
+        else:
+            errors.extend(getattr(result, 'errors', []))
+    if len(errors):
+        sublime.run_command('show_cache_errors', { 'errors': errors })
+    if len(loaded) == 1 and len(results) == 1:
+        download_file(loaded[0])
+    else:
+        sublime.status_message("Loaded {0} of {1} files".format(len(loaded), len(results)))
+
 class LoadXml(sublime_plugin.TextCommand):
     def go(self):
         self.text = self.view.substr(sublime.Region(0, self.view.size()))
-        operation = current_instance().add_xml(current_namespace(), self.text)
-        download_file(operation.file)
+        load_xml(self.text)
 
     def run(self, edit):
-        threading.Thread(target=self.go).start()
+        requests.submit(self.go, key=('load_xml', self.view.id()))
+
+class LoadXmlFile(sublime_plugin.ApplicationCommand):
+    def run(self, path = None):
+        if path is None:
+            sublime.active_window().show_input_panel("Load XML export from", settings_get('download-folder') or "", self.take_path, None, None)
+        else:
+            self.take_path(path)
+
+    def take_path(self, path):
+        requests.submit(self.go, os.path.expanduser(path), key=('load_xml_file', path))
+
+    def go(self, path):
+        with open(path, encoding='utf-8') as f:
+            load_xml(f.read())
 
 class ExportXml(sublime_plugin.TextCommand):
     def go(self):
@@ -251,14 +1211,95 @@ class ExportXml(sublime_plugin.TextCommand):
             xml = current_instance().get_xml(file)
 
             sublime.run_command('open_cache_code', {
-                    'text': xml.content,
+                    'text_key': hand_off(xml.content),
                     'syntax_name': "Export",
                     'name': "{0} Export".format(file.name)
                 })
 
     def run(self, edit):
-        threading.Thread(target=self.go).start()
+        requests.submit(self.go, key=('export_xml', self.view.id()))
+
+class ExportPackageXml(sublime_plugin.ApplicationCommand):
+    """ Export every file starting with a prefix into one XML document on disk. """
+    def run(self, prefix = None, path = None):
+        self.path = path
+        if prefix is None:
+            sublime.active_window().show_input_panel("Export files starting with", "", self.take_prefix, None, None)
+        else:
+            self.take_prefix(prefix)
+
+    def take_prefix(self, prefix):
+        self.prefix = prefix
+        if self.path is None:
+            folder = os.path.expanduser(settings_get('download-folder') or '~')
+            default = os.path.join(folder, '{0}.xml'.format(prefix.rstrip('.') or current_namespace().name))
+            sublime.active_window().show_input_panel("Export to", default, self.take_path, None, None)
+        else:
+            self.take_path(self.path)
 
+    def take_path(self, path):
+        requests.submit(self.go, self.prefix, os.path.expanduser(path), key=('export_package_xml', path))
+
+    def go(self, prefix, path):
+        index = file_index()
+        if not len(index):
+            index = update_file_listing()
+        files = [file_stub(name, index.id(name)) for name in index.prefix(prefix)]
+        if not len(files):
+            sublime.status_message("No files start with {0}".format(prefix))
+            return
+        sublime.status_message("Exporting {0} files".format(len(files)))
+        results = current_instance().export_xml(current_namespace(), files, path, settings_get('download-concurrency', 8))
+        failed = [result for result in results if not result.success]
+        if len(failed):
+            sublime.run_command('show_cache_errors', { 'errors': ["{0}: {1}".format(result.file.name, error) for result in failed for error in result.errors] })
+        sublime.status_message("Exported {0} files to {1}".format(len(results) - len(failed), path))
+
+
+class ClearCache(sublime_plugin.ApplicationCommand):
+    def run(self):
+        metadata_store().clear()
+        with file_indexes_lock:
+            file_listings.clear()
+            file_indexes.clear()
+        for cache in content_caches.values():
+            cache.clear()
+        with instances_lock:
+            for instance in instances.values():
+                instance.query_cache.clear()
+        with symbol_indexes_lock:
+            symbol_indexes.clear()
+        sublime.status_message("Cleared cached server metadata")
+
+stats_panels = {}
+
+class ShowCacheStats(sublime_plugin.ApplicationCommand):
+    """ Show request statistics in an output panel, refreshed every second while it stays open. """
+    def run(self, reset = False):
+        if reset:
+            cdev.stats.reset()
+        window = sublime.active_window()
+        panel = window.create_output_panel('InterSystems Stats')
+        window.run_command('show_panel', { 'panel': 'output.InterSystems Stats' })
+        # One refresh loop per window: running the command again only redraws
+        refreshing = window.id() in stats_panels
+        stats_panels[window.id()] = panel
+        self.write(panel)
+        if not refreshing:
+            sublime.set_timeout(lambda: self.refresh(window), 1000)
+
+    def write(self, panel):
+        panel.run_command('write_cache_output', {
+                'text': cdev.render_resultset(cdev.stats.table()),
+                'name': 'InterSystems Stats'
+            })
+
+    def refresh(self, window):
+        if window.active_panel() != 'output.InterSystems Stats':
+            stats_panels.pop(window.id(), None)
+            return
+        self.write(stats_panels[window.id()])
+        sublime.set_timeout(lambda: self.refresh(window), 1000)
 
 class ShowCacheErrors(sublime_plugin.ApplicationCommand):
     def run(self, errors):
@@ -272,32 +1313,37 @@ class WriteCacheError(sublime_plugin.TextCommand):
         self.view.insert(edit, 0, errortext)
 
 class OpenCacheCode(sublime_plugin.ApplicationCommand):
-    def run(self, text, syntax_name, name, file = None):
-        window = sublime.active_window()
-        view = window.new_file()
-        view.run_command('write_cache_output',
-            {
-                'text': text,
-                'syntax_file': 'Packages/InterSystems Cache/CacheColors/{0}.tmLanguage'.format(syntax_name),
-                'name': name,
-                'file': file
-            })
+    def run(self, syntax_name, name, text = None, file = None, version = None, text_key = None, line = None):
+        view = open_text(sublime.active_window(), take_text(text, text_key), name,
+                         'Packages/InterSystems Cache/CacheColors/{0}.tmLanguage'.format(syntax_name))
+        if file: view.settings().set('file', file)
+        if version: view.settings().set('cache-version', version)
+        view.settings().set('cache-change-count', view.change_count())
+        if line: show_line(view, line)
+
+class AppendCacheOutput(sublime_plugin.TextCommand):
+    def run(self, edit, text = None, replace_last_line = False, text_key = None):
+        text = take_text(text, text_key)
+        if replace_last_line:
+            last_line = self.view.line(self.view.size())
+            self.view.erase(edit, sublime.Region(last_line.begin(), self.view.size()))
+        elif self.view.size() and self.view.substr(self.view.size() - 1) != '\n':
+            self.view.insert(edit, self.view.size(), '\n')
+        insert_text(self.view, edit, self.view.size(), text)
 
 class OpenCacheOutput(sublime_plugin.ApplicationCommand):
-    def run(self, text, name):
-        window = sublime.active_window()
-        view = window.new_file()
-        view.run_command('write_cache_output', {
-                'text': text,
-                'name': name
-            })
+    def run(self, name, text = None, text_key = None, pages_key = None):
+        view = open_text(sublime.active_window(), take_text(text, text_key), name)
+        if pages_key is not None:
+            # The remaining pages of a query, for More Query Results in this view
+            query_pages[view.id()] = take_text(None, pages_key)
 
 class WriteCacheOutput(sublime_plugin.TextCommand):
-    def run(self, edit, text, name, file = None, syntax_file = None):
+    def run(self, edit, name, text = None, file = None, syntax_file = None, version = None, text_key = None):
         self.view.erase(edit, sublime.Region(0, self.view.size()))
-        unix_text = text.replace('\r\n','\n')
-        self.view.insert(edit, 0, unix_text)
+        insert_text(self.view, edit, 0, take_text(text, text_key))
         self.view.set_name(name)
         self.view.set_scratch(True)
         if syntax_file: self.view.set_syntax_file(syntax_file)
         if file: self.view.settings().set('file', file)
+        if version: self.view.settings().set('cache-version', version)
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+
+import argparse
+import collections
+import json
+import time
+import tracemalloc
+
+import cdev
+import mockserver
+
+def make_resultset(cells, columns=10):
+    rows = cells // columns
+    return collections.OrderedDict(
+        ('Column{0}'.format(c), ['value {0}-{1}'.format(r, c) for r in range(rows)])
+        for c in range(columns))
+
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    function(*args, **kwargs)
+    return time.perf_counter() - start
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+def report(name, samples, items=1):
+    """ Print throughput and p50/p99 latency of samples (seconds per call, items per call). """
+    total = sum(samples)
+    print("{0:<28} {1:6} calls {2:10.1f} items/s  p50 {3:8.2f} ms  p99 {4:8.2f} ms".format(
+        name, len(samples), len(samples) * items / total if total else 0,
+        percentile(samples, 0.5) * 1000, percentile(samples, 0.99) * 1000))
+
+def bench_render(sizes=(1000, 100000, 1000000)):
+    """ Time render_resultset for result sets of the given cell counts. """
+    for cells in sizes:
+        resultset = make_resultset(cells)
+        for format in ('table', 'csv', 'tsv'):
+            seconds = timed(cdev.render_resultset, resultset, format, max_width=60)
+            print("render {0:>8} cells {1:<5} {2:8.3f} s {3:12.0f} cells/s".format(cells, format, seconds, cells / seconds))
+
+def bench_memory(files=30000):
+    """ Compare a file listing held as decoded JSON dicts, File objects and a FileList, each built from
+        the same JSON response: the memory held afterwards, and the peak including the decode. """
+    names = mockserver.generated_names(files)
+    prefix = '/csp/sys/dev/namespaces/SAMPLES/'
+    response = json.dumps([{ 'id': prefix + 'files/' + name, 'name': name, 'xml': prefix + 'xml/' + name,
+                             'generatedfiles': prefix + 'generatedfiles/' + name, 'url': '/csp/samples/' + name } for name in names]).encode()
+    for (name, build) in [('decoded JSON dicts', lambda: json.loads(response.decode())),
+                          ('[ File ]', lambda: [cdev.File(file) for file in json.loads(response.decode())]),
+                          ('FileList', lambda: cdev.FileList.from_json(json.loads(response.decode())))]:
+        tracemalloc.start()
+        result = build()
+        held, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del result
+        print("memory {0:>8} files {1:<20} held {2:8.2f} MB  peak {3:8.2f} MB".format(files, name, held / 1024 / 1024, peak / 1024 / 1024))
+
+def bench_server(files=30000, file_size=5000, rows=100000, latency=0.0, repeat=20):
+    """ Time the cdev client against a local MockServer of the given scale. """
+    server = mockserver.MockServer(files=files, file_size=file_size, rows=rows, latency=latency).start()
+    try:
+        instance = cdev.CacheInstance(server.host, server.port, '_SYSTEM', 'SYS')
+        samples = collections.OrderedDict()
+        def sample(name, function, *args):
+            start = time.perf_counter()
+            result = function(*args)
+            samples.setdefault(name, []).append(time.perf_counter() - start)
+            return result
+
+        namespace = [namespace for namespace in sample('get_namespaces', instance.get_namespaces) if namespace.name == 'SAMPLES'][0]
+        for i in range(repeat):
+            listing = sample('get_files', instance.get_files, namespace)
+        validators = None
+        for i in range(repeat):
+            listing, validators, changed = sample('revalidate_files', instance.revalidate_files, namespace, listing, validators)
+        for i in range(repeat):
+            sample('quick panel names', lambda: [file.name for file in listing])
+
+        stubs = listing[:repeat * 5]
+        for stub in stubs:
+            sample('get_file', instance.get_file, stub)
+        sample('get_files_content', lambda: list(instance.get_files_content(stubs)))
+
+        person = instance.get_file([file for file in listing if file.name == 'Sample.Person.cls'][0])
+        for i in range(repeat):
+            name = 'Bench.Person{0}.cls'.format(i)
+            content = person.content.replace('Sample.Person', name[:-4])
+            result = sample('add_file', instance.add_file, namespace, name, content)
+            sample('compile_file', instance.compile_file, result.file, 'ck')
+
+        query = instance.add_query(namespace, 'SELECT Name, SSN FROM Sample.Person').query
+        for i in range(max(1, repeat // 5)):
+            result = sample('execute_query', instance.execute_query, query)
+            sample('render_resultset', cdev.render_resultset, result.resultset)
+        for i in range(max(1, repeat // 5)):
+            sample('iter_query first page', lambda: next(instance.iter_query(query)))
+    finally:
+        server.stop()
+
+    print("{0} files of ~{1} bytes, {2} rows, {3:.0f} ms latency".format(files, file_size, rows, latency * 1000))
+    items = { 'get_files': len(listing), 'revalidate_files': len(listing), 'quick panel names': len(listing),
+              'get_files_content': len(stubs), 'execute_query': rows, 'render_resultset': rows * 2 }
+    for (name, times) in samples.items():
+        report(name, times, items.get(name, 1))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the cdev client against a local mock server")
+    parser.add_argument('--files', type=int, default=30000, help="files per namespace")
+    parser.add_argument('--file-size', type=int, default=5000, help="bytes per file")
+    parser.add_argument('--rows', type=int, default=100000, help="rows per query")
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds added to each request")
+    parser.add_argument('--repeat', type=int, default=20, help="calls per timed operation")
+    parser.add_argument('--render', type=int, nargs='*', help="only benchmark rendering of result sets of these cell counts")
+    parser.add_argument('--memory', action='store_true', help="only compare the memory used by file listings")
+    args = parser.parse_args()
+    if args.render is not None:
+        bench_render(args.render or (1000, 100000, 1000000))
+    elif args.memory:
+        bench_memory(args.files)
+    else:
+        bench_server(args.files, args.file_size, args.rows, args.latency, args.repeat)
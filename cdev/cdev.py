@@ -1,12 +1,23 @@
 #!/usr/bin/env python3
 
 import base64
+import collections
+import collections.abc
+import concurrent.futures
+import csv
+import gzip
+import hashlib
+import http.client
+import io
+import itertools
 import json
 import os
+import re
 import sys
-import urllib.error
-import urllib.request
+import threading
+import time
 import urllib.parse
+import zlib
 
 class CDevException(Exception):
     def __init__(self,code,desc):
@@ -15,11 +26,27 @@ class CDevException(Exception):
     def __str__(self):
         return "CDev Exception #{0}: {1}".format(self.code,self.desc)
 
-class Root:
+class Model:
+    """ Base of the server objects. Attributes live in __slots__; optional ones are simply left unset. """
+    __slots__ = ()
+
+    def to_dict(self):
+        """ returns: dict # the JSON object this was built from, for requests and caches """
+        result = {}
+        for cls in reversed(type(self).__mro__):
+            for slot in cls.__dict__.get('__slots__', ()):
+                if hasattr(self, slot):
+                    value = getattr(self, slot)
+                    result[slot] = value.to_dict() if isinstance(value, Model) else value
+        return result
+
+class Root(Model):
+    __slots__ = ('namespaces',)
     def __init__(self, obj):
         self.namespaces = obj['namespaces']
 
-class Namespace:
+class Namespace(Model):
+    __slots__ = ('id', 'name', 'files', 'xml', 'queries')
     def __init__(self, obj):
         self.id = obj['id']
         self.name = obj['name']
@@ -27,69 +54,540 @@ class Namespace:
         self.xml = obj['xml']
         self.queries = obj['queries']
 
-class CodeEntity:
+class CodeEntity(Model):
+    __slots__ = ('id', 'content')
     def __init__(self, obj):
         self.id = obj['id']
         if 'content' in obj: self.content = obj['content']
 
 class File(CodeEntity):
+    __slots__ = ('name', 'generatedfiles', 'url', 'xml', 'deleted')
     def __init__(self, obj):
         super().__init__(obj)
         self.name = obj['name']
         if 'generatedfiles' in obj: self.generatedfiles = obj['generatedfiles']
         if 'url' in obj: self.url = obj['url']
         if 'xml' in obj: self.xml = obj['xml']
+        if 'deleted' in obj: self.deleted = obj['deleted']
 
 class XML(CodeEntity):
+    __slots__ = ()
     def __init__(self, obj):
         super().__init__(obj)
 
 class Query(CodeEntity):
+    __slots__ = ('plan', 'cached')
     def __init__(self, obj):
         super().__init__(obj)
         self.plan = obj['plan']
         self.cached = obj['cached']
 
-class Operation:
+class Operation(Model):
+    __slots__ = ('success', 'errors')
     def __init__(self, obj):
         self.success = obj['success']
         if 'errors' in obj: self.errors = obj['errors']
 
 class FileOperation(Operation):
+    __slots__ = ('file',)
     def __init__(self, obj):
         super().__init__(obj)
         if 'file' in obj: self.file = File(obj['file'])
 
 class XMLOperation(Operation):
+    __slots__ = ('xml', 'file')
     def __init__(self, obj):
         super().__init__(obj)
         if 'xml' in obj: self.xml = XML(obj['xml'])
         if 'file' in obj: self.file = File(obj['file'])
 
 class QueryOperation(Operation):
+    __slots__ = ('resultset', 'query', 'plan')
     def __init__(self, obj):
         super().__init__(obj)
         if 'resultset' in obj: self.resultset = obj['resultset']
         if 'query' in obj: self.query = Query(obj['query'])
+        if 'plan' in obj: self.plan = obj['plan']
+
+class FileList(collections.abc.Sequence):
+    """ A file listing stored column by column, one list per field in FIELDS.
+        File objects are only built for the entries that are actually used.
+        to_columns() / load() are the serialization used for caching listings. """
+    __slots__ = ('_columns',)
+    FIELDS = ('id', 'name', 'generatedfiles', 'url', 'xml', 'deleted')
+
+    def __init__(self, rows=()):
+        rows = list(rows)
+        self._columns = [list(column) for column in zip(*rows)] if rows else [[] for field in self.FIELDS]
+
+    @classmethod
+    def from_json(cls, files):
+        """ accepts: [ dict ] # a listing as returned by the server """
+        listing = cls()
+        listing._columns = [[file.get(field) for file in files] for field in cls.FIELDS]
+        return listing
+
+    @classmethod
+    def from_files(cls, files):
+        """ accepts: [ File ] """
+        listing = cls()
+        listing._columns = [[getattr(file, field, None) for file in files] for field in cls.FIELDS]
+        return listing
+
+    @classmethod
+    def load(cls, data):
+        """ accepts: dict from to_columns(), or a list of file dicts """
+        if not data:
+            return cls()
+        if isinstance(data, list):
+            return cls.from_json(data)
+        length = len(data['columns'][0]) if data['columns'] else 0
+        listing = cls()
+        listing._columns = [data['columns'][data['fields'].index(field)] if field in data['fields'] else [None] * length
+                            for field in cls.FIELDS]
+        return listing
+
+    def to_columns(self):
+        """ returns: { 'fields': [ str ], 'columns': [ list ] } """
+        return { 'fields': list(self.FIELDS), 'columns': self._columns }
+
+    def __len__(self):
+        return len(self._columns[0])
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            listing = FileList()
+            listing._columns = [column[index] for column in self._columns]
+            return listing
+        return File(dict((field, column[index]) for (field, column) in zip(self.FIELDS, self._columns) if column[index] is not None))
+
+    def names(self):
+        return list(self._columns[1])
+
+    def entries(self):
+        """ returns: [ (str, str) ] # (name, id) of every file """
+        return list(zip(self._columns[1], self._columns[0]))
+
+    def merge(self, changes):
+        """ accepts: FileList # entries with a true 'deleted' field are removed
+            returns: FileList # changed files replace their old entries, new files are appended """
+        merged = collections.OrderedDict((row[1], row) for row in zip(*self._columns))
+        for row in zip(*changes._columns):
+            if row[5]:
+                merged.pop(row[1], None)
+            else:
+                merged[row[1]] = row
+        return FileList(merged.values())
+
+class Response:
+    def __init__(self, status, headers, body, timings=None):
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.size = len(body)
+        self.timings = timings or {}
+
+def stale_connection(error):
+    """ True for the errors a kept-alive connection the server has since closed fails with, before any
+        response arrives. A timeout is not one of them: the server may already be handling the request. """
+    if isinstance(error, (ConnectionResetError, BrokenPipeError)):
+        # http.client.RemoteDisconnected is a ConnectionResetError
+        return True
+    # Python 3.3 reports a connection closed before the status line as BadStatusLine("''")
+    return isinstance(error, http.client.BadStatusLine) and not error.line.strip("'")
+
+class ConnectionPool:
+    """ Keep-alive HTTP connections to a single host and port, shared between threads. """
+    def __init__(self, host, port, size=4, idle_timeout=30, timeout=None):
+        self.host = host
+        self.port = port
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self._idle = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(size)
+
+    def _connect(self):
+        return http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+    def _checkout(self):
+        """ returns: (HTTPConnection, bool) # bool is True for a reused connection """
+        now = time.time()
+        with self._lock:
+            while self._idle:
+                connection, last_used = self._idle.pop()
+                if now - last_used < self.idle_timeout:
+                    return connection, True
+                connection.close()
+        return self._connect(), False
+
+    def _checkin(self, connection):
+        with self._lock:
+            self._idle.append((connection, time.time()))
+
+    def request(self, method, url, body=None, headers={}, stream=None):
+        """ accepts:
+                stream: function(HTTPResponse) # returns a function(bytes) the body is passed to in chunks as it
+                        arrives, or None to read the body into the Response as usual
+            returns: Response # body is read completely, or is empty if it was streamed """
+        with self._slots:
+            connection, reused = self._checkout()
+            while True:
+                try:
+                    start = time.perf_counter()
+                    if connection.sock is None:
+                        connection.connect()
+                    connected = time.perf_counter()
+                    connection.request(method, url, body=body, headers=headers)
+                    response = connection.getresponse()
+                except (http.client.HTTPException, OSError) as e:
+                    connection.close()
+                    if not reused or not stale_connection(e):
+                        raise
+                    # The server closed the idle connection before answering; the request never
+                    # reached it, so it is safe to send again on a fresh connection
+                    connection, reused = self._connect(), False
+                    continue
+                break
+            answered = time.perf_counter()
+            streamed = 0
+            try:
+                write = stream(response) if stream else None
+                if write:
+                    data = b''
+                    for chunk in iter(lambda: response.read(64 * 1024), b''):
+                        streamed += len(chunk)
+                        write(chunk)
+                else:
+                    data = response.read()
+            except BaseException:
+                connection.close()
+                raise
+            received = time.perf_counter()
+            if response.will_close:
+                connection.close()
+            else:
+                self._checkin(connection)
+            timings = { 'connect': connected - start, 'server': answered - connected, 'transfer': received - answered }
+            result = Response(response.status, response.headers, data, timings)
+            result.size = streamed or len(data)
+            return result
+
+    def close(self):
+        with self._lock:
+            for connection, last_used in self._idle:
+                connection.close()
+            self._idle = []
+
+class RequestStats:
+    """ Counts, bytes and timings of requests, per endpoint.
+        Endpoints are URLs with namespace, file and query names replaced by '*'. """
+    FIELDS = ['count', 'errors', 'bytes_out', 'bytes_in', 'connect', 'server', 'transfer', 'decode']
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._endpoints = collections.OrderedDict()
+        self._trace = None
+
+    @staticmethod
+    def endpoint(method, url):
+        path = urllib.parse.urlparse(url).path
+        parts = path[len('/csp/sys/dev/'):].strip('/').split('/') if path.startswith('/csp/sys/dev/') else [path.strip('/')]
+        return '{0} /{1}'.format(method, '/'.join('*' if i % 2 else part for (i, part) in enumerate(parts)))
+
+    def record(self, method, url, status=None, bytes_out=0, bytes_in=0, timings={}, error=None):
+        endpoint = self.endpoint(method, url)
+        with self._lock:
+            entry = self._endpoints.setdefault(endpoint, dict((field, 0) for field in self.FIELDS))
+            entry['count'] += 1
+            entry['errors'] += 1 if error or (status or 0) >= 400 else 0
+            entry['bytes_out'] += bytes_out
+            entry['bytes_in'] += bytes_in
+            for (key, seconds) in timings.items():
+                entry[key] += seconds
+            if self._trace:
+                line = { 'time': time.time(), 'endpoint': endpoint, 'url': url, 'status': status,
+                         'bytes_out': bytes_out, 'bytes_in': bytes_in, 'error': error and str(error) }
+                line.update(timings)
+                self._trace.write(json.dumps(line) + '\n')
+                self._trace.flush()
+
+    def record_decode(self, method, url, seconds):
+        with self._lock:
+            entry = self._endpoints.get(self.endpoint(method, url))
+            if entry:
+                entry['decode'] += seconds
+
+    def snapshot(self):
+        """ returns: { endpoint: { count, errors, bytes_out, bytes_in, connect, server, transfer, decode } }
+            Times are total seconds. """
+        with self._lock:
+            return collections.OrderedDict((endpoint, dict(entry)) for (endpoint, entry) in self._endpoints.items())
+
+    def reset(self):
+        with self._lock:
+            self._endpoints.clear()
+
+    def trace(self, path):
+        """ Append every request to path as a JSON line. None stops tracing. """
+        with self._lock:
+            if self._trace:
+                self._trace.close()
+            self._trace = open(path, 'a', encoding='utf-8') if path else None
+
+    def table(self):
+        """ returns: dict # snapshot as a column -> [ value ] resultset with average times, for render_resultset """
+        snapshot = self.snapshot()
+        def average(entry, key):
+            return '{0:.1f}'.format(entry[key] * 1000 / entry['count'])
+        return collections.OrderedDict([
+            ('Endpoint', list(snapshot.keys())),
+            ('Count', [entry['count'] for entry in snapshot.values()]),
+            ('Errors', [entry['errors'] for entry in snapshot.values()]),
+            ('KB Out', ['{0:.1f}'.format(entry['bytes_out'] / 1024) for entry in snapshot.values()]),
+            ('KB In', ['{0:.1f}'.format(entry['bytes_in'] / 1024) for entry in snapshot.values()]),
+            ('Connect ms', [average(entry, 'connect') for entry in snapshot.values()]),
+            ('Server ms', [average(entry, 'server') for entry in snapshot.values()]),
+            ('Transfer ms', [average(entry, 'transfer') for entry in snapshot.values()]),
+            ('Decode ms', [average(entry, 'decode') for entry in snapshot.values()]),
+        ])
+
+stats = RequestStats()
+
+class QueryCache:
+    """ The server query created for each SQL text, and its plan once fetched, by namespace.
+        Texts differing only in whitespace outside string literals share an entry. """
+    def __init__(self, max_entries=200):
+        self.max_entries = max_entries
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(namespace, text):
+        return (namespace.id, normalize_sql(text))
+
+    def get(self, namespace, text):
+        """ returns: { 'query': Query, 'plan': str or None } or None """
+        key = self.key(namespace, text)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry:
+                self._entries.move_to_end(key)
+            return entry
+
+    def set(self, namespace, text, query, plan=None):
+        with self._lock:
+            self._entries[self.key(namespace, text)] = { 'query': query, 'plan': plan }
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, namespace, text):
+        with self._lock:
+            self._entries.pop(self.key(namespace, text), None)
+
+    def clear(self, namespace=None):
+        """ Forget the queries of namespace, or of every namespace. """
+        with self._lock:
+            for key in list(self._entries):
+                if namespace is None or key[0] == namespace.id:
+                    del self._entries[key]
+
+    def __len__(self):
+        return len(self._entries)
+
+pools = {}
+pools_lock = threading.Lock()
+
+def get_pool(host, port, size=4, idle_timeout=30, timeout=None):
+    """ returns: ConnectionPool # shared by every CacheInstance talking to host:port with the same pool settings """
+    key = (host, str(port), size, idle_timeout, timeout)
+    with pools_lock:
+        if key not in pools:
+            pools[key] = ConnectionPool(host, port, size, idle_timeout, timeout)
+        return pools[key]
+
+def stream_to(sink):
+    """ returns: function(HTTPResponse) # for ConnectionPool.request; streams successful bodies to sink, gunzipping them if needed """
+    def stream(response):
+        if response.status >= 300:
+            return None
+        if response.getheader('Content-Encoding') == 'gzip':
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            return lambda chunk: sink(decompressor.decompress(chunk))
+        return sink
+    return stream
+
+EXPORT_HEAD = '<?xml version="1.0" encoding="UTF-8"?>\r\n<Export generator="Cache">\r\n'
+EXPORT_TAIL = '</Export>\r\n'
+EXPORT_ITEM = re.compile(r'<(Class|Routine|Project|CSP|CSPBase|Document)\b[^>]*>.*?</\1>\s*', re.DOTALL)
+
+def split_export(content):
+    """ returns: (str, [ str ], str) # (everything up to the <Export> tag, the XML of each exported item, the rest) """
+    start = re.search(r'<Export\b[^>]*>\s*', content)
+    if not start:
+        return EXPORT_HEAD, [], EXPORT_TAIL
+    items = list(EXPORT_ITEM.finditer(content, start.end()))
+    end = items[-1].end() if items else start.end()
+    return content[:start.end()], [item.group(0) for item in items], content[end:]
+
+def response_validators(response):
+    """ returns: dict # the cache validators a response carries """
+    result = {}
+    for (header, key) in [('ETag', 'etag'), ('Last-Modified', 'last-modified'), ('X-Change-Token', 'token')]:
+        if response.headers.get(header):
+            result[key] = response.headers.get(header)
+    return result
+
+def http_error(action, response):
+    """ returns: str # e.g. 'Cannot Compile A.cls: HTTP 500 <response body>' """
+    return "{0}: HTTP {1} {2}".format(action, response.status, response.body.decode(errors='replace')).strip()
+
+def content_hash(content):
+    """ returns: str # hex digest identifying a version of a file's content """
+    return hashlib.sha1(content.encode()).hexdigest()
+
+def text_chunks(text, size=1024 * 1024):
+    """ returns: generator of str # consecutive slices of text of at most size characters """
+    for start in range(0, len(text), size):
+        yield text[start:start + size]
+
+def normalize_newlines(chunks):
+    """ accepts: iterable of str # e.g. text_chunks(content)
+        returns: generator of str # the same text with \\r\\n line endings turned into \\n, one chunk at a time
+        A \\r\\n split across two chunks is handled, so no copy of the whole text is ever made. """
+    pending = ''
+    for chunk in chunks:
+        chunk = pending + chunk
+        pending = ''
+        if chunk.endswith('\r'):
+            chunk, pending = chunk[:-1], '\r'
+        yield chunk.replace('\r\n', '\n')
+    if pending:
+        yield pending
+
+def normalize_sql(text):
+    """ returns: str # text with runs of whitespace outside string literals and quoted identifiers collapsed """
+    parts = re.split(r"('(?:[^']|'')*'|\"(?:[^\"]|\"\")*\")", text)
+    parts[::2] = [re.sub(r'\s+', ' ', part) for part in parts[::2]]
+    return ''.join(parts).strip()
+
+def resultset_length(resultset):
+    """ returns: int # number of rows in a column -> [ value ] resultset """
+    return max([len(column) for column in resultset.values()] or [0])
+
+def resultset_slice(resultset, start, stop):
+    """ returns: dict # rows start to stop of resultset """
+    return collections.OrderedDict((header, column[start:stop]) for (header, column) in resultset.items())
+
+def column_widths(resultset, max_width=None):
+    """ returns: [ int ] # display width of each column, capped at max_width """
+    widths = []
+    for (header, column) in resultset.items():
+        width = max([len(header)] + [len(cell_text(field)) for field in column])
+        widths.append(min(width, max_width) if max_width else width)
+    return widths
+
+def cell_text(field):
+    return '' if field is None else str(field)
+
+def render_resultset(resultset, format='table', max_width=None, widths=None, header=True):
+    """ accepts:
+            resultset: dict # column -> [ value ]
+            format:    str  # 'table', 'csv' or 'tsv'
+            max_width: int  # cells wider than this are truncated (table only)
+            widths:    [ int ] # column widths to reuse, e.g. from the first page of a query
+            header:    bool # include the header (and, for tables, the separator line)
+        returns: str """
+    headers = list(resultset.keys())
+    rows = itertools.zip_longest(*[[cell_text(field) for field in column] for column in resultset.values()], fillvalue='')
+
+    if format in ('csv', 'tsv'):
+        output = io.StringIO()
+        writer = csv.writer(output, delimiter=',' if format == 'csv' else '\t', lineterminator='\n')
+        if header:
+            writer.writerow(headers)
+        writer.writerows(rows)
+        return output.getvalue()
+
+    if widths is None:
+        widths = column_widths(resultset, max_width)
+
+    def line(cells):
+        return '| ' + ' | '.join(fit(cell, width) for (cell, width) in zip(cells, widths)) + ' |'
+
+    lines = []
+    if header:
+        lines.append(line(headers))
+        lines.append('|' + '|'.join('=' * (width + 2) for width in widths) + '|')
+    lines.extend(line(row) for row in rows)
+    lines.append('-' * (sum(widths) + 3 * len(widths) + 1))
+    return '\n'.join(lines)
+
+def fit(cell, width):
+    if len(cell) > width:
+        return cell[:width - 1] + '\u2026' if width else ''
+    return cell.ljust(width)
 
 class CacheInstance:
-    def __init__(self, host, web_server_port, username, password):
+    def __init__(self, host, web_server_port, username, password, pool_size=4, idle_timeout=30, timeout=None, accept_gzip=True,
+                 compress_requests=False, compress_threshold=4096):
         self.host = host
         self.port = web_server_port
         self.username = username
         self.password = password
+        self.accept_gzip = accept_gzip
+        self.compress_requests = compress_requests
+        self.compress_threshold = compress_threshold
+        self.pool = get_pool(host, web_server_port, pool_size, idle_timeout, timeout)
+
+        self.headers = {}
+        if self.username and self.password:
+            base64string = base64.b64encode('{0}:{1}'.format(self.username, self.password).encode()).decode()
+            self.headers["Authorization"] = 'Basic {0}'.format(base64string)
+        if self.accept_gzip:
+            self.headers["Accept-Encoding"] = 'gzip'
+
+        self._root = None
+        self.last_success = None
+        self.last_failure = None
+        self.content_cache = None
+        self.query_cache = QueryCache()
+        self.batch_compile = None
+        self.batch_xml = None
+        self.paging = None
+        self.stats = stats
+
+    @property
+    def namespaces(self):
+        """ URL of the namespace listing. The root is discovered on first use. """
+        if self._root is None:
+            self._root = self._get_root()
+        return self._root.namespaces
 
+    def _get_root(self):
         try: 
             rootUrl = '/csp/sys/dev/'
             data = self._request(rootUrl)
         except Exception as e:
             raise CDevException(44, "Cannot Connect to Server: {0}".format(e))
+        if data is None:
+            raise CDevException(44, "Cannot Connect to Server")
         try:
-            root = Root(data)
+            return Root(data)
         except Exception as e:
             raise CDevException(54, "Invalid Server Response: {0}".format(e))
 
-        self.namespaces = root.namespaces
+    def refresh(self):
+        """ Forget the discovered root so that it is requested again on next use. """
+        self._root = None
+
+    @property
+    def healthy(self):
+        """ False once the most recent request to this server failed to connect or got a server error. """
+        if self.last_failure is None:
+            return True
+        return self.last_success is not None and self.last_success > self.last_failure
 
     @property
     def url_prefix(self):
@@ -120,31 +618,143 @@ class CacheInstance:
     #             return self._request(namespace['id'])
 
     def get_files(self,namespace):
-        """ returns: [ File ] 'content' key not included """
+        """ returns: FileList # [ File ] 'content' key not included """
         files = self._request(namespace.files)
-        return [File(file) for file in files]
+        return FileList.from_json(files)
+
+    def revalidate_files(self, namespace, files=None, validators=None):
+        """ accepts:
+                namespace:  Namespace
+                files:      FileList or [ File ] # previously downloaded listing, or None
+                validators: dict     # returned alongside files by the previous call
+            returns: (FileList, dict, bool) # (listing, validators, changed)
+            Unchanged listings cost a 304. If the server handed out a change token,
+            only the entries changed since then are transferred and merged into files. """
+        if not files:
+            files, validators = FileList(), {}
+        if not isinstance(files, FileList):
+            files = FileList.from_files(files)
+
+        changes, validators, delta = self.get_file_changes(namespace, validators)
+        if changes is None:
+            return files, validators, False
+        return (files.merge(changes) if delta else changes), validators, True
+
+    def get_file_changes(self, namespace, validators=None):
+        """ accepts:
+                namespace:  Namespace
+                validators: dict # returned by the previous call, or None for a full listing
+            returns: (FileList, dict, bool) # (changes, validators, delta)
+            changes is None if nothing changed. With delta true it holds only the entries
+            changed since the previous call, deleted ones flagged 'deleted'; otherwise the full listing. """
+        validators = validators or {}
+        url = namespace.files
+        headers = {}
+        if 'etag' in validators:
+            headers['If-None-Match'] = validators['etag']
+        if 'last-modified' in validators:
+            headers['If-Modified-Since'] = validators['last-modified']
+        if 'token' in validators:
+            url += ('&' if '?' in url else '?') + urllib.parse.urlencode({ 'since': validators['token'] })
+
+        response = self._send(url, headers=headers)
+        if response.status == 304:
+            return None, validators, False
+        if response.status >= 400:
+            print("Error Response: {0}".format(response.body))
+            return None, validators, False
+
+        changes = FileList.from_json(self._decode(response))
+        return changes, response_validators(response), response.headers.get('X-Delta') == 'true'
 
     def get_file(self, file):
         """ accepts: File 'content' key not required
-            returns: File """
-        result = self._request(file.id)
+            returns: File
+            With a content_cache, a cached copy is revalidated with a conditional request
+            and served without transferring the content again if it is unchanged. """
+        if not self.content_cache:
+            result = self._request(file.id)
+            return File(result)
+
+        cached = self.content_cache.get(file.id)
+        headers = {}
+        if cached and 'etag' in cached['version']:
+            headers['If-None-Match'] = cached['version']['etag']
+        if cached and 'last-modified' in cached['version']:
+            headers['If-Modified-Since'] = cached['version']['last-modified']
+
+        response = self._send(file.id, headers=headers)
+        if response.status == 304:
+            return File(cached['file'])
+        if response.status >= 400:
+            raise CDevException(response.status, "Cannot Download File: {0}".format(response.body))
+
+        result = self._decode(response)
+        version = response_validators(response)
+        version['hash'] = content_hash(result.get('content') or '')
+        self.content_cache.set(file.id, result, version)
         return File(result)
 
+    def get_file_cached(self, file, on_change=None):
+        """ accepts:
+                file:      File 'content' key not required
+                on_change: function(File) # called from a background thread if the server copy differs
+            returns: File # the cached copy if there is one, revalidated in the background """
+        cached = self.content_cache.get(file.id) if self.content_cache else None
+        if not cached:
+            return self.get_file(file)
+
+        def refresh():
+            try:
+                fresh = self.get_file(file)
+            except Exception as e:
+                print("Cannot Refresh {0}: {1}".format(file.id, e))
+                return
+            if on_change and content_hash(fresh.content) != cached['version'].get('hash'):
+                on_change(fresh)
+
+        threading.Thread(target=refresh, daemon=True).start()
+        return File(cached['file'])
+
+    def get_files_content(self, files, max_workers=8):
+        """ accepts: [ File ] 'content' key not required
+            returns: generator of (File, File or Exception) # (stub, downloaded file), in completion order """
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+        futures = dict((executor.submit(self.get_file, file), file) for file in files)
+        try:
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    yield futures[future], future.result()
+                except Exception as e:
+                    yield futures[future], e
+        finally:
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=False)
 
     def put_file(self, file):
         """ accepts: File """
-        result = self._request(file.id, method="PUT", data=file)
-        return FileOperation(result)
+        response = self._send(file.id, "PUT", file)
+        if self.content_cache:
+            self.content_cache.delete(file.id)
+        if response.status >= 400:
+            return FileOperation({ 'success': False, 'file': file.to_dict(), 'errors': [http_error("Cannot Upload {0}".format(file.name), response)] })
+        return FileOperation(self._decode(response))
 
     def add_file(self, namespace, filename, filecontent):
         """ accepts:
                 namespace:   Namespace
                 filename:    str # file name with lowercase extension
                 filecontent: str # content (UDL or Routine). Line endings will be automatically converted to \r\n. Class name must match filename.
-            returns: File """
+            returns: FileOperation # unsuccessful ones carry a File with only a name if the server has none """
         data = { 'name': filename, 'content': filecontent }
-        result = self._request(namespace.files, "PUT", data)
-        return FileOperation(result)
+        response = self._send(namespace.files, "PUT", data)
+        if response.status >= 400:
+            return FileOperation({ 'success': False, 'file': { 'id': None, 'name': filename }, 'errors': [http_error("Cannot Upload {0}".format(filename), response)] })
+        operation = FileOperation(self._decode(response))
+        if self.content_cache and hasattr(operation, 'file'):
+            self.content_cache.delete(operation.file.id)
+        return operation
 
     def compile_file(self, file, spec=""):
         """ accepts:
@@ -152,8 +762,50 @@ class CacheInstance:
                 spec: %SYSTEM.OBJ flags and compilers. Defaults are defined by the server.
             returns: FileOperation """
         command = { 'action': 'compile', 'spec': spec }
-        result = self._request(file.id, method="POST", data=command)
-        return FileOperation(result)
+        response = self._send(file.id, "POST", command)
+        if response.status >= 400:
+            return FileOperation({ 'success': False, 'file': file.to_dict(), 'errors': [http_error("Cannot Compile {0}".format(file.name), response)] })
+        return FileOperation(self._decode(response))
+
+    def add_files(self, namespace, files, max_workers=8):
+        """ accepts:
+                namespace: Namespace
+                files:     [ (str, str) ] # (filename, filecontent) as for add_file
+            returns: [ FileOperation ] # in the order of files; a file that fails does not stop the others """
+        def add(file):
+            try:
+                return self.add_file(namespace, *file)
+            except Exception as e:
+                return FileOperation({ 'success': False, 'file': { 'id': None, 'name': file[0] }, 'errors': ["Cannot Upload {0}: {1}".format(file[0], e)] })
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(add, files))
+
+    def compile_files(self, namespace, files, spec="", max_workers=8):
+        """ accepts:
+                namespace: Namespace
+                files:     [ File ]
+                spec:      %SYSTEM.OBJ flags and compilers. Defaults are defined by the server.
+            returns: [ FileOperation ] # in the order of files; a file that fails does not stop the others
+            Compiles all files in one request when the server accepts a list of files on the
+            namespace, otherwise with one request per file, max_workers at a time. """
+        if self.batch_compile is not False:
+            command = { 'action': 'compile', 'spec': spec, 'files': [file.id for file in files] }
+            response = self._send(namespace.files, "POST", command)
+            if response.status < 400:
+                self.batch_compile = True
+                return [FileOperation(result) for result in self._decode(response)]
+            if response.status not in (400, 404, 405, 501):
+                return [FileOperation({ 'success': False, 'file': file.to_dict(), 'errors': [http_error("Cannot Compile {0}".format(file.name), response)] })
+                        for file in files]
+            self.batch_compile = False
+
+        def compile(file):
+            try:
+                return self.compile_file(file, spec)
+            except Exception as e:
+                return FileOperation({ 'success': False, 'file': file.to_dict(), 'errors': ["Cannot Compile {0}: {1}".format(file.name, e)] })
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(compile, files))
 
     def get_generated_files(self,file):
         """ accepts: File
@@ -165,8 +817,10 @@ class CacheInstance:
             return []
 
     def get_xml(self, file):
-        xml = self._request(file.xml)
-        return XML(xml)
+        response = self._send(file.xml)
+        if response.status >= 400:
+            raise CDevException(response.status, http_error("Cannot Export {0}".format(file.name), response))
+        return XML(self._decode(response))
 
     def put_xml(self, xml):
         data = { 'content': xml.content }
@@ -178,45 +832,346 @@ class CacheInstance:
         result = self._request(namespace.xml, "PUT", data)
         return XMLOperation(result)
 
+    def export_xml(self, namespace, files, path, max_workers=8):
+        """ accepts:
+                namespace: Namespace
+                files:     [ File ] 'content' key not required
+                path:      str # file the export document is written to
+            returns: [ XMLOperation ] # one per file, in the order of files
+            When the server can export several files at once, the export is one request whose
+            response is streamed to disk. Otherwise the files are exported max_workers at a time
+            and written into one document as they arrive. """
+        partial = path + '.part'
+        if self.batch_xml is not False:
+            with open(partial, 'wb') as f:
+                response = self._send(namespace.xml, "POST", { 'action': 'export', 'files': [file.id for file in files] }, sink=f.write)
+            if response.status < 400:
+                self.batch_xml = True
+                os.replace(partial, path)
+                missing = set(json.loads(response.headers.get('X-Missing') or '[]'))
+                return [XMLOperation({ 'success': file.id not in missing, 'file': file.to_dict(),
+                                       'errors': ["{0} does not exist".format(file.name)] if file.id in missing else [] })
+                        for file in files]
+            os.remove(partial)
+            if response.status not in (400, 404, 405, 501):
+                return [XMLOperation({ 'success': False, 'file': file.to_dict(), 'errors': [http_error("Cannot Export {0}".format(file.name), response)] })
+                        for file in files]
+            self.batch_xml = False
+
+        def export(file):
+            try:
+                return self.get_xml(file)
+            except Exception as e:
+                return e
+        results = []
+        head = None
+        with open(partial, 'wb') as f, concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for (file, xml) in zip(files, executor.map(export, files)):
+                if isinstance(xml, Exception):
+                    results.append(XMLOperation({ 'success': False, 'file': file.to_dict(), 'errors': [str(xml)] }))
+                    continue
+                file_head, items, tail = split_export(xml.content)
+                if head is None:
+                    head = file_head
+                    f.write(head.encode())
+                for item in items:
+                    f.write(item.encode())
+                results.append(XMLOperation({ 'success': True, 'file': file.to_dict() }))
+            if head is None:
+                f.write(EXPORT_HEAD.encode())
+            f.write(EXPORT_TAIL.encode())
+        os.replace(partial, path)
+        return results
+
+    def import_xml(self, namespace, content, max_workers=8):
+        """ accepts:
+                namespace: Namespace
+                content:   str # an export document holding any number of files
+            returns: [ XMLOperation ] # one per file loaded
+            Servers that cannot import several files at once get one add_xml per file, max_workers at a time. """
+        if self.batch_xml is not False:
+            response = self._send(namespace.xml, "POST", { 'action': 'import', 'content': content })
+            if response.status < 400:
+                self.batch_xml = True
+                return [XMLOperation(result) for result in self._decode(response)]
+            if response.status not in (400, 404, 405, 501):
+                return [XMLOperation({ 'success': False, 'errors': [http_error("Cannot Import", response)] })]
+            self.batch_xml = False
+
+        head, items, tail = split_export(content)
+        if len(items) <= 1:
+            return [self.add_xml(namespace, content)]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(lambda item: self.add_xml(namespace, head + item + tail), items))
+
     def add_query(self, namespace, text):
         data = { 'content': text }
         result = self._request(namespace.queries, "PUT", data)
         return QueryOperation(result)
 
-    def execute_query(self, query):
+    def prepare_query(self, namespace, text):
+        """ accepts:
+                namespace: Namespace
+                text:      str # SQL
+            returns: QueryOperation # like add_query, but the query created for the same SQL before is reused """
+        entry = self.query_cache.get(namespace, text)
+        if entry:
+            operation = QueryOperation({ 'success': True })
+            operation.query = entry['query']
+            return operation
+        operation = self.add_query(namespace, text)
+        if operation.success:
+            self.query_cache.set(namespace, text, operation.query)
+        return operation
+
+    def run_query(self, namespace, text, page_size=1000):
+        """ accepts:
+                namespace: Namespace
+                text:      str # SQL
+                page_size: int
+            returns: generator of QueryOperation # as iter_query
+            Runs the query prepared for the same SQL before, recreating it if the server no longer has it. """
+        cached = self.query_cache.get(namespace, text) is not None
+        operation = self.prepare_query(namespace, text)
+        if not operation.success:
+            yield operation
+            return
+        pages = self.iter_query(operation.query, page_size)
+        first = next(pages)
+        if not first.success and cached:
+            self.query_cache.delete(namespace, text)
+            operation = self.prepare_query(namespace, text)
+            if not operation.success:
+                yield operation
+                return
+            pages = self.iter_query(operation.query, page_size)
+            first = next(pages)
+        yield first
+        for page in pages:
+            yield page
+
+    def execute_query(self, query, offset=None, limit=None):
+        """ accepts:
+                query:  Query
+                offset: int # first row to return
+                limit:  int # maximum number of rows to return. All rows when omitted.
+            returns: QueryOperation """
         data = { 'action': 'execute' }
-        result = self._request(query.id, "POST", data)
-        return QueryOperation(result)
+        if limit is not None:
+            data['offset'] = offset or 0
+            data['limit'] = limit
+        response = self._send(query.id, "POST", data)
+        if response.status >= 400:
+            return QueryOperation({ 'success': False, 'errors': ["Cannot Execute Query: {0}".format(response.body.decode(errors='replace'))] })
+        return QueryOperation(self._decode(response))
+
+    def iter_query(self, query, page_size=1000):
+        """ accepts:
+                query:     Query
+                page_size: int
+            returns: generator of QueryOperation # resultset holds at most page_size rows.
+            Stops after the first unsuccessful operation. Each page asks for one row more than
+            page_size, so whether more rows follow is known from the row count alone. A server
+            that ignores paging answers some request with more rows than its limit; from then on
+            its full responses are paged locally. """
+        offset = 0
+        while True:
+            # Until paging is confirmed, the second request asks for exactly page_size rows,
+            # so a server that sent its full result the first time is caught sending it again
+            limit = page_size if offset and self.paging is None else page_size + 1
+            result = self.execute_query(query, offset, limit)
+            if not result.success:
+                yield result
+                return
+            rows = resultset_length(result.resultset)
+            if rows > limit:
+                self.paging = False
+            elif offset and self.paging is None:
+                self.paging = True
+            if self.paging is False and (offset or rows > page_size):
+                for start in range(offset, rows, page_size):
+                    page = QueryOperation({ 'success': True })
+                    page.resultset = resultset_slice(result.resultset, start, start + page_size)
+                    yield page
+                return
+            if offset and rows == 0:
+                return
+            if rows > page_size:
+                result.resultset = resultset_slice(result.resultset, 0, page_size)
+            yield result
+            if rows < limit:
+                return
+            offset += page_size
 
     def get_query_plan(self, query):
-        result = self._request(query.plan)
-        return QueryOperation()
+        """ accepts: Query
+            returns: QueryOperation # with the plan text in 'plan' """
+        response = self._send(query.plan)
+        if response.status >= 400:
+            return QueryOperation({ 'success': False, 'errors': ["Cannot Get Query Plan: {0}".format(response.body.decode(errors='replace'))] })
+        return QueryOperation(self._decode(response))
+
+    def query_plan(self, namespace, text):
+        """ accepts:
+                namespace: Namespace
+                text:      str # SQL
+            returns: QueryOperation # the plan is fetched once per query and then served from query_cache """
+        entry = self.query_cache.get(namespace, text)
+        if entry and entry['plan'] is not None:
+            return QueryOperation({ 'success': True, 'plan': entry['plan'] })
+        operation = self.prepare_query(namespace, text)
+        if not operation.success:
+            return operation
+        result = self.get_query_plan(operation.query)
+        if result.success:
+            self.query_cache.set(namespace, text, operation.query, result.plan)
+        return result
 
     def _request(self, url, method="GET", data=None):
-        if data and hasattr(data,'__dict__'):
-            data = data.__dict__
+        response = self._send(url, method, data)
+        if response.status >= 400:
+            print("Error Response: {0}".format(response.body))
+            return None
+        return self._decode(response)
+
+    def _send(self, url, method="GET", data=None, headers={}, sink=None):
+        """ accepts:
+                sink: function(bytes) # receives the decompressed body of a successful response as it arrives
+            returns: Response # body is decompressed but not decoded, and empty if it went to sink """
+        if isinstance(data, Model):
+            data = data.to_dict()
         requestData = json.dumps(data).encode() if data else None
-        requestHeaders = {'Content-Type':'application/json'} if data else {}
-        requestUrl = self.url_prefix + url
+        requestHeaders = dict(self.headers)
+        requestHeaders.update(headers)
+        if data:
+            requestHeaders['Content-Type'] = 'application/json'
+
+        compressed = requestData is not None and len(requestData) >= self.compress_threshold and self.compress_requests is not False
+        if compressed:
+            requestHeaders['Content-Encoding'] = 'gzip'
+            requestData = gzip.compress(requestData)
 
-        if self.username and self.password:
-            base64string = base64.b64encode('{0}:{1}'.format(self.username, self.password).encode()).decode()
-            requestHeaders["Authorization"] = 'Basic {0}'.format(base64string)
-
-        request = urllib.request.Request(
-            url = requestUrl,
-            headers = requestHeaders,
-            data = requestData,
-            method = method
-        )
-        
         try:
-            response = urllib.request.urlopen(request)
-        except urllib.error.URLError as e:
-            print("Error Response: {0}".format(e.read()))
-            return None
-        result = response.read().decode()
-        return json.loads(result)
+            response = self.pool.request(method, url, requestData, requestHeaders, stream_to(sink) if sink else None)
+        except (http.client.HTTPException, OSError) as e:
+            self.last_failure = time.time()
+            self.stats.record(method, url, bytes_out=len(requestData or b''), error=e)
+            raise
+
+        if compressed and self.compress_requests is None:
+            # Servers that cannot read compressed bodies answer 400 or 415; stop compressing for them.
+            # Only a success shows the body was read, so anything else leaves the question open.
+            if response.status in (400, 415):
+                self.stats.record(method, url, response.status, len(requestData), len(response.body), response.timings)
+                self.compress_requests = False
+                return self._send(url, method, data, headers, sink)
+            if 200 <= response.status < 300:
+                self.compress_requests = True
+
+        response.method = method
+        response.url = url
+        bytes_in = response.size
+        start = time.perf_counter()
+        if response.body and response.headers.get('Content-Encoding') == 'gzip':
+            response.body = gzip.decompress(response.body)
+        response.timings['decode'] = time.perf_counter() - start
+        self.stats.record(method, url, response.status, len(requestData or b''), bytes_in, response.timings)
+
+        if response.status >= 500:
+            self.last_failure = time.time()
+        else:
+            self.last_success = time.time()
+        return response
+
+    def _decode(self, response):
+        """ returns: the JSON body of response """
+        start = time.perf_counter()
+        result = json.loads(response.body.decode())
+        self.stats.record_decode(response.method, response.url, time.perf_counter() - start)
+        return result
+
+class DeployResult:
+    """ The outcome of deploying to one server: errors by file and the seconds each step took. """
+    def __init__(self, server):
+        self.server = server
+        self.files = []
+        self.errors = []
+        self.timings = collections.OrderedDict()
+
+    @property
+    def success(self):
+        return not self.errors
+
+def deploy(targets, namespace, files=(), xml=None, spec="ck", max_workers=8):
+    """ Upload and compile the same files on several servers at once.
+        accepts:
+            targets:   [ (str, CacheInstance) ] # (server name, instance)
+            namespace: str # name of the namespace on every server
+            files:     [ (str, str) ] # (filename, filecontent) as for add_file
+            xml:       str # an XML export to load as well, or None
+            spec:      %SYSTEM.OBJ flags and compilers
+        returns: [ DeployResult ] # in the order of targets
+        Each server is deployed on its own thread over its own connection pool. """
+    def deploy_one(target):
+        server, instance = target
+        result = DeployResult(server)
+        start = time.perf_counter()
+        def step(name, function, *args):
+            step_start = time.perf_counter()
+            try:
+                return function(*args)
+            finally:
+                result.timings[name] = time.perf_counter() - step_start
+        try:
+            matches = [candidate for candidate in step('connect', instance.get_namespaces) if candidate.name == namespace]
+            if not matches:
+                result.errors.append("Namespace {0} does not exist".format(namespace))
+                return result
+            uploaded = []
+            if xml:
+                operation = step('load xml', instance.add_xml, matches[0], xml)
+                if operation.success:
+                    uploaded.append(operation.file)
+                else:
+                    result.errors.extend("XML: {0}".format(error) for error in getattr(operation, 'errors', []))
+            for ((name, content), operation) in zip(files, step('upload', instance.add_files, matches[0], files, max_workers)):
+                if operation.success:
+                    uploaded.append(operation.file)
+                else:
+                    result.errors.extend("{0}: {1}".format(name, error) for error in getattr(operation, 'errors', []))
+            if uploaded:
+                for (file, operation) in zip(uploaded, step('compile', instance.compile_files, matches[0], uploaded, spec, max_workers)):
+                    if operation.success:
+                        result.files.append(file.name)
+                    else:
+                        result.errors.extend("{0}: {1}".format(file.name, error) for error in getattr(operation, 'errors', []))
+        except Exception as e:
+            result.errors.append(str(e))
+        finally:
+            result.timings['total'] = time.perf_counter() - start
+        return result
+
+    targets = list(targets)
+    if not targets:
+        return []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(targets)) as executor:
+        return list(executor.map(deploy_one, targets))
+
+def deploy_report(results):
+    """ returns: str # a table of the outcome and timings of each server, followed by the errors """
+    steps = []
+    for result in results:
+        steps.extend(step for step in result.timings if step not in steps)
+    resultset = collections.OrderedDict([('Server', [result.server for result in results]),
+                                         ('Result', ['ok' if result.success else 'failed' for result in results]),
+                                         ('Compiled', [len(result.files) for result in results])])
+    for step in steps:
+        resultset['{0} ms'.format(step.capitalize())] = ['{0:.0f}'.format(result.timings[step] * 1000) if step in result.timings else ''
+                                                          for result in results]
+    lines = [render_resultset(resultset)]
+    for result in results:
+        lines.extend("{0}: {1}".format(result.server, error) for error in result.errors)
+    return '\n'.join(lines)
 
 # if __name__=="__main__":
 #     i = CacheInstance("172.16.196.221", "57772", "USER", "_SYSTEM", "SYS")
\ No newline at end of file
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+
+import heapq
+import re
+
+class FileIndex:
+    """ Search index over the file names of a namespace.
+        Names are kept in a trie of package segments ('Sample', 'Person.cls') for prefix
+        queries and in a lowercased list for fuzzy matching. """
+    def __init__(self, files=()):
+        self.names = []
+        self.ids = []
+        self._lower = []
+        self._positions = {}
+        self._free = []
+        self._trie = {}
+        self._last = None
+        for (name, id) in files:
+            self.add(name, id)
+
+    @classmethod
+    def from_files(cls, files):
+        """ accepts: FileList, [ File ] or [ dict ] # file listing """
+        return cls(file_entries(files))
+
+    def __len__(self):
+        return len(self._positions)
+
+    def add(self, name, id):
+        if name in self._positions:
+            self.ids[self._positions[name]] = id
+            return
+        if self._free:
+            position = self._free.pop()
+            self.names[position], self.ids[position], self._lower[position] = name, id, name.lower()
+        else:
+            position = len(self.names)
+            self.names.append(name)
+            self.ids.append(id)
+            self._lower.append(name.lower())
+        self._positions[name] = position
+        self._last = None
+        node = self._trie
+        for segment in segments(name):
+            node = node.setdefault(segment.lower(), {})
+        node.setdefault('', set()).add(position)
+
+    def remove(self, name):
+        position = self._positions.pop(name, None)
+        if position is None:
+            return
+        self.names[position] = self.ids[position] = self._lower[position] = None
+        self._free.append(position)
+        self._last = None
+        node = self._trie
+        for segment in segments(name):
+            node = node.get(segment.lower(), {})
+        node.get('', set()).discard(position)
+
+    def sync(self, files):
+        """ Bring the index up to date with a new listing, touching only changed names.
+            accepts: FileList, [ File ] or [ dict ] """
+        current = dict(file_entries(files))
+        for name in set(self._positions) - set(current):
+            self.remove(name)
+        for (name, id) in current.items():
+            if name not in self._positions or self.ids[self._positions[name]] != id:
+                self.add(name, id)
+
+    def entries(self):
+        """ returns: [ (str, str) ] # (name, id) of every file """
+        return [(name, self.ids[position]) for (name, position) in self._positions.items()]
+
+    def prefix(self, query, types=None):
+        """ accepts:
+                query: str # e.g. 'Sample.Per' matches every file under package Sample starting with Per
+                types: [ str ] # extensions to keep, e.g. ['.cls']
+            returns: [ str ] # sorted names """
+        parts = query.lower().split('.')
+        node = self._trie
+        last = parts[-1]
+        for (i, part) in enumerate(parts[:-1]):
+            if part not in node:
+                # The rest may be a class name with its extension, e.g. 'Person.c'
+                last = '.'.join(parts[i:])
+                break
+            node = node[part]
+        nodes = [child for (segment, child) in node.items() if segment and segment.startswith(last)]
+        positions = set()
+        while nodes:
+            node = nodes.pop()
+            positions.update(node.get('', ()))
+            nodes.extend(child for (segment, child) in node.items() if segment)
+        return sorted(name for name in (self.names[position] for position in positions) if has_type(name, types))
+
+    def search(self, query, types=None, limit=100):
+        """ accepts:
+                query: str # characters that appear in order in the name, e.g. 'spers' for Sample.Person.cls
+                types: [ str ] # extensions to keep, e.g. ['.cls', '.mac']
+                limit: int
+            returns: [ str ] # best matches first """
+        query = query.lower().replace(' ', '')
+        if not query:
+            return sorted(name for name in self._positions if has_type(name, types))[:limit]
+        # While a query is being typed each query extends the last one,
+        # so only the names that matched the last one need to be scanned.
+        candidates = range(len(self._lower))
+        if self._last and query.startswith(self._last[0]) and types == self._last[1]:
+            candidates = self._last[2]
+        pattern = re.compile('.*?'.join(re.escape(character) for character in query))
+        matches = []
+        found = []
+        for position in candidates:
+            lower = self._lower[position]
+            if lower is None or (types and not has_type(lower, types)):
+                continue
+            match = pattern.search(lower)
+            if match:
+                found.append(position)
+                matches.append((-score(lower, query, match), self.names[position]))
+        self._last = (query, types, found)
+        return [name for (rank, name) in heapq.nsmallest(limit, matches)]
+
+    def id(self, name):
+        position = self._positions.get(name)
+        return self.ids[position] if position is not None else None
+
+def segments(name):
+    """ 'Sample.Person.cls' -> ['Sample', 'Person.cls'] """
+    parts = name.split('.')
+    if len(parts) > 1:
+        parts[-2:] = ['.'.join(parts[-2:])]
+    return parts
+
+def has_type(name, types):
+    return not types or any(name.lower().endswith(type) for type in types)
+
+def score(lower, query, match):
+    """ Higher is better: exact substrings, matches at segment starts, compact matches and short names rank first. """
+    rank = 0
+    if query in lower:
+        rank += 100
+        start = lower.index(query)
+        if start == 0 or lower[start - 1] == '.':
+            rank += 50
+    rank -= (match.end() - match.start()) - len(query)
+    rank -= len(lower) / 100.0
+    return rank
+
+def file_entries(files):
+    """ returns: [ (str, str) ] # (name, id) of each file in a listing """
+    if hasattr(files, 'entries'):
+        return files.entries()
+    return [(file['name'], file['id']) if isinstance(file, dict) else (file.name, file.id) for file in files]
@@ -0,0 +1,389 @@
+#!/usr/bin/env python3
+
+import collections
+import gzip
+import http.server
+import json
+import re
+import socketserver
+import threading
+import time
+import urllib.parse
+
+ROOT = '/csp/sys/dev/'
+
+class Store:
+    """ Files, queries and change history of the namespaces a MockServer serves. """
+    def __init__(self, namespaces, files, file_size, rows):
+        self.file_size = file_size
+        self.lock = threading.Lock()
+        self.sequence = 0
+        self.namespaces = collections.OrderedDict()
+        self.changes = dict((namespace, []) for namespace in namespaces)
+        self.queries = dict((namespace, []) for namespace in namespaces)
+        self.rows = rows
+        for namespace in namespaces:
+            self.namespaces[namespace] = collections.OrderedDict()
+            for name in ['Sample.Person.cls', 'LDAP.mac'] + generated_names(files):
+                self.namespaces[namespace][name] = { 'content': None, 'version': 0, 'compiled': None }
+
+    def content(self, namespace, name):
+        """ Generated files get their content on first use, so large namespaces start quickly. """
+        entry = self.namespaces[namespace][name]
+        if entry['content'] is None:
+            entry['content'] = generate_content(name, self.file_size)
+        return entry['content']
+
+    def put(self, namespace, name, content):
+        with self.lock:
+            self.sequence += 1
+            files = self.namespaces[namespace]
+            entry = files.setdefault(name, { 'compiled': None })
+            entry['content'] = content
+            entry['version'] = self.sequence
+            self.changes[namespace].append((self.sequence, name))
+            return entry
+
+    def delete(self, namespace, name):
+        with self.lock:
+            self.sequence += 1
+            self.namespaces[namespace].pop(name, None)
+            self.changes[namespace].append((self.sequence, name))
+
+    def changed_since(self, namespace, sequence):
+        """ returns: [ str ] # names changed or deleted after sequence """
+        return list(collections.OrderedDict((name, True) for (seq, name) in self.changes[namespace] if seq > sequence))
+
+def generated_names(count):
+    names = []
+    for i in range(count):
+        if i % 10 == 9:
+            names.append('ROUTINE{0}.mac'.format(i))
+        else:
+            names.append('Package{0}.Sub{1}.Class{2}.cls'.format(i % 20, i % 7, i))
+    return names
+
+def generate_content(name, size):
+    if name.endswith('.cls'):
+        lines = ['Class {0} Extends %Persistent'.format(name[:-4]), '{', '']
+        template = 'Property Property{0} As %String;\r\n'
+    else:
+        lines = [name[:-4], '    ; generated routine']
+        template = 'Label{0}() quit {0}'
+    length = sum(len(line) + 2 for line in lines)
+    i = 0
+    while length < size:
+        lines.append(template.format(i))
+        length += len(lines[-1]) + 2
+        i += 1
+    if name.endswith('.cls'):
+        lines.append('}')
+    return '\r\n'.join(lines)
+
+def xml_content(name, content):
+    return xml_export([(name, content)])
+
+def xml_export(files):
+    """ accepts: [ (str, str) ] # (file name, content)
+        returns: str # one export document holding every file """
+    items = ['<{0} name="{1}">\r\n<![CDATA[{2}]]></{0}>\r\n'.format('Class' if name.endswith('.cls') else 'Routine', name[:-4], content)
+             for (name, content) in files]
+    return '<?xml version="1.0" encoding="UTF-8"?>\r\n<Export generator="Cache">\r\n{0}</Export>\r\n'.format(''.join(items))
+
+def xml_files(content):
+    """ returns: [ (str, str) ] # (file name, content) of every item in an export """
+    files = []
+    for match in re.finditer(r'<(Class|Routine) name="([^"]+)"[^>]*>\s*<!\[CDATA\[(.*?)\]\]>', content, re.DOTALL):
+        extension = '.cls' if match.group(1) == 'Class' else '.mac'
+        files.append((match.group(2) + extension, match.group(3)))
+    return files
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def store(self):
+        return self.server.store
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_PUT(self):
+        self.dispatch('PUT')
+
+    def do_POST(self):
+        self.dispatch('POST')
+
+    def dispatch(self, method):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        url = urllib.parse.urlparse(self.path)
+        self.params = dict(urllib.parse.parse_qsl(url.query))
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        if self.headers.get('Content-Encoding') == 'gzip':
+            if not self.server.gzip_requests:
+                return self.reply(self.server.gzip_error)
+            body = gzip.decompress(body)
+        self.data = json.loads(body.decode()) if body else None
+
+        if not url.path.startswith(ROOT):
+            return self.reply(404)
+        parts = [urllib.parse.unquote(part) for part in url.path[len(ROOT):].split('/')]
+        if parts[-1] == '':
+            parts = parts[:-1]
+
+        if not parts:
+            return self.reply(200, { 'namespaces': ROOT + 'namespaces/' })
+        if parts == ['namespaces']:
+            return self.reply(200, [self.namespace(name) for name in self.store.namespaces])
+        if len(parts) < 3 or parts[0] != 'namespaces' or parts[1] not in self.store.namespaces:
+            return self.reply(404)
+
+        namespace, collection, rest = parts[1], parts[2], parts[3:]
+        handler = getattr(self, '{0}_{1}'.format(method.lower(), collection), None)
+        if not handler:
+            return self.reply(405)
+        handler(namespace, '/'.join(rest))
+
+    def reply(self, status, obj=None, headers={}, content_type='application/json'):
+        """ obj is sent as JSON, or as is if it is bytes """
+        body = obj if isinstance(obj, bytes) else json.dumps(obj).encode() if obj is not None else b''
+        self.send_response(status)
+        for (header, value) in headers.items():
+            self.send_header(header, value)
+        if body and self.server.gzip and 'gzip' in (self.headers.get('Accept-Encoding') or ''):
+            body = gzip.compress(body)
+            self.send_header('Content-Encoding', 'gzip')
+        if body:
+            self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def namespace(self, name):
+        prefix = '{0}namespaces/{1}/'.format(ROOT, name)
+        return { 'id': prefix, 'name': name, 'files': prefix + 'files/', 'xml': prefix + 'xml/', 'queries': prefix + 'queries/' }
+
+    def file(self, namespace, name, content=False):
+        prefix = '{0}namespaces/{1}/'.format(ROOT, namespace)
+        obj = { 'id': prefix + 'files/' + name, 'name': name, 'xml': prefix + 'xml/' + name }
+        if name.endswith('.cls'):
+            obj['generatedfiles'] = prefix + 'generatedfiles/' + name
+            obj['url'] = '/csp/{0}/{1}.cls'.format(namespace.lower(), name[:-4])
+        if content:
+            obj['content'] = self.store.content(namespace, name)
+        return obj
+
+    def etag(self, *parts):
+        return '"{0}"'.format('-'.join(str(part) for part in parts))
+
+    # files
+
+    def get_files(self, namespace, name):
+        files = self.store.namespaces[namespace]
+        if not name:
+            etag = self.etag(namespace, self.store.sequence)
+            headers = { 'ETag': etag, 'X-Change-Token': str(self.store.sequence) }
+            if self.headers.get('If-None-Match') == etag:
+                return self.reply(304, headers=headers)
+            if self.server.deltas and 'since' in self.params:
+                names = self.store.changed_since(namespace, int(self.params['since']))
+                listing = [self.file(namespace, name) if name in files else { 'id': '', 'name': name, 'deleted': True } for name in names]
+                headers['X-Delta'] = 'true'
+                return self.reply(200, listing, headers)
+            return self.reply(200, [self.file(namespace, name) for name in list(files)], headers)
+
+        if name not in files:
+            return self.reply(404)
+        etag = self.etag(namespace, name, files[name]['version'])
+        if self.headers.get('If-None-Match') == etag:
+            return self.reply(304, headers={ 'ETag': etag })
+        self.reply(200, self.file(namespace, name, True), { 'ETag': etag })
+
+    def put_files(self, namespace, name):
+        name = name or self.data['name']
+        if name in self.server.failing:
+            return self.reply(500, { 'error': 'ERROR #5002: Cache error: <STORE>' })
+        self.store.put(namespace, name, self.data['content'])
+        self.reply(200, { 'success': True, 'file': self.file(namespace, name, True) })
+
+    def post_files(self, namespace, name):
+        if not name:
+            if not self.server.batch_compile:
+                return self.reply(405)
+            names = [file_id.rsplit('/', 1)[-1] for file_id in self.data['files']]
+            return self.reply(200, [self.compile(namespace, name) for name in names])
+        if name not in self.store.namespaces[namespace]:
+            return self.reply(404)
+        if name in self.server.failing:
+            return self.reply(500, { 'error': 'ERROR #5002: Cache error: <STORE>' })
+        self.reply(200, self.compile(namespace, name))
+
+    def compile(self, namespace, name):
+        entry = self.store.namespaces[namespace].get(name)
+        if entry is None:
+            return { 'success': False, 'errors': ['ERROR #5351: {0} does not exist'.format(name)] }
+        lines = self.store.content(namespace, name).split('\r\n')
+        errors = [number for (number, line) in enumerate(lines, 1) if 'ERROR' in line]
+        if errors:
+            line = errors[0]
+            return { 'success': False, 'errors': ['ERROR #5475: Error compiling {0} at line {1}'.format(name, line)] }
+        entry['compiled'] = entry['version']
+        return { 'success': True, 'file': self.file(namespace, name, True) }
+
+    def get_generatedfiles(self, namespace, name):
+        if name not in self.store.namespaces[namespace]:
+            return self.reply(404)
+        stubs = []
+        if name.endswith('.cls'):
+            int_name = name[:-4] + '.1.int'
+            if int_name not in self.store.namespaces[namespace]:
+                self.store.put(namespace, int_name, '{0}\r\n    ; generated from {1}'.format(int_name[:-4], name))
+            stubs.append(self.file(namespace, int_name))
+        self.reply(200, stubs)
+
+    # xml
+
+    def get_xml(self, namespace, name):
+        if name not in self.store.namespaces[namespace]:
+            return self.reply(404)
+        content = xml_content(name, self.store.content(namespace, name))
+        self.reply(200, { 'id': '{0}namespaces/{1}/xml/{2}'.format(ROOT, namespace, name), 'content': content })
+
+    def put_xml(self, namespace, name):
+        files = xml_files(self.data['content'])
+        if not files:
+            return self.reply(200, { 'success': False, 'errors': ['ERROR #6301: No items in export'] })
+        for (file_name, content) in files:
+            self.store.put(namespace, file_name, content)
+        file_name = files[0][0]
+        self.reply(200, {
+            'success': True,
+            'file': self.file(namespace, file_name),
+            'xml': { 'id': '{0}namespaces/{1}/xml/{2}'.format(ROOT, namespace, file_name) }
+        })
+
+    def post_xml(self, namespace, name):
+        if not self.server.batch_xml:
+            return self.reply(405)
+        files = self.store.namespaces[namespace]
+        if self.data.get('action') == 'import':
+            results = []
+            for (file_name, content) in xml_files(self.data['content']):
+                self.store.put(namespace, file_name, content)
+                results.append({ 'success': True, 'file': self.file(namespace, file_name),
+                                 'xml': { 'id': '{0}namespaces/{1}/xml/{2}'.format(ROOT, namespace, file_name) } })
+            return self.reply(200, results)
+        names = [file_id.rpartition('/')[2] for file_id in self.data['files']]
+        if self.server.failing.intersection(names):
+            return self.reply(500, { 'error': 'ERROR #5002: Cache error: <EXPORT>' })
+        missing = [file_id for (file_id, file_name) in zip(self.data['files'], names) if file_name not in files]
+        export = xml_export([(file_name, self.store.content(namespace, file_name)) for file_name in names if file_name in files])
+        self.reply(200, export.encode(), { 'X-Missing': json.dumps(missing) }, 'application/xml')
+
+    # queries
+
+    def query(self, namespace, number):
+        prefix = '{0}namespaces/{1}/queries/{2}'.format(ROOT, namespace, number)
+        return { 'id': prefix, 'content': self.store.queries[namespace][number], 'plan': prefix + '/plan', 'cached': False }
+
+    def put_queries(self, namespace, name):
+        with self.store.lock:
+            self.store.queries[namespace].append(self.data['content'])
+            number = len(self.store.queries[namespace]) - 1
+        self.reply(200, { 'success': True, 'query': self.query(namespace, number) })
+
+    def post_queries(self, namespace, name):
+        number = int(name)
+        if number >= len(self.store.queries[namespace]):
+            return self.reply(404)
+        rows = self.store.rows
+        start, stop = 0, rows
+        if self.server.paging and 'limit' in self.data:
+            start = min(self.data.get('offset', 0), rows)
+            stop = min(start + self.data['limit'], rows)
+        if self.store.queries[namespace][number].startswith('SELECT 1 '):
+            resultset = collections.OrderedDict([('Expression_1', ['1'] * (stop - start))])
+        else:
+            resultset = collections.OrderedDict([
+                ('Name', ['Person{0},Name'.format(i) for i in range(start, stop)]),
+                ('SSN', ['{0:03}-{1:02}-{2:04}'.format(i % 1000, i % 100, i % 10000) for i in range(start, stop)]),
+            ])
+        self.reply(200, { 'success': True, 'query': self.query(namespace, number), 'resultset': resultset })
+
+    def get_queries(self, namespace, name):
+        number, _, action = name.partition('/')
+        if int(number) >= len(self.store.queries[namespace]):
+            return self.reply(404)
+        if action != 'plan':
+            return self.reply(200, self.query(namespace, int(number)))
+        plan = 'Read master map Sample.Person.IDKEY, looping on ID.\r\nFor each row:\r\n    Output the row.'
+        self.reply(200, { 'success': True, 'plan': plan })
+
+class ThreadingServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+class MockServer:
+    """ A local stand-in for a Cache instance running cdev-server.
+        accepts:
+            namespaces:    [ str ]
+            files:         int   # generated files per namespace, besides Sample.Person.cls and LDAP.mac
+            file_size:     int   # approximate size of each generated file, in bytes
+            rows:          int   # rows returned by every query; 'SELECT 1 ...' returns the same row each time
+            latency:       float # seconds added to every request
+            batch_compile: bool  # accept a list of files in one compile request
+            batch_xml:     bool  # export and import several files in one request
+            paging:        bool  # honour offset/limit when executing queries
+            deltas:        bool  # answer ?since= listing requests with only the changes
+            gzip:          bool  # compress responses for clients that accept it
+            gzip_requests: bool  # accept compressed request bodies
+            gzip_error:    int   # status compressed request bodies get when they are not accepted
+            failing:       [ str ] # file names whose uploads, compiles and batch exports fail with HTTP 500 """
+    def __init__(self, namespaces=('SAMPLES', 'USER'), files=1000, file_size=2000, rows=1000, latency=0.0,
+                 batch_compile=True, batch_xml=True, paging=True, deltas=True, gzip=True, gzip_requests=True, gzip_error=415, failing=()):
+        self.server = ThreadingServer(('127.0.0.1', 0), Handler)
+        self.server.store = Store(namespaces, files, file_size, rows)
+        self.server.latency = latency
+        self.server.batch_compile = batch_compile
+        self.server.batch_xml = batch_xml
+        self.server.paging = paging
+        self.server.deltas = deltas
+        self.server.gzip = gzip
+        self.server.gzip_requests = gzip_requests
+        self.server.gzip_error = gzip_error
+        self.server.failing = set(failing)
+        self.thread = None
+
+    @property
+    def store(self):
+        return self.server.store
+
+    @property
+    def host(self):
+        return self.server.server_address[0]
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+if __name__ == '__main__':
+    server = MockServer().start()
+    print("Serving {0} on http://{1}:{2}{3}".format(', '.join(server.store.namespaces), server.host, server.port, ROOT))
+    try:
+        server.thread.join()
+    except KeyboardInterrupt:
+        server.stop()
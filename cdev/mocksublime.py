@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+
+""" Just enough of Sublime Text's sublime and sublime_plugin modules to load InterSystems.py
+    outside the editor and drive its commands from tests.
+    set_timeout only queues its callbacks; run_timeouts runs them, so tests control the clock. """
+
+import importlib
+import os
+import sys
+import threading
+import types
+
+PACKAGE = 'InterSystemsCache'
+
+class Region:
+    def __init__(self, a, b=None):
+        self.a = a
+        self.b = a if b is None else b
+
+    def begin(self):
+        return min(self.a, self.b)
+
+    def end(self):
+        return max(self.a, self.b)
+
+    def empty(self):
+        return self.a == self.b
+
+class Settings:
+    def __init__(self, values=None):
+        self.values = dict(values or {})
+        self.callbacks = {}
+
+    def get(self, name, default=None):
+        return self.values.get(name, default)
+
+    def set(self, name, value):
+        self.values[name] = value
+        for callback in list(self.callbacks.values()):
+            callback()
+
+    def add_on_change(self, key, callback):
+        self.callbacks[key] = callback
+
+    def clear_on_change(self, key):
+        self.callbacks.pop(key, None)
+
+class View:
+    """ A buffer whose run_command only records the command. edit() stands in for the user typing. """
+    def __init__(self, text='', window=None):
+        self.text = text
+        self._window = window
+        self._id = next_id()
+        self._settings = Settings()
+        self._change_count = 0
+        self.commands = []
+        self.status = {}
+
+    def id(self):
+        return self._id
+
+    def window(self):
+        return self._window
+
+    def settings(self):
+        return self._settings
+
+    def change_count(self):
+        return self._change_count
+
+    def edit(self, text):
+        self.text = text
+        self._change_count += 1
+
+    def size(self):
+        return len(self.text)
+
+    def substr(self, region):
+        return self.text[region.begin():region.end()]
+
+    def run_command(self, name, args=None):
+        self.commands.append((name, args or {}))
+
+    def set_status(self, key, text):
+        self.status[key] = text
+
+    def erase_status(self, key):
+        self.status.pop(key, None)
+
+class Window:
+    def __init__(self):
+        self._id = next_id()
+        self._views = []
+        self._active_panel = None
+        self.panels = []
+        self.output_panels = {}
+
+    def id(self):
+        return self._id
+
+    def views(self):
+        return list(self._views)
+
+    def active_view(self):
+        return self._views[-1] if self._views else None
+
+    def new_file(self):
+        view = View(window=self)
+        self._views.append(view)
+        return view
+
+    def show_quick_panel(self, items, on_select, *args):
+        self.panels.append(('quick_panel', items, on_select))
+
+    def show_input_panel(self, caption, initial, on_done, on_change=None, on_cancel=None):
+        self.panels.append(('input_panel', caption, on_done))
+
+    def create_output_panel(self, name):
+        self.output_panels[name] = View(window=self)
+        return self.output_panels[name]
+
+    def active_panel(self):
+        return self._active_panel
+
+    def run_command(self, name, args=None):
+        if name == 'show_panel':
+            self._active_panel = args['panel']
+        elif name == 'hide_panel':
+            self._active_panel = None
+        commands.append((name, args or {}))
+
+_ids = iter(range(1, sys.maxsize))
+_lock = threading.Lock()
+
+def next_id():
+    with _lock:
+        return next(_ids)
+
+settings = {}
+timeouts = []
+commands = []
+messages = []
+windows_list = [Window()]
+cache_folder = None
+
+def reset(cache_path):
+    """ Forget all settings, windows, commands and queued timeouts. """
+    global cache_folder
+    settings.clear()
+    with _lock:
+        del timeouts[:]
+    del commands[:]
+    del messages[:]
+    windows_list[:] = [Window()]
+    cache_folder = cache_path
+
+def load_settings(name):
+    return settings.setdefault(name, Settings())
+
+def save_settings(name):
+    pass
+
+def cache_path():
+    return cache_folder
+
+def set_timeout(callback, delay=0):
+    with _lock:
+        timeouts.append(callback)
+
+def run_timeouts():
+    """ Run the callbacks queued so far, in order. returns: int # callbacks run """
+    with _lock:
+        queued = list(timeouts)
+        del timeouts[:]
+    for callback in queued:
+        callback()
+    return len(queued)
+
+def status_message(text):
+    messages.append(text)
+
+def run_command(name, args=None):
+    commands.append((name, args or {}))
+
+def active_window():
+    return windows_list[0]
+
+def windows():
+    return list(windows_list)
+
+class ApplicationCommand:
+    pass
+
+class WindowCommand:
+    def __init__(self, window):
+        self.window = window
+
+class TextCommand:
+    def __init__(self, view):
+        self.view = view
+
+class EventListener:
+    pass
+
+def load_plugin():
+    """ Import InterSystems.py the way Sublime Text does, as a module of the package folder above this one,
+        with this module standing in for sublime and sublime_plugin.
+        returns: module """
+    module = sys.modules[__name__]
+    sys.modules['sublime'] = module
+    sys.modules['sublime_plugin'] = module
+    if PACKAGE not in sys.modules:
+        package = types.ModuleType(PACKAGE)
+        package.__path__ = [os.path.dirname(os.path.dirname(os.path.abspath(__file__)))]
+        sys.modules[PACKAGE] = package
+    return importlib.import_module(PACKAGE + '.InterSystems')
@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+
+import collections
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+def write_atomic(path, data):
+    """ accepts:
+            path: str
+            data: bytes
+        Readers see either the old or the new content, never a partial write. """
+    directory = os.path.dirname(path)
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+class MetadataStore:
+    """ JSON documents on disk, one file per key, evicted least recently used first.
+        The index (key -> file, size, last use) lives in memory, ordered from least to most
+        recently used and with a running total of its sizes, and is written at most every
+        flush_interval seconds, and by flush(). Small values stay in memory too, up to max_memory
+        bytes, so hot keys are not read and decoded on every get; callers must not modify them.
+        Files the index does not know about, left by a crash before a flush, are removed on open. """
+    def __init__(self, path, max_bytes=64 * 1024 * 1024, max_memory=4 * 1024 * 1024, flush_interval=5):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_memory = max_memory
+        self.flush_interval = flush_interval
+        self._lock = threading.RLock()
+        self._dirty = False
+        self._flushed = time.time()
+        self._memory = collections.OrderedDict()
+        self._memory_size = 0
+
+        os.makedirs(path, exist_ok=True)
+        self._index_path = os.path.join(path, 'index.json')
+        try:
+            with open(self._index_path, 'rb') as f:
+                index = json.loads(f.read().decode())
+            self._index = collections.OrderedDict(sorted(index.items(), key=lambda item: item[1]['used']))
+            self._size = sum(entry['size'] for entry in self._index.values())
+            known = set(entry['file'] for entry in self._index.values())
+        except (OSError, ValueError, TypeError, KeyError, AttributeError):
+            self._index = collections.OrderedDict()
+            self._size = 0
+            known = set()
+        for name in os.listdir(path):
+            if name != 'index.json' and name not in known:
+                self._remove({ 'file': name })
+
+    @staticmethod
+    def key(*parts):
+        """ returns: str # e.g. key(host, port, namespace, 'Files') """
+        return '/'.join(str(part) for part in parts)
+
+    def _file(self, key):
+        return hashlib.sha1(key.encode()).hexdigest() + '.json'
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._index.get(key)
+            if not entry:
+                return default
+            entry['used'] = time.time()
+            self._index.move_to_end(key)
+            self._dirty = True
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                return self._memory[key][0]
+            try:
+                with open(os.path.join(self.path, entry['file']), 'rb') as f:
+                    value = json.loads(f.read().decode())
+            except (OSError, ValueError):
+                del self._index[key]
+                self._size -= entry['size']
+                return default
+            self._remember(key, value, entry['size'])
+            return value
+
+    def set(self, key, value):
+        data = json.dumps(value, separators=(',', ':')).encode()
+        with self._lock:
+            entry = { 'file': self._file(key), 'size': len(data), 'used': time.time() }
+            write_atomic(os.path.join(self.path, entry['file']), data)
+            self._forget(key)
+            old = self._index.pop(key, None)
+            if old:
+                self._size -= old['size']
+            self._index[key] = entry
+            self._size += entry['size']
+            self._evict()
+            self._changed()
+
+    def delete(self, key):
+        with self._lock:
+            entry = self._index.pop(key, None)
+            self._forget(key)
+            if entry:
+                self._size -= entry['size']
+                self._remove(entry)
+                self._changed()
+
+    def clear(self):
+        with self._lock:
+            for entry in self._index.values():
+                self._remove(entry)
+            self._index = collections.OrderedDict()
+            self._size = 0
+            self._memory.clear()
+            self._memory_size = 0
+            self.flush(force=True)
+
+    def flush(self, force=False):
+        """ Persist the index if it changed since it was last written. """
+        with self._lock:
+            if force or self._dirty:
+                write_atomic(self._index_path, json.dumps(self._index, separators=(',', ':')).encode())
+                self._dirty = False
+            self._flushed = time.time()
+
+    def _changed(self):
+        self._dirty = True
+        if time.time() - self._flushed >= self.flush_interval:
+            self.flush()
+
+    @property
+    def size(self):
+        return self._size
+
+    def _evict(self):
+        while self._size > self.max_bytes and self._index:
+            key, entry = self._index.popitem(last=False)
+            self._forget(key)
+            self._remove(entry)
+            self._size -= entry['size']
+
+    def _remember(self, key, value, size):
+        """ Keep value in memory if it is small: at most an eighth of max_memory. """
+        if size > self.max_memory // 8:
+            return
+        self._memory[key] = (value, size)
+        self._memory_size += size
+        while self._memory_size > self.max_memory:
+            self._memory_size -= self._memory.popitem(last=False)[1][1]
+
+    def _forget(self, key):
+        if key in self._memory:
+            self._memory_size -= self._memory.pop(key)[1]
+
+    def _remove(self, entry):
+        try:
+            os.remove(os.path.join(self.path, entry['file']))
+        except OSError:
+            pass
+
+class ContentCache:
+    """ Downloaded file content keyed by file id, together with the version marker
+        (ETag, Last-Modified or content hash) the server returned it with.
+        Recently used entries stay in memory; everything is also kept on disk when a path is given. """
+    def __init__(self, max_memory=16 * 1024 * 1024, path=None, max_disk=256 * 1024 * 1024):
+        self.max_memory = max_memory
+        self._memory = collections.OrderedDict()
+        self._memory_size = 0
+        self._lock = threading.Lock()
+        self._disk = MetadataStore(path, max_disk, max_memory=0) if path else None
+
+    def get(self, id):
+        """ returns: { 'file': dict, 'version': dict } or None """
+        with self._lock:
+            if id in self._memory:
+                self._memory.move_to_end(id)
+                return self._memory[id][0]
+        entry = self._disk.get(id) if self._disk else None
+        if entry:
+            self._remember(id, entry)
+        return entry
+
+    def set(self, id, file, version):
+        """ accepts:
+                id:      str  # file URL
+                file:    dict # serialized File, including 'content'
+                version: dict # validators returned by the server """
+        entry = { 'file': file, 'version': version }
+        self._remember(id, entry)
+        if self._disk:
+            self._disk.set(id, entry)
+
+    def delete(self, id):
+        with self._lock:
+            if id in self._memory:
+                self._memory_size -= self._memory.pop(id)[1]
+        if self._disk:
+            self._disk.delete(id)
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            self._memory_size = 0
+        if self._disk:
+            self._disk.clear()
+
+    def flush(self):
+        if self._disk:
+            self._disk.flush()
+
+    def _remember(self, id, entry):
+        size = len(entry['file'].get('content') or '')
+        with self._lock:
+            if id in self._memory:
+                self._memory_size -= self._memory.pop(id)[1]
+            self._memory[id] = (entry, size)
+            self._memory_size += size
+            while self._memory_size > self.max_memory and len(self._memory) > 1:
+                self._memory_size -= self._memory.popitem(last=False)[1][1]
@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+
+import collections
+import hashlib
+import re
+import threading
+
+Symbol = collections.namedtuple('Symbol', ['kind', 'name', 'file', 'line', 'container'])
+
+MEMBER_KINDS = ['ClassMethod', 'Method', 'Property', 'Relationship', 'Query', 'Index', 'Parameter',
+                'XData', 'Trigger', 'ForeignKey', 'Projection', 'Storage']
+
+CLASS = re.compile(r'^Class\s+(%?[\w.]+)(?:\s+Extends\s+(\([^)]*\)|%?[\w.]+))?', re.IGNORECASE)
+MEMBER = re.compile(r'^({0})\s+("[^"]+"|%?\w+)'.format('|'.join(MEMBER_KINDS)), re.IGNORECASE)
+INCLUDE = re.compile(r'^(?:Include|IncludeGenerator)\s+(\([^)]*\)|%?[\w.]+)', re.IGNORECASE)
+ROUTINE_INCLUDE = re.compile(r'^\s*#include\s+(%?[\w.]+)', re.IGNORECASE)
+DEFINE = re.compile(r'^\s*#(?:define|def1arg)\s+(%?\w+)', re.IGNORECASE)
+ROUTINE_HEADER = re.compile(r'^ROUTINE\s+(%?[\w.]+)', re.IGNORECASE)
+LABEL = re.compile(r'^(%?[A-Za-z0-9]+)')
+TOKEN = re.compile(r'%?[A-Za-z][A-Za-z0-9]*(?:\.%?[A-Za-z][A-Za-z0-9]*)*')
+REFERENCE = re.compile(r'##class\((?P<class>%?[\w.]+)\)'
+                       r'|\$\$\$(?P<macro>%?\w+)'
+                       r'|(?:\$\$)?(?P<label>%?\w+)?\^(?P<routine>%?[\w.]+)'
+                       r'|(?P<self>\.\.)?(?P<name>%?[A-Za-z][\w.]*)', re.IGNORECASE)
+
+Scan = collections.namedtuple('Scan', ['symbols', 'extends', 'includes', 'tokens'])
+
+def name_list(text):
+    """ '(A, B)' or 'A' -> ['A', 'B'] or ['A'] """
+    return [name.strip() for name in text.strip('()').split(',') if name.strip()]
+
+def qualify(name, package):
+    """ Resolve a class name the way the class compiler does: '%String' -> '%Library.String',
+        'Person' in package Sample -> 'Sample.Person'. """
+    if '.' in name:
+        return name
+    if name.startswith('%'):
+        return '%Library.' + name[1:]
+    return '{0}.{1}'.format(package, name) if package else name
+
+def package_of(class_name):
+    return class_name.rpartition('.')[0]
+
+def reference_at(line, column):
+    """ The identifier under column in a line of source.
+        returns: (str, str, str) or None # (kind, name, routine); kind is 'class', 'macro', 'label', 'member' or 'name'
+        e.g. '##class(Sample.Person)' -> ('class', 'Sample.Person', None), 'do Work^LDAP' -> ('label', 'Work', 'LDAP'),
+             '..Save()' -> ('member', 'Save', None), 'e.Save()' -> ('name', 'e.Save', None) """
+    for match in REFERENCE.finditer(line):
+        if match.start() <= column <= match.end():
+            if match.group('class'):
+                return ('class', match.group('class'), None)
+            if match.group('macro'):
+                return ('macro', match.group('macro'), None)
+            if match.group('routine'):
+                return ('label', match.group('label'), match.group('routine'))
+            if match.group('self'):
+                return ('member', match.group('name'), None)
+            return ('name', match.group('name').rstrip('.'), None)
+    return None
+
+def scan(name, content):
+    """ Find the definitions, superclasses, include files and identifiers of a UDL class or a routine.
+        accepts:
+            name:    str # file name, e.g. 'Sample.Person.cls' or 'LDAP.mac'
+            content: str
+        returns: Scan """
+    symbols = []
+    extends = []
+    includes = []
+    tokens = collections.defaultdict(list)
+    is_class = name.lower().endswith('.cls')
+    container = name[:-4] if is_class else name.rpartition('.')[0]
+
+    for (number, line) in enumerate(content.splitlines(), 1):
+        names = set()
+        for token in TOKEN.findall(line):
+            names.add(token.lower())
+            if '.' in token:
+                names.add(token.rpartition('.')[2].lower())
+        for token in names:
+            tokens[token].append(number)
+        if not line or line[0] in ' \t;/#}{':
+            if not is_class:
+                match = ROUTINE_INCLUDE.match(line)
+                if match:
+                    includes.append(match.group(1))
+                match = DEFINE.match(line)
+                if match:
+                    symbols.append(Symbol('macro', match.group(1), name, number, container))
+            continue
+        if is_class:
+            match = MEMBER.match(line)
+            if match:
+                symbols.append(Symbol(match.group(1).lower(), match.group(2).strip('"'), name, number, container))
+                continue
+            match = CLASS.match(line)
+            if match:
+                container = match.group(1)
+                symbols.append(Symbol('class', container, name, number, None))
+                if match.group(2):
+                    extends.extend(qualify(superclass, package_of(container)) for superclass in name_list(match.group(2)))
+                continue
+            match = INCLUDE.match(line)
+            if match:
+                includes.extend(name_list(match.group(1)))
+        else:
+            match = ROUTINE_HEADER.match(line)
+            if match:
+                container = match.group(1)
+                continue
+            match = LABEL.match(line)
+            if match:
+                symbols.append(Symbol('label', match.group(1), name, number, container))
+
+    return Scan(symbols, extends, includes, dict(tokens))
+
+class SymbolIndex:
+    """ Definitions (classes, members and routine labels), superclasses, include files and
+        identifier occurrences of the sources of a namespace, updated one file at a time. """
+    def __init__(self):
+        self._files = {}
+        self._definitions = collections.defaultdict(set)
+        self._classes = {}
+        self._references = collections.defaultdict(dict)
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._files)
+
+    def __contains__(self, name):
+        return name in self._files
+
+    def update(self, name, content):
+        """ Index the current content of a file, replacing what was indexed for it before.
+            returns: bool # False if the content was already indexed """
+        content_hash = hashlib.sha1(content.encode()).hexdigest()
+        if name in self._files and self._files[name]['hash'] == content_hash:
+            return False
+        file_scan = scan(name, content)
+        with self._lock:
+            self._add(name, content_hash, file_scan)
+        return True
+
+    def remove(self, name):
+        with self._lock:
+            self._remove(name)
+
+    def _remove(self, name):
+        entry = self._files.pop(name, None)
+        if not entry:
+            return
+        for symbol in entry['scan'].symbols:
+            files = self._definitions.get(symbol.name.lower())
+            if files:
+                files.discard(name)
+                if not files:
+                    del self._definitions[symbol.name.lower()]
+            if symbol.kind == 'class' and self._classes.get(symbol.name.lower(), (None,))[0] == name:
+                del self._classes[symbol.name.lower()]
+        for token in entry['scan'].tokens:
+            occurrences = self._references.get(token)
+            if occurrences:
+                occurrences.pop(name, None)
+                if not occurrences:
+                    del self._references[token]
+
+    def _add(self, name, content_hash, file_scan):
+        self._remove(name)
+        self._files[name] = { 'hash': content_hash, 'scan': file_scan }
+        for symbol in file_scan.symbols:
+            self._definitions[symbol.name.lower()].add(name)
+            if symbol.kind == 'class':
+                self._classes[symbol.name.lower()] = (name, file_scan.extends)
+        for (token, lines) in file_scan.tokens.items():
+            self._references[token][name] = lines
+
+    def definitions(self, name, kinds=None):
+        """ accepts:
+                name:  str # class, member or label name
+                kinds: [ str ] # e.g. ['method', 'classmethod']
+            returns: [ Symbol ] """
+        result = []
+        with self._lock:
+            files = sorted(self._definitions.get(name.lower(), ()))
+            scans = [self._files[file]['scan'] for file in files]
+        for file_scan in scans:
+            result.extend(symbol for symbol in file_scan.symbols
+                          if symbol.name.lower() == name.lower() and (not kinds or symbol.kind in kinds))
+        return result
+
+    def superclasses(self, class_name):
+        """ returns: ([ str ], [ str ]) # (class_name and its indexed ancestors in inheritance order, ancestors not indexed) """
+        found = []
+        missing = []
+        pending = [class_name]
+        while pending:
+            current = pending.pop(0)
+            if current.lower() in (name.lower() for name in found + missing):
+                continue
+            entry = self._classes.get(current.lower())
+            if entry:
+                found.append(current)
+                pending.extend(entry[1])
+            else:
+                missing.append(current)
+        return found, missing
+
+    def members(self, class_name, member):
+        """ returns: [ Symbol ] # definitions of member in class_name or its indexed superclasses, nearest first """
+        classes = [name.lower() for name in self.superclasses(class_name)[0]]
+        symbols = [symbol for symbol in self.definitions(member) if symbol.kind != 'class' and symbol.container and symbol.container.lower() in classes]
+        return sorted(symbols, key=lambda symbol: classes.index(symbol.container.lower()))
+
+    def references(self, name):
+        """ returns: [ (str, int) ] # (file, line) of every occurrence of the identifier """
+        with self._lock:
+            occurrences = dict(self._references.get(name.lower(), {}))
+        return sorted((file, line) for (file, lines) in occurrences.items() for line in lines)
+
+    def includes(self, name):
+        """ returns: [ str ] # include files named by the file """
+        entry = self._files.get(name)
+        return list(entry['scan'].includes) if entry else []
+
+    def to_dict(self):
+        """ returns: dict # everything indexed, for load """
+        with self._lock:
+            files = list(self._files.items())
+        return dict((name, { 'hash': entry['hash'], 'symbols': [list(symbol) for symbol in entry['scan'].symbols],
+                             'extends': entry['scan'].extends, 'includes': entry['scan'].includes, 'tokens': entry['scan'].tokens })
+                    for (name, entry) in files)
+
+    @classmethod
+    def load(cls, data):
+        """ accepts: dict # from to_dict, or None """
+        index = cls()
+        for (name, entry) in (data or {}).items():
+            index._add(name, entry['hash'], Scan([Symbol(*symbol) for symbol in entry['symbols']],
+                                                 entry['extends'], entry['includes'], entry['tokens']))
+        return index
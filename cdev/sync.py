@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+
+import concurrent.futures
+import hashlib
+import json
+import os
+import threading
+
+try:
+    from . import store
+except (ImportError, SystemError):
+    import store
+
+STATE_FILE = '.cdev-sync.json'
+CONFLICT_SUFFIX = '.server'
+
+def local_hash(text):
+    """ Hash of content with server line endings, so a file hashes the same on both sides. """
+    return hashlib.sha1(text.replace('\r\n', '\n').replace('\n', '\r\n').encode('utf-8')).hexdigest()
+
+class SyncResult:
+    """ File names touched by one pass of a NamespaceMirror. """
+    def __init__(self):
+        self.pulled = []
+        self.pushed = []
+        self.deleted = []
+        self.conflicts = []
+        self.errors = []
+
+    def __bool__(self):
+        return bool(self.pulled or self.pushed or self.deleted or self.conflicts or self.errors)
+
+    def summary(self):
+        """ returns: str # e.g. 'pulled 3, pushed 1, 1 conflicts' """
+        parts = ["{0} {1}".format(name, len(names)) for (name, names) in
+                 [('pulled', self.pulled), ('pushed', self.pushed), ('deleted', self.deleted)] if names]
+        if self.conflicts:
+            parts.append("{0} conflicts".format(len(self.conflicts)))
+        if self.errors:
+            parts.append("{0} errors".format(len(self.errors)))
+        return ", ".join(parts) or "up to date"
+
+class NamespaceMirror:
+    """ Keeps the files of a namespace whose names start with prefix in a local folder.
+        State (the hash of each file as of the last sync and the listing validators) lives in
+        STATE_FILE inside the folder, so a mirror picks up where it left off after a restart.
+
+        Local edits are found by comparing modification times and then hashes; server edits by
+        revalidating the listing. A file edited on both sides since the last sync is a conflict:
+        the local copy is kept and the server copy is written next to it with CONFLICT_SUFFIX. """
+    def __init__(self, instance, namespace, path, prefix='', max_workers=8):
+        self.instance = instance
+        self.namespace = namespace
+        self.path = os.path.abspath(os.path.expanduser(path))
+        self.prefix = prefix
+        self.max_workers = max_workers
+        self._lock = threading.Lock()
+        os.makedirs(self.path, exist_ok=True)
+        self.state = self._load()
+
+    def _load(self):
+        try:
+            with open(os.path.join(self.path, STATE_FILE), 'rb') as f:
+                state = json.loads(f.read().decode())
+            if state.get('namespace') == self.namespace.id and state.get('prefix') == self.prefix:
+                return state
+        except (OSError, ValueError):
+            pass
+        return { 'namespace': self.namespace.id, 'prefix': self.prefix, 'validators': {}, 'files': {} }
+
+    def _save(self):
+        store.write_atomic(os.path.join(self.path, STATE_FILE), json.dumps(self.state, indent=1, sort_keys=True).encode())
+
+    def wants(self, name):
+        return name.startswith(self.prefix) and not name.startswith('.') and not name.endswith(CONFLICT_SUFFIX)
+
+    def in_conflict(self, name):
+        """ A file stays in conflict, and is not uploaded, until its server copy is deleted. """
+        return os.path.exists(self.local_path(name + CONFLICT_SUFFIX))
+
+    def local_path(self, name):
+        return os.path.join(self.path, name)
+
+    def contains(self, path):
+        """ returns: str or None # the file name if path is a mirrored file in this folder """
+        directory, name = os.path.split(os.path.abspath(path))
+        if directory == self.path and self.wants(name):
+            return name
+        return None
+
+    def pull(self):
+        """ Download every matching file, overwriting local copies.
+            returns: SyncResult """
+        with self._lock:
+            result = SyncResult()
+            changes, validators, delta = self.instance.get_file_changes(self.namespace)
+            if changes is None:
+                # Without a listing there is no telling which local files are gone from the server
+                result.errors.append("Cannot list the files of {0}".format(self.namespace.name))
+                return result
+            files = [file for file in changes if self.wants(file.name)]
+            self._download(files, result)
+            wanted = set(file.name for file in files)
+            for name in list(self.state['files']):
+                if name not in wanted:
+                    self._delete_local(name, result)
+            self.state['validators'] = validators
+            self._save()
+            return result
+
+    def sync(self, local=True, server=True):
+        """ accepts:
+                local:  bool # upload files changed on disk
+                server: bool # download files changed on the server
+            returns: SyncResult """
+        with self._lock:
+            result = SyncResult()
+            edited = self._local_changes() if local else {}
+            if server:
+                self._server_changes(edited, result)
+            self._upload(edited, result)
+            self._save()
+            return result
+
+    def push(self, name):
+        """ Upload one file now, e.g. right after it was saved. Skipped if it is unchanged.
+            returns: SyncResult """
+        with self._lock:
+            result = SyncResult()
+            edited = self._local_changes([name])
+            self._upload(edited, result)
+            self._save()
+            return result
+
+    def _local_changes(self, names=None):
+        """ returns: { str: str } # name -> content of files edited or created on disk since the last sync """
+        if names is None:
+            names = set(self.state['files'])
+            try:
+                names.update(name for name in os.listdir(self.path)
+                             if self.wants(name) and os.path.isfile(self.local_path(name)))
+            except OSError:
+                pass
+        edited = {}
+        for name in names:
+            entry = self.state['files'].get(name)
+            try:
+                mtime = os.path.getmtime(self.local_path(name))
+            except OSError:
+                continue
+            if entry and entry['mtime'] == mtime:
+                continue
+            with open(self.local_path(name), encoding='utf-8') as f:
+                content = f.read()
+            if entry and entry['hash'] == local_hash(content):
+                entry['mtime'] = mtime
+                continue
+            edited[name] = content
+        return edited
+
+    def _server_changes(self, edited, result):
+        changes, validators, delta = self.instance.get_file_changes(self.namespace, self.state['validators'])
+        if changes is None:
+            return
+        changes = [file for file in changes if self.wants(file.name)]
+        if not delta:
+            # Only a full listing came back; every mirrored file has to be checked,
+            # which costs a 304 per unchanged file when the instance has a content cache.
+            listed = set(file.name for file in changes)
+            for name in list(self.state['files']):
+                if name not in listed:
+                    self._delete_local(name, result, edited)
+        live = []
+        for file in changes:
+            if getattr(file, 'deleted', False):
+                self._delete_local(file.name, result, edited)
+            else:
+                live.append(file)
+        self._download(live, result, edited)
+        self.state['validators'] = validators
+
+    def _download(self, files, result, edited={}):
+        for (stub, file) in self.instance.get_files_content(files, self.max_workers):
+            if isinstance(file, Exception):
+                result.errors.append("{0}: {1}".format(stub.name, file))
+                continue
+            entry = self.state['files'].get(file.name)
+            hash = local_hash(file.content)
+            if entry and entry['hash'] == hash:
+                continue
+            if file.name in edited:
+                if local_hash(edited.pop(file.name)) == hash:
+                    self._remember(file.name, file.content, file.id)
+                else:
+                    self._write_conflict(file.name, file.content)
+                    result.conflicts.append(file.name)
+                continue
+            self._write(file.name, file.content, file.id)
+            result.pulled.append(file.name)
+
+    def _upload(self, edited, result):
+        if not edited:
+            return
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers)
+        futures = dict((executor.submit(self.instance.add_file, self.namespace, name, content), name)
+                       for (name, content) in edited.items() if not self.in_conflict(name))
+        try:
+            for future in concurrent.futures.as_completed(futures):
+                name = futures[future]
+                try:
+                    operation = future.result()
+                except Exception as e:
+                    result.errors.append("{0}: {1}".format(name, e))
+                    continue
+                if not operation.success:
+                    result.errors.append("{0}: {1}".format(name, "\n".join(getattr(operation, 'errors', []))))
+                    continue
+                self._remember(name, edited[name], operation.file.id)
+                result.pushed.append(name)
+        finally:
+            executor.shutdown()
+
+    def _delete_local(self, name, result, edited={}):
+        if name not in self.state['files']:
+            return
+        if name in edited:
+            # Deleted on the server but edited here: keep the local copy and upload it again
+            result.conflicts.append(name)
+            del self.state['files'][name]
+            return
+        try:
+            os.remove(self.local_path(name))
+        except OSError:
+            pass
+        del self.state['files'][name]
+        result.deleted.append(name)
+
+    def _write(self, name, content, id):
+        text = content.replace('\r\n', '\n')
+        store.write_atomic(self.local_path(name), text.encode('utf-8'))
+        self._remember(name, text, id)
+
+    def _write_conflict(self, name, content):
+        store.write_atomic(self.local_path(name + CONFLICT_SUFFIX), content.replace('\r\n', '\n').encode('utf-8'))
+
+    def _remember(self, name, content, id):
+        self.state['files'][name] = { 'id': id, 'hash': local_hash(content), 'mtime': os.path.getmtime(self.local_path(name)) }
@@ -1,7 +1,23 @@
 #!/usr/bin/env python3
 
+import collections
+import http.client
+import io
+import json
+import os
+import socket
+import tempfile
+import threading
+import time
 import unittest
+import unittest.mock
 import cdev
+import index
+import mocksublime
+import mockserver
+import symbols
+import store
+import sync
 
 
 class TestCDEVServer(unittest.TestCase):
@@ -85,5 +101,936 @@ class TestCDEVServer(unittest.TestCase):
         self.assertTrue(anonxmlresult.success)
         self.assertEqual(anonxmlresult.file.name, "Sample.Person.cls")
 
+class TestMockServer(TestCDEVServer):
+    """ The live server tests, run against a local mockserver.MockServer """
+    @classmethod
+    def setUpClass(cls):
+        cls.server = mockserver.MockServer(files=100).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
+    def setUp(self):
+        self.instance = cdev.CacheInstance(self.server.host, self.server.port, '_SYSTEM', 'SYS')
+
+class TestStats(unittest.TestCase):
+    def test_endpoints(self):
+        server = mockserver.MockServer(files=10).start()
+        self.addCleanup(server.stop)
+        instance = cdev.CacheInstance(server.host, server.port, '_SYSTEM', 'SYS')
+        instance.stats = cdev.RequestStats()
+
+        namespace = instance.get_namespaces()[0]
+        files = instance.get_files(namespace)
+        instance.get_file(files[0])
+        instance.get_file(files[1])
+
+        snapshot = instance.stats.snapshot()
+        self.assertEqual(list(snapshot.keys()), ['GET /', 'GET /namespaces', 'GET /namespaces/*/files', 'GET /namespaces/*/files/*'])
+        self.assertEqual(snapshot['GET /namespaces/*/files/*']['count'], 2)
+        self.assertEqual(snapshot['GET /namespaces/*/files/*']['errors'], 0)
+        self.assertGreater(snapshot['GET /namespaces/*/files']['bytes_in'], 0)
+
+class FakeConnection:
+    """ Stands in for an HTTPConnection; getresponse raises error if one is given. """
+    def __init__(self, error=None):
+        self.error = error
+        self.sock = object()
+        self.requests = []
+
+    def connect(self):
+        self.sock = object()
+
+    def request(self, method, url, body=None, headers={}):
+        self.requests.append((method, url))
+
+    def getresponse(self):
+        if self.error:
+            raise self.error
+        response = io.BytesIO(b'{}')
+        response.status, response.headers, response.will_close = 200, {}, False
+        return response
+
+    def close(self):
+        self.sock = None
+
+class TestConnectionPool(unittest.TestCase):
+    def pool(self, idle, fresh):
+        pool = cdev.ConnectionPool('localhost', 1)
+        pool._checkin(idle)
+        pool._connect = lambda: fresh
+        return pool
+
+    def test_stale_connection(self):
+        idle, fresh = FakeConnection(http.client.RemoteDisconnected()), FakeConnection()
+        self.assertEqual(self.pool(idle, fresh).request('PUT', '/files/').status, 200)
+        self.assertEqual((len(idle.requests), len(fresh.requests)), (1, 1))
+
+    def test_timeout(self):
+        idle, fresh = FakeConnection(socket.timeout()), FakeConnection()
+        with self.assertRaises(socket.timeout):
+            self.pool(idle, fresh).request('PUT', '/files/')
+        self.assertEqual((len(idle.requests), len(fresh.requests)), (1, 0))
+
+    def test_fresh_connection(self):
+        idle, fresh = FakeConnection(http.client.RemoteDisconnected()), FakeConnection(ConnectionResetError())
+        with self.assertRaises(ConnectionResetError):
+            self.pool(idle, fresh).request('GET', '/')
+        self.assertEqual((len(idle.requests), len(fresh.requests)), (1, 1))
+
+    def test_shared(self):
+        pool = cdev.get_pool('pool.example', 57772, 4, 30, 10)
+        self.assertIs(cdev.CacheInstance('pool.example', 57772, None, None, timeout=10).pool, pool)
+        self.assertIsNot(cdev.CacheInstance('pool.example', 57772, None, None, timeout=60).pool, pool)
+        self.assertEqual(cdev.CacheInstance('pool.example', 57772, None, None, pool_size=8, timeout=10).pool.size, 8)
+
+class TestCompression(unittest.TestCase):
+    content = 'Class Big.Class\r\n{\r\n' + 'Property P As %String;\r\n' * 1000 + '}'
+
+    def upload(self, server, **options):
+        self.addCleanup(server.stop)
+        instance = cdev.CacheInstance(server.host, server.port, '_SYSTEM', 'SYS', **options)
+        instance.stats = cdev.RequestStats()
+        namespace = instance.get_namespaces()[0]
+        return instance, instance.add_file(namespace, 'Big.Class.cls', self.content)
+
+    def test_compressed(self):
+        instance, result = self.upload(mockserver.MockServer(files=10).start(), compress_requests=None)
+        self.assertTrue(result.success)
+        self.assertEqual(instance.get_file(result.file).content, self.content)
+        self.assertTrue(instance.compress_requests)
+        self.assertLess(instance.stats.snapshot()['PUT /namespaces/*/files']['bytes_out'], len(self.content) / 10)
+
+    def test_fallback(self):
+        instance, result = self.upload(mockserver.MockServer(files=10, gzip_requests=False).start(), compress_requests=None)
+        self.assertTrue(result.success)
+        self.assertEqual(instance.get_file(result.file).content, self.content)
+        self.assertFalse(instance.compress_requests)
+
+    def test_server_error(self):
+        instance, result = self.upload(mockserver.MockServer(files=10, gzip_requests=False, gzip_error=500).start(), compress_requests=None)
+        self.assertFalse(result.success)
+        self.assertIsNone(instance.compress_requests)
+
+    def test_default(self):
+        instance, result = self.upload(mockserver.MockServer(files=10, gzip_requests=False).start())
+        self.assertTrue(result.success)
+        self.assertGreater(instance.stats.snapshot()['PUT /namespaces/*/files']['bytes_out'], len(self.content))
+        self.assertEqual(instance.stats.snapshot()['PUT /namespaces/*/files']['count'], 1)
+
+class TestBatch(unittest.TestCase):
+    def test_failing_file(self):
+        server = mockserver.MockServer(files=10, batch_compile=False, failing=['Batch.B.cls']).start()
+        self.addCleanup(server.stop)
+        instance = cdev.CacheInstance(server.host, server.port, '_SYSTEM', 'SYS')
+        namespace = instance.get_namespaces()[0]
+        files = [(name, 'Class {0}\r\n{{\r\n}}'.format(name[:-4])) for name in ('Batch.A.cls', 'Batch.B.cls', 'Batch.C.cls')]
+        added = instance.add_files(namespace, files)
+        self.assertEqual([operation.success for operation in added], [True, False, True])
+        self.assertEqual(added[1].file.name, 'Batch.B.cls')
+        self.assertIn('HTTP 500', added[1].errors[0])
+
+        server.store.put(namespace.name, 'Batch.B.cls', 'Class Batch.B\r\n{\r\n}')
+        stubs = [added[0].file, cdev.File({ 'id': namespace.files + 'Batch.B.cls', 'name': 'Batch.B.cls' }), added[2].file]
+        compiled = instance.compile_files(namespace, stubs)
+        self.assertEqual([operation.success for operation in compiled], [True, False, True])
+        self.assertEqual(compiled[1].file.name, 'Batch.B.cls')
+        self.assertIn('Cannot Compile Batch.B.cls: HTTP 500', compiled[1].errors[0])
+
+class TestQueryCache(unittest.TestCase):
+    def setUp(self):
+        self.server = mockserver.MockServer(files=10).start()
+        self.addCleanup(self.server.stop)
+        self.instance = cdev.CacheInstance(self.server.host, self.server.port, '_SYSTEM', 'SYS')
+        self.namespace = self.instance.get_namespaces()[0]
+
+    def test_normalize(self):
+        self.assertEqual(cdev.normalize_sql(" SELECT  Name\r\n  FROM Sample.Person WHERE Name = 'A  B' "),
+                         "SELECT Name FROM Sample.Person WHERE Name = 'A  B'")
+
+    def test_reuse(self):
+        first = next(self.instance.run_query(self.namespace, 'SELECT Name FROM Sample.Person', 10))
+        second = next(self.instance.run_query(self.namespace, 'SELECT  Name\nFROM Sample.Person', 10))
+        self.assertTrue(first.success and second.success)
+        self.assertEqual(len(self.server.store.queries[self.namespace.name]), 1)
+        self.assertEqual(first.query.id, second.query.id)
+
+    def test_recreate(self):
+        next(self.instance.run_query(self.namespace, 'SELECT Name FROM Sample.Person', 10))
+        self.server.store.queries[self.namespace.name] = []
+        result = next(self.instance.run_query(self.namespace, 'SELECT Name FROM Sample.Person', 10))
+        self.assertTrue(result.success)
+        self.assertEqual(len(self.server.store.queries[self.namespace.name]), 1)
+
+    def test_plan(self):
+        result = self.instance.query_plan(self.namespace, 'SELECT Name FROM Sample.Person')
+        self.assertTrue(result.success)
+        self.assertIn('Sample.Person', result.plan)
+        self.instance.stats = cdev.RequestStats()
+        self.assertEqual(self.instance.query_plan(self.namespace, 'SELECT Name FROM Sample.Person').plan, result.plan)
+        self.assertEqual(self.instance.stats.snapshot(), {})
+
+        self.instance.query_cache.clear(self.namespace)
+        self.assertEqual(len(self.instance.query_cache), 0)
+
+class TestPaging(unittest.TestCase):
+    def pages(self, rows, page_size, paging, text='SELECT Name, SSN FROM Sample.Person'):
+        server = mockserver.MockServer(files=10, rows=rows, paging=paging).start()
+        self.addCleanup(server.stop)
+        instance = cdev.CacheInstance(server.host, server.port, '_SYSTEM', 'SYS')
+        query = instance.add_query(instance.get_namespaces()[0], text).query
+        pages = list(instance.iter_query(query, page_size))
+        self.assertTrue(all(page.success for page in pages))
+        if rows > page_size:
+            self.assertEqual(instance.paging, paging)
+        return [list(page.resultset.values())[0] for page in pages]
+
+    def test_paging(self):
+        pages = self.pages(25, 10, True)
+        self.assertEqual([len(names) for names in pages], [10, 10, 5])
+        self.assertEqual(len(set(sum(pages, []))), 25)
+
+    def test_without_paging(self):
+        self.assertEqual([len(names) for names in self.pages(25, 10, False)], [10, 10, 5])
+
+    def test_full_page(self):
+        self.assertEqual([len(names) for names in self.pages(10, 10, True)], [10])
+        self.assertEqual([len(names) for names in self.pages(10, 10, False)], [10])
+
+    def test_one_row_over(self):
+        self.assertEqual([len(names) for names in self.pages(11, 10, True)], [10, 1])
+        self.assertEqual([len(names) for names in self.pages(11, 10, False)], [10, 1])
+
+    def test_repeated_rows(self):
+        pages = self.pages(25, 10, True, 'SELECT 1 FROM Sample.Person')
+        self.assertEqual(pages, [['1'] * 10, ['1'] * 10, ['1'] * 5])
+
+class TestDeploy(unittest.TestCase):
+    def test_deploy(self):
+        targets = []
+        for i in range(3):
+            server = mockserver.MockServer(files=10).start()
+            self.addCleanup(server.stop)
+            targets.append(('server{0}'.format(i), cdev.CacheInstance(server.host, server.port, '_SYSTEM', 'SYS')))
+        files = [('Deploy.A.cls', 'Class Deploy.A\r\n{\r\n}'), ('Deploy.B.cls', 'Class Deploy.B\r\n{\r\nERROR\r\n}')]
+        xml = mockserver.xml_content('Deploy.C.cls', 'Class Deploy.C\r\n{\r\n}')
+        results = cdev.deploy(targets, 'SAMPLES', files, xml)
+        self.assertEqual([result.server for result in results], ['server0', 'server1', 'server2'])
+        for result in results:
+            self.assertFalse(result.success)
+            self.assertEqual(sorted(result.files), ['Deploy.A.cls', 'Deploy.C.cls'])
+            self.assertEqual(len(result.errors), 1)
+            self.assertIn('Deploy.B.cls', result.errors[0])
+            self.assertEqual(list(result.timings), ['connect', 'load xml', 'upload', 'compile', 'total'])
+        report = cdev.deploy_report(results)
+        self.assertIn('server2', report)
+        self.assertIn('Compile ms', report)
+
+    def test_failing_file(self):
+        server = mockserver.MockServer(files=10, failing=['Deploy.B.cls']).start()
+        self.addCleanup(server.stop)
+        files = [('Deploy.A.cls', 'Class Deploy.A\r\n{\r\n}'), ('Deploy.B.cls', 'Class Deploy.B\r\n{\r\n}')]
+        result = cdev.deploy([('server', cdev.CacheInstance(server.host, server.port, '_SYSTEM', 'SYS'))], 'SAMPLES', files)[0]
+        self.assertEqual(result.files, ['Deploy.A.cls'])
+        self.assertEqual(len(result.errors), 1)
+        self.assertIn('Deploy.B.cls', result.errors[0])
+        self.assertIn('HTTP 500', result.errors[0])
+
+    def test_missing_namespace(self):
+        server = mockserver.MockServer(files=10).start()
+        self.addCleanup(server.stop)
+        results = cdev.deploy([('server', cdev.CacheInstance(server.host, server.port, '_SYSTEM', 'SYS'))], 'NOPE', [('A.cls', 'Class A\r\n{\r\n}')])
+        self.assertEqual(results[0].errors, ['Namespace NOPE does not exist'])
+
+class TestXml(unittest.TestCase):
+    def instance(self, batch_xml, failing=()):
+        server = mockserver.MockServer(files=30, batch_xml=batch_xml, failing=failing).start()
+        self.addCleanup(server.stop)
+        instance = cdev.CacheInstance(server.host, server.port, '_SYSTEM', 'SYS')
+        namespace = [namespace for namespace in instance.get_namespaces() if namespace.name == 'SAMPLES'][0]
+        return server, instance, namespace
+
+    def export(self, batch_xml):
+        server, instance, namespace = self.instance(batch_xml)
+        files = [file for file in instance.get_files(namespace) if file.name.startswith('Package1')]
+        files.append(cdev.File({ 'id': namespace.files + 'Missing.cls', 'name': 'Missing.cls', 'xml': namespace.xml + 'Missing.cls' }))
+        folder = tempfile.TemporaryDirectory()
+        self.addCleanup(folder.cleanup)
+        path = os.path.join(folder.name, 'export.xml')
+        results = instance.export_xml(namespace, files, path)
+        self.assertEqual(instance.batch_xml, batch_xml)
+        self.assertEqual([result.file.name for result in results], [file.name for file in files])
+        self.assertEqual([result.success for result in results], [True] * (len(files) - 1) + [False])
+        with open(path, encoding='utf-8', newline='') as f:
+            exported = mockserver.xml_files(f.read())
+        self.assertEqual([name for (name, content) in exported], [file.name for file in files[:-1]])
+        self.assertEqual(exported[0][1], server.store.content('SAMPLES', files[0].name))
+        if not batch_xml:
+            self.assertIn('HTTP 404', results[-1].errors[0])
+
+    def test_export(self):
+        self.export(True)
+
+    def test_export_fallback(self):
+        self.export(False)
+
+    def test_export_error(self):
+        server, instance, namespace = self.instance(True, failing=['Package1.Sub1.Class1.cls'])
+        files = [file for file in instance.get_files(namespace) if file.name.startswith('Package1.')]
+        folder = tempfile.TemporaryDirectory()
+        self.addCleanup(folder.cleanup)
+        path = os.path.join(folder.name, 'export.xml')
+        results = instance.export_xml(namespace, files, path)
+        self.assertEqual([result.file.name for result in results], [file.name for file in files])
+        self.assertFalse(any(result.success for result in results))
+        self.assertIn('HTTP 500', results[0].errors[0])
+        self.assertFalse(os.path.exists(path) or os.path.exists(path + '.part'))
+
+    def load(self, batch_xml):
+        server, instance, namespace = self.instance(batch_xml)
+        content = mockserver.xml_export([('Bulk.A.cls', 'Class Bulk.A\r\n{\r\n}'), ('Bulk.B.cls', 'Class Bulk.B\r\n{\r\n}'), ('BULK.mac', 'BULK\r\n quit')])
+        results = instance.import_xml(namespace, content)
+        self.assertEqual(sorted(result.file.name for result in results), ['BULK.mac', 'Bulk.A.cls', 'Bulk.B.cls'])
+        self.assertTrue(all(result.success for result in results))
+        self.assertEqual(server.store.content('SAMPLES', 'Bulk.B.cls'), 'Class Bulk.B\r\n{\r\n}')
+
+    def test_import(self):
+        self.load(True)
+
+    def test_import_fallback(self):
+        self.load(False)
+
+class PluginTestCase(unittest.TestCase):
+    """ InterSystems.py loaded with mocksublime standing in for the editor, with empty registries and caches. """
+    def setUp(self):
+        folder = tempfile.TemporaryDirectory()
+        self.addCleanup(folder.cleanup)
+        mocksublime.reset(folder.name)
+        self.plugin = mocksublime.load_plugin()
+        for registry in (self.plugin.instances, self.plugin.content_caches, self.plugin.file_indexes, self.plugin.symbol_indexes,
+                         self.plugin.query_pages, self.plugin.stats_panels):
+            registry.clear()
+        self.plugin.metadata = None
+        self.plugin.plugin_loaded()
+        self.addCleanup(self.plugin.plugin_unloaded)
+        self.settings = mocksublime.load_settings('InterSystems.sublime-settings')
+
+    def use_server(self, server, namespace='SAMPLES'):
+        self.settings.set('servers', { 'mock': { 'host': server.host, 'web_server_port': server.port, 'username': '_SYSTEM', 'password': 'SYS' } })
+        self.settings.set('current-server', 'mock')
+        namespaces = self.plugin.current_instance().get_namespaces()
+        self.plugin.cache_set('Namespace', [candidate for candidate in namespaces if candidate.name == namespace][0].to_dict())
+
+class TestInstances(PluginTestCase):
+    def setUp(self):
+        super().setUp()
+        self.settings.set('servers', dict((name, { 'host': name + '.example', 'web_server_port': 57772, 'username': '_SYSTEM', 'password': 'SYS' })
+                                          for name in ('a', 'b')))
+        self.settings.set('current-server', 'a')
+
+    def test_shared(self):
+        instance = self.plugin.current_instance()
+        self.assertIs(self.plugin.current_instance(), instance)
+        self.assertIsNone(instance._root)
+        self.assertIs(self.plugin.get_instance(self.settings.get('servers')['a']), instance)
+        self.assertEqual(self.plugin.get_instance(self.settings.get('servers')['b']).host, 'b.example')
+
+    def test_settings_change(self):
+        instance = self.plugin.current_instance()
+        self.settings.set('current-server', 'b')
+        self.assertEqual(self.plugin.current_instance().host, 'b.example')
+        servers = dict(self.settings.get('servers'))
+        servers['a'] = dict(servers['a'], password='changed')
+        self.settings.set('servers', servers)
+        self.settings.set('current-server', 'a')
+        self.assertIsNot(self.plugin.current_instance(), instance)
+        self.assertEqual(self.plugin.current_instance().password, 'changed')
+
+    def test_unhealthy(self):
+        instance = self.plugin.current_instance()
+        instance.last_success = time.time() - 10
+        instance.last_failure = time.time()
+        self.assertIsNot(self.plugin.current_instance(), instance)
+
+    def test_refresh(self):
+        instance = self.plugin.current_instance()
+        instance._root = self.plugin.cdev.Root({ 'namespaces': '/csp/sys/dev/namespaces/' })
+        instance.last_success = time.time()
+        self.assertIsNotNone(self.plugin.current_instance()._root)
+        instance.last_success = time.time() - 3600
+        self.assertIs(self.plugin.current_instance(), instance)
+        self.assertIsNone(instance._root)
+
+class TestStore(unittest.TestCase):
+    def setUp(self):
+        folder = tempfile.TemporaryDirectory()
+        self.addCleanup(folder.cleanup)
+        self.path = folder.name
+
+    def files(self):
+        return sorted(name for name in os.listdir(self.path) if name != 'index.json')
+
+    def test_values(self):
+        metadata = store.MetadataStore(self.path)
+        metadata.set('a', { 'value': 1 })
+        self.assertEqual(metadata.get('a'), { 'value': 1 })
+        self.assertIs(metadata.get('a'), metadata.get('a'))
+        metadata.set('a', { 'value': 2 })
+        self.assertEqual(metadata.get('a'), { 'value': 2 })
+        metadata.delete('a')
+        self.assertIsNone(metadata.get('a'))
+        self.assertEqual(self.files(), [])
+
+    def test_deferred_flush(self):
+        metadata = store.MetadataStore(self.path, flush_interval=3600)
+        for i in range(10):
+            metadata.set(str(i), i)
+        self.assertFalse(os.path.exists(os.path.join(self.path, 'index.json')))
+        # Reopened without a flush, as after a crash: the unindexed files are removed
+        self.assertIsNone(store.MetadataStore(self.path).get('1'))
+        self.assertEqual(self.files(), [])
+
+        metadata.set('1', 1)
+        metadata.flush()
+        self.assertEqual(store.MetadataStore(self.path).get('1'), 1)
+
+    def test_eviction(self):
+        metadata = store.MetadataStore(self.path, max_bytes=20)
+        metadata.set('a', 'x' * 8)
+        metadata.set('b', 'y' * 8)
+        metadata.get('a')
+        metadata.set('c', 'z' * 8)
+        self.assertIsNone(metadata.get('b'))
+        self.assertEqual(metadata.get('a'), 'x' * 8)
+        self.assertEqual(len(self.files()), 2)
+
+    def test_size(self):
+        metadata = store.MetadataStore(self.path, max_bytes=40)
+        for (key, value) in [('a', 'x' * 8), ('b', 'y' * 8), ('a', 'x' * 3), ('c', 'z' * 8)]:
+            metadata.set(key, value)
+        self.assertEqual(metadata.size, 25)
+        metadata.delete('b')
+        self.assertEqual(metadata.size, 15)
+        metadata.get('a')
+        metadata.set('d', 'w' * 28)
+        self.assertEqual((metadata.get('a'), metadata.get('c')), ('xxx', None))
+        self.assertEqual(metadata.size, 35)
+        metadata.flush()
+        reopened = store.MetadataStore(self.path, max_bytes=40)
+        self.assertEqual(reopened.size, 35)
+        reopened.set('e', 'v' * 4)
+        self.assertEqual((reopened.get('d'), reopened.size), (None, 11))
+        metadata.clear()
+        self.assertEqual(metadata.size, 0)
+
+    def test_corrupt_index(self):
+        metadata = store.MetadataStore(self.path)
+        metadata.set('a', 1)
+        metadata.flush()
+        with open(os.path.join(self.path, 'index.json'), 'wb') as f:
+            f.write(b'{"a": {"file"')
+        metadata = store.MetadataStore(self.path)
+        self.assertIsNone(metadata.get('a'))
+        self.assertEqual(self.files(), [])
+        metadata.set('a', 2)
+        self.assertEqual(metadata.get('a'), 2)
+
+    def test_atomic_write(self):
+        path = os.path.join(self.path, 'file')
+        store.write_atomic(path, b'old')
+        with self.assertRaises(TypeError):
+            store.write_atomic(path, 'not bytes')
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), b'old')
+        self.assertEqual(os.listdir(self.path), ['file'])
+
+    def test_content_cache(self):
+        cache = store.ContentCache(25, self.path)
+        for name in 'abc':
+            cache.set(name, { 'id': name, 'content': name * 10 }, { 'hash': name })
+        self.assertEqual(list(cache._memory), ['b', 'c'])
+        self.assertEqual(cache.get('a')['file']['content'], 'a' * 10)
+        self.assertEqual(list(cache._memory), ['c', 'a'])
+        cache.delete('c')
+        self.assertIsNone(cache.get('c'))
+        cache.flush()
+        self.assertEqual(store.ContentCache(25, self.path).get('b')['version'], { 'hash': 'b' })
+
+class TestFileListing(PluginTestCase):
+    def test_update(self):
+        server = mockserver.MockServer(files=20).start()
+        self.addCleanup(server.stop)
+        self.use_server(server)
+        self.assertIn('Sample.Person.cls', self.plugin.update_file_listing().prefix('Sample.'))
+        server.store.put('SAMPLES', 'Sample.New.cls', 'Class Sample.New\r\n{\r\n}')
+
+        metadata = self.plugin.metadata_store()
+        reads = []
+        get = metadata.get
+        metadata.get = lambda key, default=None: reads.append(key) or get(key, default)
+        self.assertIn('Sample.New.cls', self.plugin.update_file_listing().prefix('Sample.'))
+        self.assertFalse([key for key in reads if key.endswith('/Files')])
+        self.assertEqual(len(self.plugin.file_listing()[0]), 23)
+
+class TestRefresh(PluginTestCase):
+    def test_refresh(self):
+        server = mockserver.MockServer(files=10).start()
+        self.addCleanup(server.stop)
+        self.use_server(server)
+        instance = self.plugin.current_instance()
+        stub = [file for file in instance.get_files(self.plugin.current_namespace()) if file.name == 'Sample.Person.cls'][0]
+        window = mocksublime.active_window()
+        clean, edited = window.new_file(), window.new_file()
+        for view in (clean, edited):
+            self.plugin.write_file(view, instance.get_file(stub))
+            view.settings().set('file', stub.to_dict())
+        edited.edit('Class Sample.Person { // unsaved }')
+
+        server.store.put('SAMPLES', 'Sample.Person.cls', 'Class Sample.Person\r\n{ // server\r\n}')
+        self.plugin.refresh_file(instance.get_file(stub))
+        name, args = clean.commands[-1]
+        self.assertEqual(self.plugin.take_text(None, args['text_key']), 'Class Sample.Person\r\n{ // server\r\n}')
+        self.assertEqual(len(edited.commands), 1)
+        self.assertIn('cache-newer', edited.status)
+        self.assertNotIn('cache-newer', clean.status)
+
+class TestQueryPages(PluginTestCase):
+    def page(self, names):
+        page = self.plugin.cdev.QueryOperation({ 'success': True })
+        page.resultset = collections.OrderedDict([('Name', names)])
+        return page
+
+    def append(self, view, pages, widths):
+        self.plugin.MoreQueryResults(view).go(iter(pages), 'table', widths)
+        name, args = view.commands[-1]
+        return self.plugin.take_text(None, args['text_key']).split('\n'), args['replace_last_line']
+
+    def test_widths(self):
+        view = mocksublime.active_window().new_file()
+        self.settings.set('query-max-column-width', None)
+        lines, replace = self.append(view, [self.page(['Al', 'Bo'])], [4])
+        self.assertEqual(lines[0], '| Al   |')
+        self.assertTrue(replace)
+        lines, replace = self.append(view, [self.page(['Christopher'])], [4])
+        self.assertEqual(lines[:3], ['| Name        |', '|=============|', '| Christopher |'])
+        self.assertFalse(replace)
+        self.assertEqual(self.plugin.query_pages[view.id()][2], [11])
+
+        self.settings.set('query-max-column-width', 6)
+        lines, replace = self.append(view, [self.page(['Christopher'])], [4])
+        self.assertEqual(lines[2], '| Chris\u2026 |')
+
+    def test_output_view(self):
+        server = mockserver.MockServer(files=10, rows=25).start()
+        self.addCleanup(server.stop)
+        self.use_server(server)
+        self.settings.set('query-page-size', 10)
+        window = mocksublime.active_window()
+        self.plugin.RunSqlQuery(window.new_file()).go('SELECT Name FROM Sample.Person')
+        name, args = mocksublime.commands[-1]
+        self.assertEqual(name, 'open_cache_output')
+        window.new_file()
+        self.plugin.OpenCacheOutput().run(**args)
+        output = window.views()[-1]
+        self.assertEqual(list(self.plugin.query_pages), [output.id()])
+        self.assertTrue(self.plugin.MoreQueryResults(output).is_enabled())
+
+class TestDownloadPackage(PluginTestCase):
+    def setUp(self):
+        super().setUp()
+        self.server = mockserver.MockServer(files=40).start()
+        self.addCleanup(self.server.stop)
+        self.use_server(self.server)
+        self.names = [name for name in self.server.store.namespaces['SAMPLES'] if name.startswith('Package1.')]
+
+    def test_folder(self):
+        with tempfile.TemporaryDirectory() as folder:
+            command = self.plugin.DownloadPackage()
+            command.folder = folder
+            command.go('Package1.')
+            self.assertEqual(sorted(os.listdir(folder)), sorted(self.names))
+            with open(os.path.join(folder, self.names[0]), encoding='utf-8') as f:
+                self.assertEqual(f.read(), self.server.store.content('SAMPLES', self.names[0]).replace('\r\n', '\n'))
+        self.assertEqual(mocksublime.messages[-1], "Downloaded {0} of {0} files".format(len(self.names)))
+
+    def test_open(self):
+        command = self.plugin.DownloadPackage()
+        command.folder = None
+        command.go('Package1.')
+        opened = [args['name'] for (name, args) in mocksublime.commands if name == 'open_cache_code']
+        self.assertEqual(sorted(opened), sorted(self.names))
+
+class TestUploadOpenFiles(PluginTestCase):
+    def setUp(self):
+        super().setUp()
+        self.server = mockserver.MockServer(files=10).start()
+        self.addCleanup(self.server.stop)
+        self.use_server(self.server)
+        self.views = []
+        for name in ('A', 'B'):
+            view = mocksublime.active_window().new_file()
+            view.edit('Class Batch.{0}\n{{\n}}\n'.format(name))
+            self.views.append(view)
+        self.command = self.plugin.UploadOpenFiles()
+        with unittest.mock.patch.object(self.plugin.requests, 'submit'):
+            self.command.run()
+
+    def during_compile(self, action):
+        """ Run action while the batch compile is in flight. """
+        instance = self.plugin.current_instance()
+        compile_files = instance.compile_files
+        def compile_and_act(*args):
+            action()
+            return compile_files(*args)
+        patcher = unittest.mock.patch.object(instance, 'compile_files', compile_and_act)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def written(self, view):
+        return [self.plugin.take_text(None, args['text_key']) for (name, args) in view.commands if name == 'write_cache_output']
+
+    def test_edited_during_upload(self):
+        self.during_compile(lambda: self.views[1].edit('Class Batch.B\n{ // typing\n}\n'))
+        self.command.go()
+        self.assertEqual(self.written(self.views[0]), ['Class Batch.A\r\n{\r\n}\r\n'])
+        self.assertEqual(self.written(self.views[1]), [])
+        self.assertEqual(self.views[1].text, 'Class Batch.B\n{ // typing\n}\n')
+        self.assertEqual(self.server.store.content('SAMPLES', 'Batch.B.cls'), 'Class Batch.B\r\n{\r\n}\r\n')
+
+    def test_queued_files(self):
+        self.plugin.uploads.submit(self.views[0], 'Batch.A.cls', 'Class Batch.A\r\n{ // queued\r\n}\r\n')
+        self.during_compile(lambda: self.plugin.uploads.submit(self.views[1], 'Batch.B.cls', 'Class Batch.B\r\n{ // saved\r\n}\r\n'))
+        self.command.go()
+        self.assertNotIn('Batch.A.cls', self.server.store.namespaces['SAMPLES'])
+        self.assertEqual(self.written(self.views[1]), [])
+        mocksublime.run_timeouts()
+        deadline = time.time() + 5
+        while self.plugin.uploads.pending or self.plugin.uploads.active:
+            self.assertLess(time.time(), deadline)
+            time.sleep(0.01)
+        self.assertEqual(self.server.store.content('SAMPLES', 'Batch.A.cls'), 'Class Batch.A\r\n{ // queued\r\n}\r\n')
+        self.assertEqual(self.server.store.content('SAMPLES', 'Batch.B.cls'), 'Class Batch.B\r\n{ // saved\r\n}\r\n')
+
+class TestQuickPanelDownloads(PluginTestCase):
+    def test_background(self):
+        stub = self.plugin.file_stub('Sample.Person.cls', 'files/Sample.Person.cls')
+        commands = [self.plugin.DownloadClassOrRoutine(), self.plugin.FindCacheFile(), self.plugin.OpenGeneratedFiles(None)]
+        commands[0].entries = [(stub.name, stub.id)]
+        commands[1].names = [stub.name]
+        commands[1].index = unittest.mock.Mock(id=lambda name: stub.id)
+        commands[2].files = [stub]
+        with unittest.mock.patch.object(self.plugin, 'download_file') as download_file, \
+             unittest.mock.patch.object(self.plugin.requests, 'submit') as submit:
+            for command in commands:
+                command.download(0)
+        self.assertFalse(download_file.called)
+        self.assertEqual([call[0][:1] + (call[0][1].id,) for call in submit.call_args_list], [(download_file, stub.id)] * 3)
+
+class TestStatsPanel(PluginTestCase):
+    def test_one_refresh_loop(self):
+        window = mocksublime.active_window()
+        self.plugin.ShowCacheStats().run()
+        self.plugin.ShowCacheStats().run(reset=True)
+        self.assertEqual(len(mocksublime.timeouts), 1)
+        panel = window.output_panels['InterSystems Stats']
+        self.assertEqual(mocksublime.run_timeouts(), 1)
+        self.assertEqual(panel.commands[-1][0], 'write_cache_output')
+        self.assertEqual(len(mocksublime.timeouts), 1)
+        window.run_command('hide_panel')
+        mocksublime.run_timeouts()
+        self.assertEqual(mocksublime.timeouts, [])
+        self.plugin.ShowCacheStats().run()
+        self.assertEqual(len(mocksublime.timeouts), 1)
+
+class FakeUploads:
+    """ The add_file and compile_file of a CacheInstance, recording their calls.
+        add_file calls gates[text] first if there is one, to hold an upload in flight. """
+    def __init__(self, plugin):
+        self.plugin = plugin
+        self.lock = threading.Lock()
+        self.gates = {}
+        self.added = []
+        self.compiled = []
+        self.compiled_content = True
+
+    def add_file(self, namespace, name, text):
+        with self.lock:
+            self.added.append((name, text))
+        if text in self.gates:
+            self.gates[text]()
+        return self.plugin.cdev.FileOperation({ 'success': True, 'file': { 'id': name, 'name': name, 'content': text } })
+
+    def compile_file(self, file, spec):
+        with self.lock:
+            self.compiled.append(file.content)
+        compiled = file.to_dict()
+        if not self.compiled_content:
+            del compiled['content']
+        return self.plugin.cdev.FileOperation({ 'success': True, 'file': compiled })
+
+class TestUploadQueue(PluginTestCase):
+    def setUp(self):
+        super().setUp()
+        self.instance = FakeUploads(self.plugin)
+        self.written = []
+        self.indexed = []
+        for (name, value) in [('current_instance', lambda: self.instance), ('current_namespace', lambda: None),
+                              ('write_file', lambda view, file: self.written.append(file.content)),
+                              ('index_source', lambda file: self.indexed.append(file.content))]:
+            patcher = unittest.mock.patch.object(self.plugin, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.uploads = self.plugin.UploadQueue()
+        self.view = mocksublime.active_window().new_file()
+
+    def wait(self, done=None):
+        """ Wait until done() is true, or until the queue is idle. """
+        deadline = time.time() + 5
+        while not (done() if done else not self.uploads.pending and not self.uploads.active):
+            self.assertLess(time.time(), deadline)
+            time.sleep(0.01)
+
+    def test_rapid_saves(self):
+        self.uploads.submit(self.view, 'A.cls', 'v1')
+        self.uploads.submit(self.view, 'A.cls', 'v2')
+        self.assertEqual(self.uploads.status(), "Cache: 1 queued, 0 uploading")
+        self.assertEqual(self.instance.added, [])
+        mocksublime.run_timeouts()
+        self.wait()
+        self.assertEqual(self.instance.added, [('A.cls', 'v2')])
+        self.assertEqual(self.instance.compiled, ['v2'])
+        self.assertEqual(self.written, ['v2'])
+        self.assertEqual(self.uploads.status(), '')
+
+    def test_compile_without_content(self):
+        self.instance.compiled_content = False
+        self.uploads.submit(self.view, 'A.cls', 'v1')
+        mocksublime.run_timeouts()
+        self.wait()
+        self.assertEqual(self.written, ['v1'])
+        self.assertEqual(mocksublime.messages[-1], "Compiled A.cls")
+
+    def test_save_during_upload(self):
+        release = threading.Event()
+        self.instance.gates['v1'] = lambda: release.wait(5)
+        self.uploads.submit(self.view, 'A.cls', 'v1')
+        mocksublime.run_timeouts()
+        self.wait(lambda: self.instance.added)
+        self.uploads.submit(self.view, 'A.cls', 'v2')
+        self.uploads.submit(self.view, 'A.cls', 'v3')
+        mocksublime.run_timeouts()
+        self.assertTrue(self.uploads.status().startswith("Cache: 0 queued, 1 uploading"))
+        self.assertEqual(len(self.instance.added), 1)
+        release.set()
+        self.wait()
+        self.assertEqual(self.instance.added, [('A.cls', 'v1'), ('A.cls', 'v3')])
+        self.assertEqual(self.instance.compiled, ['v3'])
+        self.assertEqual(self.written, ['v3'])
+
+    def test_parallel_files(self):
+        both_uploading = threading.Barrier(2, timeout=5)
+        self.instance.gates = { 'a': both_uploading.wait, 'b': both_uploading.wait }
+        self.uploads.submit(self.view, 'A.cls', 'a')
+        self.uploads.submit(mocksublime.active_window().new_file(), 'B.cls', 'b')
+        mocksublime.run_timeouts()
+        self.wait()
+        self.assertEqual(sorted(self.instance.compiled), ['a', 'b'])
+
+    def test_edited_view(self):
+        self.uploads.submit(self.view, 'A.cls', 'v1')
+        self.view.edit('v2 not saved')
+        mocksublime.run_timeouts()
+        self.wait()
+        self.assertEqual(self.written, [])
+        self.assertEqual(self.indexed, ['v1'])
+
+class TestSync(unittest.TestCase):
+    def setUp(self):
+        self.server = mockserver.MockServer(files=20).start()
+        self.addCleanup(self.server.stop)
+        self.instance = cdev.CacheInstance(self.server.host, self.server.port, '_SYSTEM', 'SYS')
+        self.namespace = [namespace for namespace in self.instance.get_namespaces() if namespace.name == 'SAMPLES'][0]
+        folder = tempfile.TemporaryDirectory()
+        self.addCleanup(folder.cleanup)
+        self.path = folder.name
+        self.mirror = sync.NamespaceMirror(self.instance, self.namespace, self.path)
+        self.names = sorted(self.mirror.pull().pulled)
+
+    def edit(self, name, content):
+        path = os.path.join(self.path, name)
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(content)
+        os.utime(path, (time.time() + 1, time.time() + 1))
+
+    def test_pull(self):
+        self.assertIn('Sample.Person.cls', self.names)
+        self.assertEqual(sorted(name for name in os.listdir(self.path) if not name.startswith('.')), self.names)
+        self.assertFalse(sync.NamespaceMirror(self.instance, self.namespace, self.path).sync())
+
+    def test_failed_listing(self):
+        with unittest.mock.patch.object(self.instance, 'get_file_changes', return_value=(None, {}, False)):
+            result = self.mirror.pull()
+        self.assertEqual(result.errors, ["Cannot list the files of SAMPLES"])
+        self.assertEqual(result.deleted, [])
+        self.assertEqual(sorted(name for name in os.listdir(self.path) if not name.startswith('.')), self.names)
+
+    def test_prefix(self):
+        with tempfile.TemporaryDirectory() as path:
+            mirror = sync.NamespaceMirror(self.instance, self.namespace, path, prefix='Package1')
+            self.assertEqual(sorted(mirror.pull().pulled), [name for name in self.names if name.startswith('Package1')])
+
+    def test_push(self):
+        self.edit('Sample.Person.cls', 'Class Sample.Person\n{\n}\n')
+        self.edit('Sample.New.cls', 'Class Sample.New\n{\n}\n')
+        result = self.mirror.sync()
+        self.assertEqual(sorted(result.pushed), ['Sample.New.cls', 'Sample.Person.cls'])
+        self.assertEqual(self.server.store.content('SAMPLES', 'Sample.Person.cls').replace('\r\n', '\n'), 'Class Sample.Person\n{\n}\n')
+        self.assertEqual(self.mirror.sync().pulled, [])
+
+    def test_server_changes(self):
+        self.server.store.put('SAMPLES', 'Sample.Person.cls', 'Class Sample.Person\r\n{\r\n}\r\n')
+        self.server.store.delete('SAMPLES', 'LDAP.mac')
+        result = self.mirror.sync()
+        self.assertEqual(result.pulled, ['Sample.Person.cls'])
+        self.assertEqual(result.deleted, ['LDAP.mac'])
+        with open(os.path.join(self.path, 'Sample.Person.cls'), encoding='utf-8') as f:
+            self.assertEqual(f.read(), 'Class Sample.Person\n{\n}\n')
+
+    def test_conflict(self):
+        self.server.store.put('SAMPLES', 'Sample.Person.cls', 'Class Sample.Person\r\n{ // server\r\n}\r\n')
+        self.edit('Sample.Person.cls', 'Class Sample.Person\n{ // local\n}\n')
+        result = self.mirror.sync()
+        self.assertEqual(result.conflicts, ['Sample.Person.cls'])
+        self.assertEqual(result.pushed, [])
+        self.assertTrue(os.path.exists(os.path.join(self.path, 'Sample.Person.cls' + sync.CONFLICT_SUFFIX)))
+        self.assertIn('// server', self.server.store.content('SAMPLES', 'Sample.Person.cls'))
+
+        os.remove(os.path.join(self.path, 'Sample.Person.cls' + sync.CONFLICT_SUFFIX))
+        self.assertEqual(self.mirror.sync().pushed, ['Sample.Person.cls'])
+        self.assertIn('// local', self.server.store.content('SAMPLES', 'Sample.Person.cls'))
+
+class TestSymbols(unittest.TestCase):
+    def setUp(self):
+        self.index = symbols.SymbolIndex()
+        self.index.update('Sample.Person.cls', 'Include %occStatus\r\n\r\nClass Sample.Person Extends %Persistent\r\n{\r\n\r\n'
+                          'Property Name As %String;\r\n\r\nMethod Save() As %Status\r\n{\r\n    quit $$$OK\r\n}\r\n\r\n}')
+        self.index.update('Sample.Employee.cls', '/// Staff\r\nClass Sample.Employee Extends Person\r\n{\r\n\r\n'
+                          'ClassMethod Hire() As Sample.Employee\r\n{\r\n    set e = ##class(Sample.Employee).%New()\r\n    do e.Save()\r\n    quit e\r\n}\r\n\r\n}')
+        self.index.update('LDAP.mac', 'ROUTINE LDAP\r\n#include %occInclude\r\nStart()\r\n    do Work^LDAP\r\n    quit\r\nWork\r\n    quit')
+
+    def test_scan(self):
+        scan = symbols.scan('Sample.Employee.cls', 'Class Sample.Employee Extends (Person, %Populate)\r\n{\r\nProperty Salary;\r\n}')
+        self.assertEqual([(symbol.kind, symbol.name, symbol.line) for symbol in scan.symbols],
+                         [('class', 'Sample.Employee', 1), ('property', 'Salary', 3)])
+        self.assertEqual(scan.extends, ['Sample.Person', '%Library.Populate'])
+        self.assertEqual(self.index.includes('Sample.Person.cls'), ['%occStatus'])
+        self.assertEqual(self.index.includes('LDAP.mac'), ['%occInclude'])
+
+    def test_reference_at(self):
+        line = '    set e = ##class(Sample.Employee).%New(), x = $$Start^LDAP(), y = $$$OK do ..Save(), e.Save()'
+        self.assertEqual(symbols.reference_at(line, line.index('Employee')), ('class', 'Sample.Employee', None))
+        self.assertEqual(symbols.reference_at(line, line.index('%New')), ('name', '%New', None))
+        self.assertEqual(symbols.reference_at(line, line.index('LDAP')), ('label', 'Start', 'LDAP'))
+        self.assertEqual(symbols.reference_at(line, line.index('OK')), ('macro', 'OK', None))
+        self.assertEqual(symbols.reference_at(line, line.index('..Save') + 3), ('member', 'Save', None))
+        self.assertEqual(symbols.reference_at(line, line.index('e.Save')), ('name', 'e.Save', None))
+
+    def test_definitions(self):
+        self.assertEqual([(symbol.file, symbol.line) for symbol in self.index.definitions('Sample.Person')], [('Sample.Person.cls', 3)])
+        self.assertEqual([(symbol.kind, symbol.line) for symbol in self.index.definitions('Work')], [('label', 6)])
+        macros = symbols.scan('Sample.inc', '#define OK 1\r\n #def1arg Err(%a) %a')
+        self.assertEqual([(symbol.kind, symbol.name) for symbol in macros.symbols], [('macro', 'OK'), ('macro', 'Err')])
+
+    def test_members(self):
+        self.assertEqual(self.index.superclasses('Sample.Employee'), (['Sample.Employee', 'Sample.Person'], ['%Library.Persistent']))
+        self.assertEqual([(symbol.container, symbol.line) for symbol in self.index.members('Sample.Employee', 'save')], [('Sample.Person', 8)])
+
+    def test_references(self):
+        self.assertEqual(self.index.references('Save'), [('Sample.Employee.cls', 8), ('Sample.Person.cls', 8)])
+        self.assertEqual(self.index.references('sample.employee'), [('Sample.Employee.cls', 2), ('Sample.Employee.cls', 5), ('Sample.Employee.cls', 7)])
+
+    def test_update(self):
+        self.assertFalse(self.index.update('LDAP.mac', 'ROUTINE LDAP\r\n#include %occInclude\r\nStart()\r\n    do Work^LDAP\r\n    quit\r\nWork\r\n    quit'))
+        self.index.update('Sample.Person.cls', 'Class Sample.Person\r\n{\r\n}')
+        self.assertEqual(self.index.members('Sample.Employee', 'Save'), [])
+        self.assertEqual(self.index.references('Save'), [('Sample.Employee.cls', 8)])
+        self.index.remove('LDAP.mac')
+        self.assertEqual(self.index.definitions('Work'), [])
+
+        loaded = symbols.SymbolIndex.load(json.loads(json.dumps(self.index.to_dict())))
+        self.assertEqual(loaded.definitions('Hire'), self.index.definitions('Hire'))
+        self.assertEqual(loaded.references('Save'), self.index.references('Save'))
+
+class TestFileIndex(unittest.TestCase):
+    def setUp(self):
+        names = ['Sample.Person.cls', 'Sample.Employee.cls', 'Sample.PersonSets.mac', 'LDAP.mac', 'SampleApp.Main.cls']
+        self.index = index.FileIndex((name, '/files/' + name) for name in names)
+
+    def test_prefix(self):
+        self.assertEqual(self.index.prefix('Sample.Per'), ['Sample.Person.cls', 'Sample.PersonSets.mac'])
+        self.assertEqual(self.index.prefix('sample.person.c'), ['Sample.Person.cls'])
+        self.assertEqual(self.index.prefix('Sample', ['.cls']), ['Sample.Employee.cls', 'Sample.Person.cls', 'SampleApp.Main.cls'])
+
+    def test_search(self):
+        self.assertEqual(self.index.search('person')[0], 'Sample.Person.cls')
+        self.assertEqual(self.index.search('spers', ['.mac']), ['Sample.PersonSets.mac'])
+        self.assertEqual(self.index.search('ldap'), ['LDAP.mac'])
+
+    def test_sync(self):
+        self.index.sync([{ 'name': 'Sample.Person.cls', 'id': '/files/Sample.Person.cls' }, { 'name': 'New.Class.cls', 'id': '/files/New.Class.cls' }])
+        self.assertEqual(len(self.index), 2)
+        self.assertEqual(self.index.prefix('Sample.'), ['Sample.Person.cls'])
+        self.assertEqual(self.index.search('newcl'), ['New.Class.cls'])
+        self.assertEqual(self.index.id('New.Class.cls'), '/files/New.Class.cls')
+
+class TestFileList(unittest.TestCase):
+    def setUp(self):
+        self.files = cdev.FileList.from_json([
+            { 'id': '/files/A.cls', 'name': 'A.cls', 'generatedfiles': '/generatedfiles/A.cls' },
+            { 'id': '/files/B.mac', 'name': 'B.mac' }])
+
+    def test_files(self):
+        self.assertEqual(len(self.files), 2)
+        self.assertEqual(self.files[0].generatedfiles, '/generatedfiles/A.cls')
+        self.assertFalse(hasattr(self.files[1], 'generatedfiles'))
+        self.assertEqual(self.files[1].to_dict(), { 'id': '/files/B.mac', 'name': 'B.mac' })
+        self.assertEqual([file.name for file in self.files[1:]], ['B.mac'])
+
+    def test_serialization(self):
+        loaded = cdev.FileList.load(json.loads(json.dumps(self.files.to_columns())))
+        self.assertEqual(loaded.entries(), self.files.entries())
+        self.assertEqual(loaded[0].to_dict(), self.files[0].to_dict())
+
+    def test_merge(self):
+        changes = cdev.FileList.from_json([
+            { 'id': '', 'name': 'A.cls', 'deleted': True },
+            { 'id': '/files/C.cls', 'name': 'C.cls' }])
+        self.assertEqual(self.files.merge(changes).names(), ['B.mac', 'C.cls'])
+
+class TestRender(unittest.TestCase):
+    def setUp(self):
+        self.resultset = collections.OrderedDict([('Name', ['Smith,John', 'Al']), ('SSN', ['123-45-6789', None])])
+
+    def test_newlines(self):
+        text = 'a\r\nb\r\n\r\nc\r'
+        for size in (1, 2, 3, 100):
+            self.assertEqual(''.join(cdev.normalize_newlines(cdev.text_chunks(text, size))), 'a\nb\n\nc\r')
+
+    def test_table(self):
+        lines = cdev.render_resultset(self.resultset).split('\n')
+        self.assertEqual(lines[0], '| Name       | SSN         |')
+        self.assertEqual(lines[2], '| Smith,John | 123-45-6789 |')
+        self.assertEqual(lines[3], '| Al         |             |')
+        self.assertEqual(len(set(len(line) for line in lines)), 1)
+
+    def test_truncate(self):
+        lines = cdev.render_resultset(self.resultset, max_width=5).split('\n')
+        self.assertEqual(lines[2], '| Smit\u2026 | 123-\u2026 |')
+
+    def test_csv(self):
+        self.assertEqual(cdev.render_resultset(self.resultset, 'csv'), 'Name,SSN\n"Smith,John",123-45-6789\nAl,\n')
+        self.assertEqual(cdev.render_resultset(self.resultset, 'tsv', header=False), 'Smith,John\t123-45-6789\nAl\t\n')
+
 if __name__=='__main__':
     unittest.main()
\ No newline at end of file